@@ -0,0 +1,534 @@
+###########################################################################
+## Export of Script Module: AsyncCiscoDevice
+## Language: Python
+## Category: Internal
+## Description: asyncio variant of CiscoDevice, and its transfer pipeline.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for driving many Cisco devices from one event loop
+# AsyncCiscoDevice.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   CiscoDevice, and the cleanup/transfer/verify pipeline of the job, with
+#   awaitable CLI commands. One process can drive hundreds of devices, with
+#   their long copies and verifies in flight at the same time, from one
+#   asyncio event loop.
+#
+#   The CLI goes through a Transport (one per device session). Subclass
+#   Transport to plug in another way of reaching the devices. EasyTransport
+#   adapts a NetMRIEasy instance, which is blocking: its calls run in a
+#   shared, bounded thread pool, instead of a thread per device.
+#
+#   AsyncCiscoDevice runs the same probe steps as CiscoDevice (see
+#   CiscoDevice._run()), so the parsing is shared. Facts can't be discovered
+#   on first read without blocking, so the probes must be awaited first:
+#       device = AsyncCiscoDevice(transport)
+#       await device.discover()
+#       device.platform, device.system_fs_info, ...
+#
+#   run_devices() runs a pipeline for every device, with a concurrency limit
+#   and a per-device timeout. Cancelling it (or a device timing out) cancels
+#   the pipeline at its current await, and closes the transport.
+#
+#   Transport errors from a copy are mapped to transfer error codes by
+#   CiscoDevice.get_ccs_transfer_status(). A transport should raise them the
+#   same way NetMRI does (args[0] is a dict, with the 'message').
+#------------------------------------------------------------------------------
+import asyncio
+import functools
+from CiscoDevice import CiscoDevice, OS_ROLES, get_manifest_file
+from CiscoDevice import match_manifest
+from CiscoDevice import RETRY_TRANSFER_CODES, get_ccs_transfer_status
+from CiscoDevice import TailBuffer, get_transfer_error
+from EventLog import EventLog
+
+# Command timeouts, in seconds. Same as the job.
+TRANSFER_TIMEOUT = 15300
+VERIFY_TIMEOUT = 1200
+COPY_TIMEOUT = 3600
+# Devices in flight at once, by default.
+DEFAULT_CONCURRENCY = 200
+
+
+class Transport:
+    """One CLI session to one device. Subclass it, and implement
+    get_device(), send_command() and send_async_command()."""
+
+    def get_device(self):
+        """The device (DeviceRemote, or anything with the same Device*
+        attributes)."""
+        raise NotImplementedError
+
+    async def send_command(self, command):
+        """Send a command, and return its output."""
+        raise NotImplementedError
+
+    async def send_async_command(self, command, timeout, regex):
+        """Send a long running command (e.g: copy), and return its output
+        once the prompt returns, or 'timeout' seconds have passed. The
+        output can be a str, or a TailBuffer fed as it arrives."""
+        raise NotImplementedError
+
+    async def get_device_groups(self):
+        """Names of the device groups the device is in, for TargetRules.
+        None, unless the transport can look them up."""
+        return []
+
+    async def get_network_view(self):
+        """Network view of the device, for TargetRules. From the device's
+        virtual_network, if it has one."""
+        return getattr(getattr(self.get_device(), "virtual_network", None),
+                       "VirtualNetworkName", "")
+
+    async def log_message(self, severity, message, **fields):
+        """Log a message. Dropped, unless the transport has somewhere to
+        send it."""
+
+    async def close(self):
+        """Close the session. Called by run_devices() when the device is
+        done, failed, timed out or was cancelled."""
+
+
+class EasyTransport(Transport):
+    """A Transport over a NetMRIEasy instance (or an EventLog wrapping one).
+
+    NetMRIEasy blocks, so its calls run in 'executor' (the event loop's
+    default executor if None). Share one executor between all the devices:
+    threads are bounded by its size, not by the device count. A command that
+    is cancelled is abandoned, not interrupted. It still holds its worker
+    until NetMRI returns.
+    """
+
+    def __init__(self, easy, executor=None):
+        self.easy = easy            # NetMRIEasy, or EventLog
+        self.executor = executor    # concurrent.futures.Executor
+        self.device = easy.get_device()
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def get_device(self):
+        return self.device
+
+    async def send_command(self, command):
+        return await self._call(self.easy.send_command, command)
+
+    async def send_async_command(self, command, timeout, regex):
+        return await self._call(self.easy.send_async_command, command,
+                                timeout, regex)
+
+    async def get_device_groups(self):
+        return await self._call(self._get_device_groups)
+
+    async def get_network_view(self):
+        return await self._call(self._get_network_view)
+
+    def _get_network_view(self):
+        # DeviceRemote.virtual_network is a broker call, on first read.
+        return getattr(getattr(self.device, "virtual_network", None),
+                       "VirtualNetworkName", "")
+
+    def _get_device_groups(self):
+        # Same lookup as the job's get_device_groups().
+        members = self.easy.broker("DeviceGroupMember").index(
+            DeviceID=self.device.DeviceID, select=["GroupID"]
+        )
+        group_ids = {item.GroupID for item in members}
+        if not group_ids:
+            return []
+        return [item.GroupName for item in self.easy.broker(
+                    "DeviceGroup").index(select=["GroupID", "GroupName"])
+                if item.GroupID in group_ids]
+
+    async def log_message(self, severity, message, **fields):
+        # Only EventLog keeps the typed fields.
+        if not isinstance(self.easy, EventLog):
+            fields = {}
+        await self._call(self.easy.log_message, severity, message, **fields)
+
+    async def close(self):
+        if isinstance(self.easy, EventLog):
+            await self._call(self.easy.flush)
+
+
+class AsyncCiscoDevice(CiscoDevice):
+    """CiscoDevice, with the probes awaited over a Transport."""
+
+    def __init__(self, transport):
+        # Nothing in CiscoDevice.__init__() needs the CLI.
+        super().__init__(transport)
+        self.transport = transport
+
+    def _run(self, steps):
+        # Reading a fact that isn't discovered yet lands here.
+        raise RuntimeError(f"{steps.__name__.lstrip('_')}() must be awaited"
+                           " first, on an AsyncCiscoDevice")
+
+    async def _arun(self, steps):
+        """Same as CiscoDevice._run(), awaiting the transport."""
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    if request.timeout is None:
+                        output = await self.transport.send_command(
+                            request.command
+                        )
+                    else:
+                        output = await self.transport.send_async_command(
+                            request.command, request.timeout, request.regex
+                        )
+                except Exception as err:
+                    request = steps.throw(err)
+                else:
+                    request = steps.send(output)
+        except StopIteration as stop:
+            return stop.value
+
+    async def get_context_info(self):
+        return await self._arun(self._get_context_info())
+
+    async def get_system_image_info(self):
+        return await self._arun(self._get_system_image_info())
+
+    async def get_system_fs_info(self):
+        return await self._arun(self._get_system_fs_info())
+
+    async def get_file_size_info(self, fs, name, path='/'):
+        return await self._arun(self._get_file_size_info(fs, name, path))
+
+    async def get_old_images(self, fs_list):
+        return await self._arun(self._get_old_images(fs_list))
+
+    async def get_install_summary(self):
+        return await self._arun(self._get_install_summary())
+
+    async def get_boot_config(self):
+        return await self._arun(self._get_boot_config())
+
+    async def check_device_facts(self, facts):
+        return await self._arun(self._check_device_facts(facts))
+
+    async def get_active_interfaces(self):
+        return await self._arun(self._get_active_interfaces())
+
+    async def get_http_source_interface(self):
+        return await self._arun(self._get_http_source_interface())
+
+    async def get_http_client_config(self):
+        return await self._arun(self._get_http_client_config())
+
+    async def get_relay_interfaces(self):
+        return await self._arun(self._get_relay_interfaces())
+
+    async def enter_global_config(self):
+        return await self._arun(self._enter_global_config())
+
+    async def exit_global_config(self, commit_config):
+        return await self._arun(self._exit_global_config(commit_config))
+
+    async def discover(self):
+        """Discover everything the transfer pipeline reads: the context,
+        the running image and platform, and the file systems."""
+        await self.get_system_image_info()
+        await self.get_system_fs_info()
+
+
+async def remove_old_images(device, fs_list, dry_run=False, keep=()):
+    """Delete the old images from the file systems. See
+    CiscoDevice.get_old_images().
+
+    Args:
+        - device (AsyncCiscoDevice): Discovered device.
+        - fs_list (list): File system(s) to delete from.
+        - dry_run (bool): Only log the delete commands. (Default: False)
+        - keep (list): Filenames to never delete (e.g: the target
+          manifest). (Default: ())
+
+    Returns:
+        list: The (fs, filename, kind) tuples deleted.
+    """
+    images = [item for item in await device.get_old_images(fs_list)
+              if item[1] not in keep]
+    for fs_name, image, kind in images:
+        cmd = device.get_delete_command(fs_name, image, recursive=True)
+        await device.transport.log_message(
+            "info", f"Deleting {kind} {fs_name}:/{image}"
+        )
+        if not dry_run:
+            await device.transport.send_command(cmd)
+    return images
+
+
+async def transfer_image(device, url, f_info, nxos_vrf="default",
+                         timeout=TRANSFER_TIMEOUT, dry_run=False):
+    """Copy an image to the default fs of the device.
+
+    Args:
+        - device (AsyncCiscoDevice): Discovered device.
+        - url (str): Source URL of the image.
+        - f_info (dict): Hash list row of the image ('Size' is an int).
+        - nxos_vrf (str): VRF NX-OS copies from. (Default: "default")
+        - timeout (int): Seconds to wait for the copy.
+        - dry_run (bool): Only log the copy command. (Default: False)
+
+    Raises:
+        Exception if failure. Exception.args[1] is the error code. See
+        CiscoDevice.get_transfer_error(). 0xbf is an incomplete transfer.
+    """
+    cmd = device.get_copy_command(url, f_info['Filename'], nxos_vrf)
+    if dry_run:
+        await device.transport.log_message(
+            "info", f"dry_run send_async_command: {cmd}"
+        )
+        return
+    try:
+        raw_output = TailBuffer.of(await device.transport.send_async_command(
+            cmd, timeout, ""
+        ))
+        xfr_status = device.get_transfer_status(raw_output)
+    except Exception as err:
+        xfr_status = get_ccs_transfer_status(err)
+
+    ex = get_transfer_error(device.os, xfr_status)
+    # NX-OS cURL tells us. Everything else, check the size.
+    if ex is None and device.os != "NX-OS":
+        name, size = await device.get_file_size_info(device.system_fs,
+                                                     f_info['Filename'])
+        if not name or size != f_info['Size']:
+            ex = Exception("Incomplete transfer")
+            ex.args += (0xbf,)
+    if ex:
+        raise ex
+
+
+async def verify_image(device, f_info, timeout=VERIFY_TIMEOUT,
+                       dry_run=False):
+    """Verify the integrity of an image on the default fs.
+
+    Returns:
+        bool: True if it passed. Always True on a dry run.
+    """
+    cmd, expected_hash = device.get_verify_command(f_info)
+    if dry_run:
+        await device.transport.log_message(
+            "info", f"dry_run send_async_command: {cmd}"
+        )
+        return True
+    raw_output = TailBuffer.of(await device.transport.send_async_command(
+        cmd, timeout, ""
+    ))
+    return device.verify_passed(raw_output, expected_hash)
+
+
+async def transfer_and_verify(device, url, f_info, retries=0,
+                              nxos_vrf="default", dry_run=False):
+    """Transfer and verify an image, retrying on the errors in
+    RETRY_TRANSFER_CODES. The partial file is deleted before each retry.
+
+    Returns:
+        int: Attempts it took.
+
+    Raises:
+        Exception of the last attempt, with its error code in args[1].
+        0xdf is a failed integrity check.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await transfer_image(device, url, f_info, nxos_vrf,
+                                 dry_run=dry_run)
+            if await verify_image(device, f_info, dry_run=dry_run):
+                return attempt
+            ex = Exception("Integrity check failed.")
+            ex.args += (0xdf,)
+            raise ex
+        except Exception as err:
+            code = err.args[1] if len(err.args) > 1 else None
+            if code not in RETRY_TRANSFER_CODES or attempt > retries:
+                raise
+            await device.transport.log_message(
+                "notif", f"({attempt}/{retries}) Retrying transfer of"
+                f" {f_info['Filename']} [{hex(code)} - {err.args[0]}] ..."
+            )
+            if not dry_run:
+                await device.transport.send_command(device.get_delete_command(
+                    device.system_fs, f_info['Filename']
+                ))
+
+
+async def copy_to_other_fs(device, f_info, dry_run=False):
+    """Copy an image from the default fs to the other file systems (e.g:
+    switch stack members), where it's missing. IOS/IOS-XE only.
+
+    Returns:
+        list: File systems copied to.
+    """
+    copied = []
+    if device.os not in ("IOS", "IOS-XE"):
+        return copied
+    for item in list(device.system_fs_info.values())[1:]:
+        _, size = await device.get_file_size_info(item['fs'],
+                                                  f_info['Filename'])
+        if size == f_info['Size']:
+            continue
+        cmd = (f"copy {device.system_fs}:/{f_info['Filename']}"
+               f" {item['fs']}:/{f_info['Filename']}\r\r\r")
+        await device.transport.log_message(
+            "info", f"{'dry_run ' if dry_run else ''}Copying"
+            f" {f_info['Filename']} to '{item['fs']}'"
+        )
+        if not dry_run:
+            await device.transport.send_async_command(cmd, COPY_TIMEOUT, "")
+        copied.append(item['fs'])
+    return copied
+
+
+async def transfer_pipeline(transport, repo_url, hash_rows, retries=0,
+                            clean_old_images=False, nxos_vrf="default",
+                            dry_run=False, rules=None):
+    """Discover the device, then clean up, transfer, verify and copy (to
+    the other file systems) the files of its target manifest (see
+    CiscoDevice.match_manifest()). The async counterpart of the job's
+    main(), without checkpoints.
+
+    Args:
+        - transport (Transport): Session to the device.
+        - repo_url (str): Base URL of the images (e.g: http://repo/pub).
+        - hash_rows (list): Hash list rows.
+        - retries (int): Transfer retries per image. (Default: 0)
+        - clean_old_images (bool): Delete old images first. (Default: False)
+        - nxos_vrf (str): VRF NX-OS copies from. (Default: "default")
+        - dry_run (bool): Only log what would change. (Default: False)
+        - rules (TargetRules): Targeting rules to select the system image
+          with. The platform's first one is used if no rule matches.
+          (Default: None)
+
+    Returns:
+        str: "current", "present" or "transferred".
+
+    Raises:
+        Exception if the device can't be transferred to.
+    """
+    device = AsyncCiscoDevice(transport)
+    if device.nxos_aci_mode:
+        raise Exception("Nexus ACI mode upgrade not supported.")
+    await device.discover()
+    if ((device.asa_multi_context and not device.asa_admin_context)
+            or (device.nxos_vdc and not device.nxos_default_vdc)):
+        raise Exception("Not the admin ASA context, or default VDC.")
+
+    kickstart = device.os == "NX-OS" and bool(device.nxos_kickstart_image)
+    system = None
+    if rules:
+        groups = (await transport.get_device_groups()
+                  if rules.uses_groups else [])
+        view = await transport.get_network_view()
+        system = rules.resolve(device.os, device.platform, device.model,
+                               device.version, view, groups)
+    targets = match_manifest(hash_rows, device.os, device.platform,
+                             device.asa_is_lfbff, device.asa_is_smp,
+                             kickstart, system)
+    if not targets:
+        raise Exception("Unable to find target image for platform"
+                        f' "{device.platform}"')
+    if kickstart and not get_manifest_file(targets, "kickstart"):
+        raise Exception("Unable to find kickstart image for platform"
+                        f' "{device.platform}"')
+    image = targets[0]
+    if ((device.iosxe_boot_mode == "INSTALL"
+            and f".{device.iosxe_build}." in image['Filename'])
+            or image['Filename'].startswith(device.current_system_image)):
+        # The other files of the manifest (e.g: ASDM) may still be missing.
+        targets = [item for item in targets if item['Role'] not in OS_ROLES]
+        image = None
+        if not targets:
+            return "current"
+
+    # Skip what's already there, and verified.
+    missing = []
+    for item in targets:
+        name, _ = await device.get_file_size_info(device.system_fs,
+                                                  item['Filename'])
+        if name and await verify_image(device, item, dry_run=dry_run):
+            continue
+        if name and not dry_run:
+            # NX-OS prompts to overwrite, and the default answer is "no".
+            await transport.send_command(device.get_delete_command(
+                device.system_fs, item['Filename']
+            ))
+        missing.append(item)
+    if not missing:
+        if image:
+            await copy_to_other_fs(device, image, dry_run)
+        return "present"
+
+    fs_list = [item['fs'] for item in device.system_fs_info.values()]
+    if clean_old_images:
+        await remove_old_images(device, fs_list, dry_run,
+                                [item['Filename'] for item in targets])
+        await device.get_system_fs_info()
+    needed = sum(int(item['Size']) for item in missing)
+    for item in device.system_fs_info.values():
+        if int(item['free']) < needed:
+            raise Exception(f"Insufficient free space on {item['fs']}")
+
+    for item in missing:
+        await transfer_and_verify(device, f"{repo_url}/{item['Filename']}",
+                                  item, retries, nxos_vrf, dry_run)
+    if image:
+        await copy_to_other_fs(device, image, dry_run)
+    return "transferred"
+
+
+async def run_devices(transports, pipeline, concurrency=DEFAULT_CONCURRENCY,
+                      timeout=None):
+    """Run a pipeline for every device, concurrently, from this event loop.
+
+    Args:
+        - transports (iterable): Transport of each device.
+        - pipeline (coroutine function): Called with a transport (e.g:
+          functools.partial(transfer_pipeline, repo_url=..., hash_rows=...)).
+        - concurrency (int): Devices in flight at once.
+        - timeout (float): Seconds each device may take. None is no limit.
+
+    Returns:
+        list: (transport, result) in the same order. The result is what the
+              pipeline returned, or the exception it raised
+              (asyncio.TimeoutError if the device timed out).
+    """
+    transports = list(transports)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(transport):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(pipeline(transport), timeout)
+            except Exception as err:
+                return err
+            finally:
+                await transport.close()
+
+    results = await asyncio.gather(*(run_one(item) for item in transports))
+    return list(zip(transports, results))
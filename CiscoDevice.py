@@ -35,10 +35,1390 @@
 #       - NX-OS 5K/6K/7K [Version 4.0(1), or higher]
 #       - NX-OS 3K/9K
 #       - Adaptive Security Appliance (ASA) 5500-X Series [Ver. 9, or higher]
+#
+#   Constructing a CiscoDevice does not send any CLI command. Facts that need
+#   the CLI (e.g: platform, system_fs_info) are discovered the first time
+#   they are read, by the probe method that owns them, and kept. Probes run
+#   the probes they depend on first, only if those facts aren't known yet.
+#   Calling a probe method directly refreshes its facts.
+#
+#   Probes, and the facts they discover:
+#       get_context_info(): asa_multi_context, asa_admin_context,
+#           asa_admin_context_name, nxos_default_vdc_name, nxos_default_vdc,
+#           vdc_id
+#       get_system_image_info(): platform, current_system_image,
+#           current_system_image_fs, nxos_kickstart_image, iosxe_boot_mode,
+#           iosxe_build, iosxe_sdwan
+#       get_system_fs_info(): system_fs, system_fs_info
+#
+#   OS type, device flags and platform aliases come from the classification
+#   tables (OS_RULES, ..., PLATFORM_ALIASES). They are compiled into one regex
+#   that classifies a single device (classify_device()), or a whole inventory
+#   export in one pass (classify_inventory()).
+#
+#   The target image of a platform is its first system image in the hash
+#   list, unless targeting rules (TargetRules) select another one, by model,
+#   version range, network view or device group.
 #------------------------------------------------------------------------------
+import array
+import collections
+import functools
+import itertools
 import re
+import struct
+import sys
+import zlib
+
+# Classification tables. See classify_device() and classify_inventory().
+#
+# OS type, by sysDescr.0 (DeviceRemote.DeviceSysDescr) regex.
+# Tried in order. The first match wins.
+OS_RULES = (
+    ("ASA", r"Adaptive Security"),
+    ("NX-OS", r"NX-OS"),
+    # IOS-XE has many different variations in the sysDescr.0 ...
+    ("IOS-XE", r"IOSXE|IOS-XE|IOS XE|LINUX_IOSD|CAT3K_"),
+    ("IOS", r"IOS")
+)
+# Device flags, by sysDescr.0 regex, for an OS type.
+SYSDESCR_FLAG_RULES = (
+    ("nxos_aci_mode", "NX-OS", r"aci"),
+)
+# Device flags, by model (DeviceRemote.DeviceModel) regex, for an OS type.
+MODEL_FLAG_RULES = (
+    # asa933-7-lfbff-k8.SPA - 5506-X, 5508-X, 5516-X.
+    ("asa_is_lfbff", "ASA", r"5506|5508|5516"),
+    # asa924-5-smp-K8.bin - 5512-X, 5515-X, 5525-X, 5545-X, 5555-X
+    #                     - 5585-X, ASAv
+    # TODO: ASAv?
+    ("asa_is_smp", "ASA", r"5512|5515|5525|5545|5555|5585"),
+    # N7k/N77 have VDCs.
+    ("nxos_vdc", "NX-OS", r"^N7[K7]")
+)
+# Platform, by OS type, when it doesn't depend on the image.
+PLATFORM_BY_OS = {
+    "ASA": "asa"
+}
+# Platform, by image name regex. Group 1 is the platform.
+# (OS type, NX-OS ACI mode, regex). None matches anything. First match wins.
+IMAGE_PLATFORM_RULES = (
+    ("NX-OS", True, r"(aci-[a-zA-Z0-9]+)(?:-|_|\.)"),
+    # CAT92k uses cat9k_lite. Other use cat9k_iosxe.
+    # NOTE: NX-OS higher than 7.0(3)I2(1) uses one image "nxos".
+    (None, None, r"([a-zA-Z0-9]+(?:_lite|_iosxe)?)(?:-|_|\.)")
+)
+# Platform aliases. (regex on the start of the platform, replacement)
+PLATFORM_ALIASES = (
+    # IOS-XE 3X for cat3k shows platform as "ng3k" in packages.conf.
+    (r"ng3k$", "cat3k_caa"),
+    # C8300 and C8500 used to be individual platforms.
+    # Cisco has consolidated them to "c8000"
+    (r"c8300", "c8000"),
+    (r"c8500", "c8000")
+)
+
+
+def _lookahead_flags(rules, prefix):
+    # One optional lookahead per rule, so every rule is tested on the line.
+    return "".join(f"(?:(?=.*?(?P<{prefix}{i}>{rule[-1]}))|)"
+                   for i, rule in enumerate(rules))
+
+
+# Every table is compiled into one regex per input, anchored on a line. The
+# same regex classifies a single device (match), or a whole inventory at
+# once (finditer over all the rows, joined with newlines).
+_SYSDESCR_RE = re.compile(
+    # OS rules, in order. The first lookahead that matches wins.
+    "^(?:" + "|".join(f"(?=.*?(?P<os{i}>{pattern}))"
+                      for i, (_, pattern) in enumerate(OS_RULES)) + "|)"
+    + _lookahead_flags(SYSDESCR_FLAG_RULES, "sf")
+    # Image family, e.g: "... Software (C3560CX-UNIVERSALK9-M), ..."
+    + r"(?:(?=.*?Software\s+\((?P<family>[A-Za-z0-9_-]+)\))|)"
+    + ".*$", re.MULTILINE
+)
+_MODEL_RE = re.compile(
+    "^" + _lookahead_flags(MODEL_FLAG_RULES, "mf") + ".*$", re.MULTILINE
+)
+_IMAGE_PLATFORM_RES = tuple((os_type, aci, re.compile(pattern))
+                            for os_type, aci, pattern in IMAGE_PLATFORM_RULES)
+_ALIAS_RE = re.compile(
+    "^(?:" + "|".join(f"(?P<a{i}>{pattern})"
+                      for i, (pattern, _) in enumerate(PLATFORM_ALIASES))
+    + ")"
+)
+
+# Result of classify_device(). Flags are always False for other OS types.
+Classification = collections.namedtuple("Classification", (
+    "os",               # (str) OS type, or None
+    "family",           # (str) Image family from sysDescr (lowercase)
+    "nxos_aci_mode",    # (bool)
+    "asa_is_lfbff",     # (bool)
+    "asa_is_smp",       # (bool)
+    "nxos_vdc"          # (bool)
+))
+
+
+def _one_line(value):
+    # Never empty, so every row is exactly one match.
+    return (value or " ").replace("\r", " ").replace("\n", " ")
+
+
+def _flags(match, rules, prefix, os_type):
+    return {
+        flag: (flag_os == os_type
+               and match.group(f"{prefix}{i}") is not None)
+        for i, (flag, flag_os, _) in enumerate(rules)
+    }
+
+
+# Group numbers, to read all the groups of a match with one groups() call.
+_OS_GROUPS = tuple((_SYSDESCR_RE.groupindex[f"os{i}"] - 1, name)
+                   for i, (name, _) in enumerate(OS_RULES))
+_FAMILY_GROUP = _SYSDESCR_RE.groupindex["family"] - 1
+_FLAG_GROUPS = (
+    tuple((_SYSDESCR_RE.groupindex[f"sf{i}"] - 1, flag, flag_os, 0)
+          for i, (flag, flag_os, _) in enumerate(SYSDESCR_FLAG_RULES))
+    + tuple((_MODEL_RE.groupindex[f"mf{i}"] - 1, flag, flag_os, 1)
+            for i, (flag, flag_os, _) in enumerate(MODEL_FLAG_RULES))
+)
+
+
+def _classification(sys_match, model_match):
+    sys_groups = sys_match.groups()
+    groups = (sys_groups, model_match.groups())
+    os_type = None
+    for index, name in _OS_GROUPS:
+        if sys_groups[index] is not None:
+            os_type = name
+            break
+    family = sys_groups[_FAMILY_GROUP]
+    flags = {
+        flag: flag_os == os_type and groups[source][index] is not None
+        for index, flag, flag_os, source in _FLAG_GROUPS
+    }
+    return Classification(os=os_type,
+                          family=family.lower() if family else None,
+                          **flags)
+
+
+def classify_device(sysdescr, model=""):
+    """Classify a device from its sysDescr and model. No CLI needed.
+
+    Args:
+        - sysdescr (str): DeviceRemote.DeviceSysDescr
+        - model (str): DeviceRemote.DeviceModel
+
+    Returns:
+        Classification: os is None if it could not be determined.
+    """
+    return _classification(_SYSDESCR_RE.match(_one_line(sysdescr)),
+                           _MODEL_RE.match(_one_line(model)))
+
+
+def classify_inventory(sysdescrs, models):
+    """Classify a whole inventory at once.
+
+    Each of the two compiled tables makes a single pass over all the rows.
+
+    Args:
+        - sysdescrs (list): DeviceSysDescr of each device.
+        - models (list): DeviceModel of each device, in the same order.
+
+    Returns:
+        list: A Classification per device, in the same order.
+    """
+    sys_matches = list(_SYSDESCR_RE.finditer(
+        "\n".join(_one_line(value) for value in sysdescrs)
+    ))
+    model_matches = list(_MODEL_RE.finditer(
+        "\n".join(_one_line(value) for value in models)
+    ))
+    if len(sys_matches) != len(sysdescrs) or len(model_matches) != len(models):
+        raise ValueError("sysdescrs and models must have one row per device")
+    return [_classification(sys_match, model_match)
+            for sys_match, model_match in zip(sys_matches, model_matches)]
+
+
+def normalize_platform(platform):
+    """Apply PLATFORM_ALIASES to a platform (e.g: c8300be -> c8000be)."""
+    if not platform:
+        return platform
+    match = _ALIAS_RE.match(platform)
+    if not match:
+        return platform
+    replacement = PLATFORM_ALIASES[int(match.lastgroup[1:])][1]
+    return replacement + platform[match.end():]
+
+
+def platform_from_image(os_type, image, nxos_aci_mode=False):
+    """Derive the platform from an image name (BUNDLE mode, or NX-OS/ASA).
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - image (str): The image filename.
+        - nxos_aci_mode (bool): NX-OS is in ACI mode.
+
+    Returns:
+        str: The platform, or None if it can't be derived.
+    """
+    if os_type in PLATFORM_BY_OS:
+        return PLATFORM_BY_OS[os_type]
+    for rule_os, rule_aci, regex in _IMAGE_PLATFORM_RES:
+        if ((rule_os is None or rule_os == os_type)
+                and (rule_aci is None or rule_aci == nxos_aci_mode)):
+            match = regex.search(image or "")
+            return normalize_platform(match.group(1)) if match else None
+    return None
+
+
+def get_os_type(sysdescr):
+    """Determine the OS type from sysDescr.0 (DeviceRemote.DeviceSysDescr).
+
+    Args:
+        - sysdescr (str): The device sysDescr.
+
+    Returns:
+        str: "ASA", "NX-OS", "IOS-XE" or "IOS".
+
+    Raises:
+        ValueError if the OS could not be determined.
+    """
+    os_type = classify_device(sysdescr).os
+    if os_type is None:
+        # If we got here, we got problems.
+        raise ValueError("Unable to determine OS")
+    return os_type
+
+
+def get_asa_image_flags(model):
+    """Determine which ASA image format a model uses.
+
+    Args:
+        - model (str): The device model (DeviceRemote.DeviceModel).
+
+    Returns:
+        tuple: (asa_is_lfbff, asa_is_smp)
+    """
+    flags = _flags(_MODEL_RE.match(_one_line(model)), MODEL_FLAG_RULES,
+                   "mf", "ASA")
+    return (flags['asa_is_lfbff'], flags['asa_is_smp'])
+
+
+def get_version_info(os_type, version):
+    """Parse the running version (DeviceRemote.DeviceVersion) into its parts.
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - version (str): The version string.
+
+    Returns:
+        dict: The detailed version. The keys depend on the OS type.
+              Values are None if the version string could not be parsed.
+    """
+    verinfo = {}
+    if os_type == "ASA":
+        # NOTE: ASA prior to 9.10 uses format like this:
+        #       asa{maj}{min}{maint}-{patch}-...
+        #       After 9.10, the format changes to:
+        #       asa{maj}-{min}-{maint}-{patch}-....
+        verinfo = {
+            'maj': None,    # (int) Major release
+            'min': None,    # (int) Minor release
+            'maint': None,  # (int) Maintenance release
+            'rebld': None   # (int) Patch
+        }
+        # DeviceVersion: 9.8(4)26. Image: asa984-26-..., asa9-12-4-2-...
+        match = (re.search(r'(\d+)\.(\d+)\((\d+)\)(\d+)?', version)
+                 or re.search(r'(\d)-?(\d+)-?(\d)-(\d+)?', version))
+
+        if match:
+            verinfo['maj'] = int(match.group(1))
+            verinfo['min'] = int(match.group(2))
+            verinfo['maint'] = int(match.group(3))
+            verinfo['rebld'] = (
+                int(match.group(4)) if match.group(4) else None
+            )
+
+    elif os_type == "NX-OS":
+        verinfo = {
+            'maj': None,    # (int) Major release
+            'min': None,    # (int) Minor release
+            'maint': None,  # (int) Maintenance release
+            'rebld': None,  # (str) Rebuild
+            'train': None   # (str) Platform train/release (e.g: I7(9))
+        }
+        match = re.search(r'(\d+)\.(\d+)\((\d+)(\w+)?\)(\S*)', version)
+        if match:
+            verinfo['maj'] = int(match.group(1))
+            verinfo['min'] = int(match.group(2))
+            verinfo['maint'] = int(match.group(3))
+            verinfo['rebld'] = match.group(4)
+            verinfo['train'] = match.group(5) or None
+
+    elif os_type == "IOS-XE":
+        verinfo = {
+            'maj': None,    # (int) Major release
+            'rel': None,    # (int) Release version
+            'rebld': None,  # (int) Rebuild
+            'spcrel': None, # (str) Special release
+            'train': None,  # (str) Train (IOS-XE 3X)
+            'iosd': None    # (str) IOSd (IOS-XE 3X)
+        }
+        match = re.search(
+            r'(\d+)\.(\d+)\.(\d+)\.?([a-zA-Z0-9]+)?\.?(\S+)?', version
+        )
+        if match:
+            verinfo['maj'] = int(match.group(1))
+            verinfo['rel'] = int(match.group(2))
+            verinfo['rebld'] = int(match.group(3))
+            # IOS-XE "Peaks"
+            if verinfo['maj'] >= 16:
+                verinfo['spcrel'] = match.group(4)
+            # IOS-XE 3X
+            elif verinfo['maj'] == 3:
+                verinfo['train'] = match.group(4)
+                verinfo['iosd'] = match.group(5)
+
+    elif os_type == "IOS":
+        verinfo = {
+            'maj': None,    # (int) Major version / Main release
+            'min': None,    # (int) Release version / Major feature
+            'feat': None,   # (str) Feature release number
+            'type': None,   # (str) Type / Train
+            'maint': None   # (str) Maintenance rebuild
+        }
+        match = re.search(
+            r'(\d+)\.(\d+)\(([a-zA-Z0-9]+)\)([A-Z]+)([a-z0-9]+)?',
+            version
+        )
+        if match:
+            verinfo['maj'] = int(match.group(1))
+            verinfo['min'] = int(match.group(2))
+            verinfo['feat'] = match.group(3)
+            verinfo['type'] = match.group(4)
+            verinfo['maint'] = match.group(5)
+    return verinfo
+
+
+# Roles of the files in a platform's manifest, in transfer order. Every
+# platform has one 'system' image. The others are optional, and only taken
+# from hash list rows with a 'Role' column (NX-OS kickstart images are also
+# recognized by name).
+MANIFEST_ROLES = ("system", "kickstart", "rommon", "asdm", "smu")
+# Roles that can have more than one file per platform.
+MANIFEST_MULTI_ROLES = ("smu",)
+# Roles that make up the running OS. A device already running the target
+# only needs the other roles.
+OS_ROLES = ("system", "kickstart")
+
+
+def get_file_role(row):
+    """Get the manifest role of a hash list row.
+
+    Args:
+        - row (dict): Hash list row. 'Role' is optional.
+
+    Returns:
+        str: One of MANIFEST_ROLES, or None if the role is unknown.
+    """
+    role = (row.get('Role') or "").strip().lower()
+    if not role:
+        return "kickstart" if "kickstart" in row['Filename'] else "system"
+    return role if role in MANIFEST_ROLES else None
+
+
+def _platform_matches(row, os_type, platform):
+    """Check if a hash list row is for a platform: its 'Platform' column
+    (comma separated), if it has one, or else its filename prefix."""
+    if row.get('Platform'):
+        return platform in (item.strip().lower()
+                            for item in row['Platform'].split(","))
+    # ASA does not have delimiter between the platform and version.
+    if os_type == "ASA":
+        return row['Filename'].startswith(platform)
+    # 2023.05.25 - aensminger - Add generator, so we match
+    # "c800-" to c800-univeralk9-mz.xxx-x.xx.bin,
+    # instead of c800 getting matched with c8000aep-universalk9...
+    return any(row['Filename'].startswith(plat)
+               for plat in (platform + '-', platform + '_', platform + '.'))
+
+
+def match_upgrade_file(rows, os_type, platform, asa_is_lfbff=False,
+                       asa_is_smp=False, kickstart=False):
+    """Find the target upgrade file for a platform in the hash list rows.
+
+    Args:
+        - rows (list): Hash list rows (dicts with 'Filename', 'Size', ...)
+        - os_type (str): CiscoDevice.os
+        - platform (str): CiscoDevice.platform
+        - asa_is_lfbff (bool): CiscoDevice.asa_is_lfbff
+        - asa_is_smp (bool): CiscoDevice.asa_is_smp
+        - kickstart (bool): True returns NX-OS kickstart image.
+
+    Returns:
+        dict: The first matching row, with 'Size' converted to int.
+              None if nothing matched.
+    """
+    role = "kickstart" if kickstart else "system"
+    for item in rows:
+        # Never return the kickstart (or an ASDM, ...) as the system image,
+        # if it happens to be listed first.
+        if (get_file_role(item) != role
+                or not _platform_matches(item, os_type, platform)):
+            continue
+        # Remove commas and store size as integer.
+        item['Size'] = int(str(item['Size']).replace(",", ""))
+        if os_type != "ASA":
+            return item
+
+        # Return appropriate item for ASA.
+        # 5506-X, 5508-X, 5516-X.
+        if asa_is_lfbff and "lfbff" in item['Filename']:
+            return item
+
+        # 5512-X, 5515-X, 5525-X, 5545-X, 5555-X, 5585-X, ASAv
+        if asa_is_smp and "smp" in item['Filename']:
+            return item
+
+        # Legacy ASA.
+        return item
+    return None
+
+
+def match_manifest(rows, os_type, platform, asa_is_lfbff=False,
+                   asa_is_smp=False, kickstart=False, system=None):
+    """Find every file of the target manifest of a platform, in the hash
+    list rows: the system image, then the kickstart, ROMMON, ASDM and SMUs
+    (see MANIFEST_ROLES).
+
+    Args:
+        - rows, os_type, platform, asa_is_lfbff, asa_is_smp: See
+          match_upgrade_file().
+        - kickstart (bool): Include the NX-OS kickstart image.
+        - system (dict): The system image row, if already selected (e.g: by
+                         TargetRules.resolve()). The kickstart is then the
+                         one of the same version. (Default: None, the first
+                         system image of the platform)
+
+    Returns:
+        list: The matching rows, in transfer order, with 'Size' converted to
+              int, and 'Role' set. Empty if there's no system image. A
+              missing kickstart is left out, check for it.
+    """
+    pinned = system is not None
+    if pinned:
+        system['Size'] = int(str(system['Size']).replace(",", ""))
+    else:
+        system = match_upgrade_file(rows, os_type, platform, asa_is_lfbff,
+                                    asa_is_smp)
+    if not system:
+        return []
+    system['Role'] = "system"
+    manifest = [system]
+    if kickstart and pinned:
+        version = get_image_version(os_type, system['Filename'])
+        item = next((
+            row for row in rows
+            if get_file_role(row) == "kickstart"
+            and _platform_matches(row, os_type, platform)
+            and version is not None
+            and get_image_version(os_type, row['Filename']) == version
+        ), None)
+        if item:
+            item['Size'] = int(str(item['Size']).replace(",", ""))
+            item['Role'] = "kickstart"
+            manifest.append(item)
+    elif kickstart:
+        item = match_upgrade_file(rows, os_type, platform, kickstart=True)
+        if item:
+            item['Role'] = "kickstart"
+            manifest.append(item)
+    for role in MANIFEST_ROLES[2:]:
+        for item in rows:
+            if (get_file_role(item) != role
+                    or not _platform_matches(item, os_type, platform)):
+                continue
+            item['Size'] = int(str(item['Size']).replace(",", ""))
+            item['Role'] = role
+            manifest.append(item)
+            if role not in MANIFEST_MULTI_ROLES:
+                break
+    return manifest
+
+
+def get_manifest_file(manifest, role):
+    """Get the first file of a role from a manifest, or None."""
+    return next((item for item in manifest if item['Role'] == role), None)
+
+
+def get_image_version(os_type, filename):
+    """Get the version of an image, from its (Cisco default) filename.
+
+    The version is in the same format as DeviceRemote.DeviceVersion, so both
+    parse to the same get_version_info() (e.g:
+    c3560cx-universalk9-mz.152-7.E8.bin -> 15.2(7)E8).
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - filename (str): The image filename.
+
+    Returns:
+        str: The version, or None if the filename could not be parsed.
+    """
+    if os_type == "ASA":
+        # asa984-26-smp-k8.bin, asa9-12-4-2-lfbff-k8.SPA
+        verinfo = get_version_info(os_type, filename)
+        if verinfo['maj'] is None:
+            return None
+        return (f"{verinfo['maj']}.{verinfo['min']}({verinfo['maint']})"
+                f"{verinfo['rebld'] if verinfo['rebld'] is not None else ''}")
+    if os_type == "NX-OS":
+        # nxos.9.3.8.bin, nxos.7.0.3.I7.9.bin, n5000-uk9.7.3.8.N1.1.bin
+        match = re.search(
+            r'\.(\d+)\.(\d+)\.(\d+)(?:\.([A-Z]+\d+)\.(\d+[a-z]?))?'
+            r'(?:\.[A-Z])?\.bin$', filename
+        )
+        if not match:
+            return None
+        version = f"{match.group(1)}.{match.group(2)}({match.group(3)})"
+        if match.group(4):
+            version += f"{match.group(4)}({match.group(5)})"
+        return version
+    if os_type == "IOS-XE":
+        # cat9k_iosxe.17.09.04a.SPA.bin
+        match = re.search(r'\.(\d{2})\.(\d{2})\.(\d{2})([a-z]?)\.SPA\.bin$',
+                          filename)
+        if match:
+            return (f"{int(match.group(1))}.{int(match.group(2))}"
+                    f".{int(match.group(3))}{match.group(4)}")
+        # IOS-XE 3X: cat3k_caa-universalk9.SPA.03.06.06.E.152-2.E6.bin
+        match = re.search(r'\.(\d{2})\.(\d{2})\.(\d{2})\.([A-Z]+)\.',
+                          filename)
+        if match:
+            return "{}.{}.{}{}".format(*match.groups())
+        return None
+    if os_type == "IOS":
+        # c3560cx-universalk9-mz.152-7.E8.bin
+        match = re.search(
+            r'\.(\d{2})(\d)-([a-zA-Z0-9]+)\.([A-Z]+[a-z0-9]*)\.bin$', filename
+        )
+        if match:
+            return "{}.{}({}){}".format(*match.groups())
+    return None
+
+
+def get_version_key(os_type, version):
+    """Parse a version into a key that compares equal for the same release.
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - version (str): DeviceRemote.DeviceVersion, or get_image_version().
+
+    Returns:
+        tuple: The get_version_info() values, or None if it couldn't be
+               parsed.
+    """
+    verinfo = get_version_info(os_type, version or "")
+    if verinfo.get('maj') is None:
+        return None
+    return tuple(verinfo.values())
+
+
+def platform_from_sysdescr(cls, version):
+    """Best effort platform from the sysDescr, without any CLI.
+
+    The sysDescr contains the image family in parentheses
+    (e.g: "C3560CX Software (C3560CX-UNIVERSALK9-M), Version ..."). The same
+    image rules that CiscoDevice.get_system_image_info() uses for BUNDLE
+    images are applied to it.
+
+    Args:
+        - cls (Classification): From classify_device()/classify_inventory().
+        - version (str): DeviceRemote.DeviceVersion
+
+    Returns:
+        str: The platform, or None if it cannot be derived.
+    """
+    os_type = cls.os
+    if os_type == "ASA":
+        return platform_from_image(os_type, "")
+    family = cls.family
+    if not family:
+        return None
+    # e.g: ISR4k, ASR1k. The image name is not in sysDescr.
+    if family.startswith("x86_64_linux_iosd") or "linux_iosd" in family:
+        return None
+    # Starting with 7.0(3)I2(1), N3K/N9K use the one "nxos" image.
+    if os_type == "NX-OS" and family.startswith(("n9000", "n3000")):
+        verinfo = get_version_info(os_type, version)
+        if verinfo['maj'] is not None and (
+                verinfo['maj'] > 7
+                or re.search(r'^7\.0\(3\)I[2-9]', version)):
+            return "nxos"
+    return platform_from_image(os_type, family + ".")
+
+
+# Targeting rules. See TargetRules.
+#
+# Rule columns matched exactly (case-insensitive) through the index. An empty
+# cell, or "*", matches anything. A cell can list values, comma separated.
+RULE_KEY_FIELDS = ("Platform", "Model", "Network View", "Device Group")
+RULE_WILDCARDS = ("", "*")
+
+
+def get_version_order(os_type, version):
+    """Parse a version into a key that sorts in release order.
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - version (str): DeviceRemote.DeviceVersion, or get_image_version().
+
+    Returns:
+        tuple: Comparable to the keys of the same OS type, or None if the
+               version couldn't be parsed.
+    """
+    verinfo = get_version_info(os_type, version or "")
+    if verinfo.get('maj') is None:
+        return None
+    key = []
+    for value in verinfo.values():
+        if value is None:
+            key.append(())
+        elif isinstance(value, int):
+            key.append(((value, ""),))
+        else:
+            # e.g: "E10" -> ((-1, "E"), (10, "")), so it sorts after "E8".
+            key.append(tuple((int(part), "") if part.isdigit() else (-1, part)
+                             for part in re.findall(r'\d+|\D+', value)))
+    return tuple(key)
+
+
+class TargetRules:
+    """Targeting rules (e.g: the "Cisco OS SW Target Rules" list), compiled
+    into an index.
+
+    Each rule selects a system image from the hash list ('Filename') for the
+    devices it matches: on RULE_KEY_FIELDS, and on the running version
+    ('Min Version' to 'Max Version', both inclusive, either can be empty).
+    Rules are tried by 'Priority' (lowest first, empty is last), then in
+    list order. The first match wins.
+
+    Rules are indexed once, by their RULE_KEY_FIELDS values. Resolving a
+    device is one dict lookup per combination of wildcard columns the rules
+    use (at most 16, per device group), whatever the number of rules. Only
+    the rules found by those lookups have their version range checked.
+    """
+
+    def __init__(self, rule_rows, hash_rows):
+        """
+        Args:
+            - rule_rows (list): Rule rows (dicts, see above).
+            - hash_rows (list): Hash list rows.
+
+        Raises:
+            ValueError if a rule's 'Filename' is not in the hash list, or its
+            'Priority' is not a number.
+        """
+        files = {}
+        for item in hash_rows:
+            files.setdefault(item['Filename'], item)
+        self.index = {}         # Key (None is a wildcard) -> [entries]
+        self.masks = set()      # Wildcard columns in use, as bool tuples
+        self.uses_groups = False
+        self.count = len(rule_rows)
+        # Parsed device versions. A fleet only runs a handful.
+        self.versions = {}
+        for num, row in enumerate(rule_rows, 1):
+            filename = (row.get('Filename') or "").strip()
+            if filename not in files:
+                raise ValueError(f"Target rule {num}: {filename!r} is not"
+                                 " in the hash list")
+            priority = str(row.get('Priority') or "").strip()
+            try:
+                rank = (int(priority) if priority else sys.maxsize, num)
+            except ValueError:
+                raise ValueError(f"Target rule {num}: Priority {priority!r}"
+                                 " is not a number") from None
+            bounds = self._bounds(row.get('Min Version'),
+                                  row.get('Max Version'))
+            entry = (rank, bounds, files[filename])
+            cells = [self._cell(row.get(field)) for field in RULE_KEY_FIELDS]
+            self.uses_groups = self.uses_groups or cells[-1] != (None,)
+            for key in itertools.product(*cells):
+                self.masks.add(tuple(value is None for value in key))
+                self.index.setdefault(key, []).append(entry)
+        for entries in self.index.values():
+            entries.sort(key=lambda entry: entry[0])
+
+    @staticmethod
+    def _bounds(low, high):
+        # None if the rule has no version range. Otherwise the parsed range
+        # for every OS type, since the rule may not say which one it's for.
+        # None for an OS type whose versions don't parse the same way.
+        low = str(low or "").strip()
+        high = str(high or "").strip()
+        if not low and not high:
+            return None
+        bounds = {}
+        for os_type, _ in OS_RULES:
+            low_key = get_version_order(os_type, low) if low else ()
+            high_key = get_version_order(os_type, high) if high else ()
+            bounds[os_type] = (None if low_key is None or high_key is None
+                               else (low_key, high_key))
+        return bounds
+
+    @staticmethod
+    def _cell(value):
+        values = tuple(item.strip().lower()
+                       for item in str(value or "").split(","))
+        if any(item in RULE_WILDCARDS for item in values):
+            return (None,)
+        return values
+
+    def resolve(self, os_type, platform, model, version, network_view="",
+                groups=()):
+        """Find the target system image of a device.
+
+        Args:
+            - os_type (str): CiscoDevice.os
+            - platform (str): CiscoDevice.platform
+            - model (str): DeviceRemote.DeviceModel
+            - version (str): DeviceRemote.DeviceVersion
+            - network_view (str): The device's network view.
+            - groups (iterable): Names of the device groups the device is
+                                 in. (Only needed if self.uses_groups)
+
+        Returns:
+            dict: The hash list row of the first matching rule, or None.
+                  Rules that select an image for another platform never
+                  match.
+        """
+        values = tuple(str(value or "").strip().lower()
+                       for value in (platform, model, network_view))
+        if (os_type, version) not in self.versions:
+            self.versions[os_type, version] = get_version_order(os_type,
+                                                                version)
+        version = self.versions[os_type, version]
+        groups = [str(group).strip().lower() for group in groups
+                  if str(group).strip()] or [""]
+        order = None
+        best = None
+        for mask in self.masks:
+            for group in groups if not mask[-1] else ("",):
+                key = tuple(None if wild else value for wild, value
+                            in zip(mask, values + (group,)))
+                for rank, bounds, row in self.index.get(key, ()):
+                    if order is not None and rank >= order:
+                        break
+                    if (self._in_range(bounds, os_type, version)
+                            and _platform_matches(row, os_type, platform)):
+                        order, best = rank, row
+                        break
+        return best
+
+    @staticmethod
+    def _in_range(bounds, os_type, version):
+        if bounds is None:
+            return True
+        if bounds.get(os_type) is None or version is None:
+            return False
+        low, high = bounds[os_type]
+        return (not low or low <= version) and (not high or version <= high)
+
+
+def prefilter_current(rows, hash_rows, classes=None, rules=None):
+    """Find the devices already running their target version, without CLI.
+
+    Only the DeviceRemote fields are used. A device is current when its
+    platform can be derived from the sysDescr, the hash list has a target
+    for it (and no other files, like an ASDM image, that may be missing),
+    and the target's version (from its filename) parses to the same version
+    key as the DeviceVersion.
+
+    Args:
+        - rows (list): Dicts with 'DeviceID', 'DeviceSysDescr',
+                       'DeviceModel' and 'DeviceVersion'. With rules, also
+                       'Network View' (or 'VirtualNetworkName'), and
+                       'Device Groups' (comma separated).
+        - hash_rows (list): Hash list rows.
+        - classes (list): classify_inventory() of the rows, if already done.
+                          (Default: None)
+        - rules (TargetRules): Targeting rules. The platform's first system
+                               image is the target of devices no rule
+                               matches. (Default: None)
+
+    Returns:
+        dict: Target filename, keyed by DeviceID, for the current devices.
+    """
+    if classes is None:
+        classes = classify_inventory([row.get('DeviceSysDescr')
+                                      for row in rows],
+                                     [row.get('DeviceModel') for row in rows])
+    targets = {}
+    current = {}
+    for row, cls in zip(rows, classes):
+        if cls.os is None or cls.nxos_aci_mode:
+            continue
+        version = row.get('DeviceVersion') or ""
+        platform = platform_from_sysdescr(cls, version)
+        if not platform:
+            continue
+        system = rules.resolve(
+            cls.os, platform, row.get('DeviceModel'), version,
+            row.get('Network View') or row.get('VirtualNetworkName'),
+            (row.get('Device Groups') or "").split(",")
+        ) if rules else None
+        # Most of the fleet shares a handful of targets. Parse each once.
+        key = (cls.os, platform, cls.asa_is_lfbff, cls.asa_is_smp,
+               system['Filename'] if system else None)
+        if key not in targets:
+            manifest = match_manifest(hash_rows, *key[:4], system=system)
+            item = manifest[0] if manifest else None
+            # Files besides the OS (e.g: ASDM) may still be missing. Only
+            # the device can tell.
+            if not item or any(other['Role'] not in OS_ROLES
+                               for other in manifest):
+                targets[key] = (None, None)
+            else:
+                targets[key] = (item['Filename'], get_version_key(
+                    cls.os, get_image_version(cls.os, item['Filename'])
+                ))
+        filename, target_key = targets[key]
+        if (target_key is not None
+                and get_version_key(cls.os, version) == target_key):
+            current[row.get('DeviceID')] = filename
+    return current
+
+
+# Lines of a long command output kept by TailBuffer. The status parsers only
+# look at the last few.
+TAIL_LINES = 20
+# Longest line kept, in characters. A copy can print its progress marks on
+# one line, for hours.
+TAIL_LINE_CHARS = 512
+# Slice size TailBuffer.of() feeds a complete output in.
+TAIL_FEED_CHARS = 65536
+
+
+class TailBuffer:
+    """The tail of a long command output (e.g: copy, verify), in bounded
+    memory, however long the command ran.
+
+    Keeps the last 'max_lines' lines, plus counters of the whole output.
+    Output can be fed in chunks, as it arrives, or at once with
+    TailBuffer.of(). Lines are split on "\\n", "\\r\\n" and "\\r", like
+    str.splitlines().
+    """
+
+    def __init__(self, max_lines=TAIL_LINES, max_line_chars=TAIL_LINE_CHARS):
+        self.lines = collections.deque(maxlen=max_lines)  # Complete lines
+        self.max_line_chars = max_line_chars
+        self.partial = ""           # Last line, not terminated yet
+        self.chars = 0              # Characters fed
+        self.line_count = 0         # Line breaks fed
+        self.progress_marks = 0     # '!' fed (e.g: copy progress)
+        self.pending_cr = False     # Last chunk ended with "\r"
+
+    @classmethod
+    def of(cls, output, **kwargs):
+        """A TailBuffer of a complete output. Returns 'output' as is if it
+        already is one."""
+        if isinstance(output, cls):
+            return output
+        tail = cls(**kwargs)
+        output = output or ""
+        # In slices, so the line break normalization doesn't copy all of it.
+        for start in range(0, len(output), TAIL_FEED_CHARS):
+            tail.feed(output[start:start + TAIL_FEED_CHARS])
+        return tail
+
+    def feed(self, chunk):
+        """Add a chunk of output."""
+        self.chars += len(chunk)
+        self.progress_marks += chunk.count("!")
+        if self.pending_cr and chunk.startswith("\n"):
+            # "\r\n", split across chunks. The "\r" was the line break.
+            chunk = chunk[1:]
+        self.pending_cr = chunk.endswith("\r")
+        chunk = chunk.replace("\r\n", "\n").replace("\r", "\n")
+        head, newline, rest = chunk.rpartition("\n")
+        if newline:
+            self.line_count += head.count("\n") + 1
+            # Only the last max_lines complete lines are kept. Don't split
+            # anything before them.
+            start = len(head)
+            for _ in range(self.lines.maxlen):
+                start = head.rfind("\n", 0, start)
+                if start < 0:
+                    break
+            if start < 0:
+                head = self.partial + head
+            else:
+                head = head[start + 1:]
+            self.lines.extend(line[-self.max_line_chars:]
+                              for line in head.split("\n"))
+            self.partial = ""
+        self.partial = (self.partial + rest)[-self.max_line_chars:]
+
+    def tail(self):
+        """list: The kept lines, last one included (if not terminated)."""
+        lines = list(self.lines)
+        if self.partial:
+            lines.append(self.partial)
+        return lines[-self.lines.maxlen:]
+
+    def __str__(self):
+        return "\n".join(self.tail())
+
+    def summary(self):
+        """str: Counters and tail, for debug logging."""
+        return (f"{self.chars} chars, {self.line_count} lines,"
+                f" {self.progress_marks} '!', tail={self.tail()!r}")
+
+
+# 'install add' expands an IOS-XE image into its packages, next to the image.
+# They take about as much space as the image itself. Room for a bit more.
+INSTALL_EXPAND_RATIO = 1.2
+
+
+# Lines of 'show install all impact' output kept for its compatibility
+# table. One line per module, plus the image version table after it.
+INSTALL_IMPACT_LINES = 200
+
+
+# Transfer error codes (Exception.args[1]) that are worth a retry:
+# - 0x00: General error
+# - 0x3f: Broken pipe
+# - 0xbf: Incomplete transfer
+# - 0xdf: Integrity check failed
+RETRY_TRANSFER_CODES = (0x00, 0x3f, 0xbf, 0xdf)
+
+
+def get_ccs_transfer_status(ccs_error):
+    """Map a NetMRI CCS error, raised by send_async_command() during a
+    copy, to a transfer status line for get_transfer_error().
+
+    Args:
+        - ccs_error (Exception): The error. args[0] is the CCS error dict.
+
+    Returns:
+        str: The transfer status.
+    """
+    ccs_err_info = ccs_error.args[0]
+    # IOS/IOS-XE/ASA/NX-OS 0x7f Host unresponsive, or file not found.
+    if ("Error opening" in ccs_err_info['message'] #IOS/IOS-XE/ASA
+            or "404 Not Found" in ccs_err_info['message']): #NX-OS
+        return "%(ERR_OPEN)"
+    # ASA partial transfer (broken pipe)
+    if "Signature not valid" in ccs_err_info['message']:
+        return "%(Error reading)"
+    # Connection closed by remote side (e.g: clear line vty)
+    if "Connection closed by foreign host" in ccs_err_info['message']:
+        return "%(CONNECTION_CLOSED)"
+    # send_async_command returns sometimes returns blank output in cases
+    # where xfer completes in under 30 seconds.
+    # Not sure how to handle this yet.
+    return "%(API_ERR)"
+
+
+def get_transfer_error(os_type, xfr_status):
+    """Check the status line of a copy from the repo.
+
+    Args:
+        - os_type (str): "ASA", "NX-OS", "IOS-XE" or "IOS".
+        - xfr_status (str): From CiscoDevice.get_transfer_status(), or
+                            get_ccs_transfer_status().
+
+    Returns:
+        Exception: The transfer error, or None if there was no error (that
+                   we could see). Exception.args[1] is the error code:
+            - 0x00 : General error
+            - 0x3f : Read error (e.g: broken pipe)
+            - 0x40 : Connection closed by remote host
+            - 0x70 : Host unresolvable
+            - 0x7f : Host unresponsive, or remote file not found.
+            - 0xff : API error
+
+    Raises:
+        ValueError if the NX-OS cURL return code can't be determined.
+    """
+    ex = None
+    # IOS/IOS-XE/ASA shows "%" in line with error.
+    if os_type != "NX-OS":
+        if "%" not in xfr_status:
+            return None
+        match = re.search(r'%(?:.*\((.*)\))', xfr_status)
+        last_status = match.group(1) if match else "Unknown"
+        if "ERR_OPEN" in last_status:
+            ex = Exception("Host unresponsive or file not found")
+            ex.args += (0x7f,)
+        elif "CONNECTION_CLOSED" in last_status:
+            ex = Exception("Connection closed by remote host")
+            ex.args += (0x40,)
+        elif "API_ERR" in last_status:
+            ex = Exception("API error")
+            ex.args += (0xff,)
+        elif "Broken pipe" in last_status:
+            ex = Exception("Broken pipe")
+            ex.args += (0x3f,)
+        else:
+            # There are instances where we get jacked up return, and we can't
+            # see last_status.... If "Error reading", then more than likely it
+            # is broken pipe. So send broken pipe code and retry.
+            if "Error reading" in xfr_status:
+                ex = Exception("Transfer read error")
+                ex.args += (0x3f,)
+            # Or some other shenanigans we can't handle, yet.
+            else:
+                ex = Exception(f"General error [{last_status}]")
+                ex.args += (0x00,)
+        return ex
+
+    # NX-OS uses cURL, so we get to use cURL error codes (man 3 libcurl-errors)
+    match = re.search(r'(?:curl:\s+)\((\d+)\)', xfr_status)
+    if "Copy complete" in xfr_status:
+        last_status = 0 #CURLE_OK
+    elif "curl:" in xfr_status and match:
+        last_status = int(match.group(1))
+    # This shouldn't happen?
+    else:
+        raise ValueError(f"Undetermined cURL return code: {xfr_status}")
+
+    # Was code anything except CURLE_OK?
+    if last_status > 0:
+        #CURLE_COULDNT_RESOLVE_HOST
+        if last_status == 6:
+            ex = Exception("Host unresolvable")
+            ex.args += (0x70,)
+        #CURLE_COULDNT_CONNECT
+        elif last_status == 7:
+            ex = Exception("Host unresponsive")
+            ex.args += (0x7f,)
+        #CURLE_PARTIAL_FILE
+        elif last_status == 18:
+            ex = Exception("Broken pipe")
+            ex.args += (0x3f,)
+        # CURLE_HTTP_RETURNED_ERROR
+        elif last_status == 22:
+            ex = Exception("File not found")
+            ex.args += (0x7f,)
+        else:
+        # Something else. Send code back.
+        # If it needs to be handled, then handle it.
+            ex = Exception(f"cURL error: {last_status}")
+            ex.args += (0x00,)
+    return ex
+
+
+# DeviceRecord fields. See DeviceRecord.
+DEVICE_RECORD_FIELDS = (
+    "device_id",        # (int) NetMRI DeviceID
+    "name",             # (str) DeviceName
+    "model",            # (str) DeviceModel
+    "version",          # (str) DeviceVersion
+    "os",               # (str) OS type
+    "platform",         # (str) Platform (e.g: c3560cx)
+    "version_key",      # (tuple) Parsed version, from get_version_info()
+    "image",            # (str) Current system image
+    "image_fs",         # (str) Fs of the current system image
+    "system_fs",        # (str) Default fs
+    "fs",               # (tuple) (fs name, bytes free) per fs
+    "asa_is_lfbff",     # (bool)
+    "asa_is_smp",       # (bool)
+    "iosxe_boot_mode",  # (str) "INSTALL" or "BUNDLE"
+    "iosxe_build",      # (str)
+    "iosxe_sdwan",      # (str) SD-WAN mode
+    "kickstart_image",  # (str) Current NX-OS kickstart
+    "present"           # (tuple) Target images present, and verified
+)
+# Packed DeviceRecord format. See pack_device_records().
+DEVICE_RECORDS_MAGIC = b"CDR1"
+# String fields, packed as indices into the string table.
+_RECORD_STR_FIELDS = ("name", "model", "version", "os", "platform", "image",
+                      "image_fs", "system_fs", "iosxe_boot_mode",
+                      "iosxe_build", "iosxe_sdwan", "kickstart_image")
+
+
+class DeviceRecord(collections.namedtuple("DeviceRecord",
+                                          DEVICE_RECORD_FIELDS)):
+    """Compact, immutable snapshot of the facts of one device.
+
+    Unlike a CiscoDevice, it has no __dict__ and no NetMRI session, so fleet
+    tools can hold tens of thousands of them. Fs sizes are integers, and
+    version_key tuples are shared between devices on the same version.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_facts(cls, facts, version_cache=None):
+        """Build a record from a CiscoDevice.get_device_facts() dictionary
+        (e.g: the job's facts cache, with its 'present' key).
+
+        Args:
+            - facts (dict): The facts dictionary.
+            - version_cache (dict): Shared memo of parsed versions.
+                                    (Default: None)
+        """
+        os_type = facts.get('os')
+        version = facts.get('DeviceVersion')
+        if version_cache is None:
+            version_cache = {}
+        key = (os_type, version)
+        version_key = version_cache.get(key)
+        if version_key is None:
+            version_key = version_cache[key] = tuple(
+                get_version_info(os_type, version or "").values()
+            )
+        return cls(
+            device_id=int(facts['DeviceID']),
+            name=facts.get('DeviceName'),
+            model=facts.get('DeviceModel'),
+            version=version,
+            os=os_type,
+            platform=facts.get('platform'),
+            version_key=version_key,
+            image=facts.get('current_system_image'),
+            image_fs=facts.get('current_system_image_fs'),
+            system_fs=facts.get('system_fs'),
+            fs=tuple((item['fs'], int(item['free']))
+                     for item in facts.get('system_fs_info') or []),
+            asa_is_lfbff=bool(facts.get('asa_is_lfbff')),
+            asa_is_smp=bool(facts.get('asa_is_smp')),
+            iosxe_boot_mode=facts.get('iosxe_boot_mode'),
+            iosxe_build=facts.get('iosxe_build'),
+            iosxe_sdwan=(facts.get('iosxe_sdwan') or {}).get('mode'),
+            kickstart_image=facts.get('nxos_kickstart_image'),
+            present=tuple(facts.get('present') or ())
+        )
+
+    @classmethod
+    def from_device(cls, device, present=()):
+        """Build a record from a CiscoDevice.
+
+        Args:
+            - device (cls): CiscoDevice class reference.
+            - present (list): Target images present, and verified.
+        """
+        facts = device.get_device_facts()
+        facts['present'] = list(present)
+        return cls.from_facts(facts)
+
+    def to_facts(self):
+        """Inverse of from_facts()."""
+        # NX-OS fs indices start at 0. Everything else starts at 1.
+        start = 0 if self.os == "NX-OS" else 1
+        return {
+            "DeviceID": self.device_id,
+            "DeviceName": self.name,
+            "DeviceModel": self.model,
+            "DeviceVersion": self.version,
+            "os": self.os,
+            "platform": self.platform,
+            "current_system_image": self.image,
+            "current_system_image_fs": self.image_fs,
+            "system_fs": self.system_fs,
+            "system_fs_info": [
+                {"index": index, "fs": fs, "free": free}
+                for index, (fs, free) in enumerate(self.fs, start)
+            ],
+            "asa_is_lfbff": self.asa_is_lfbff,
+            "asa_is_smp": self.asa_is_smp,
+            "iosxe_boot_mode": self.iosxe_boot_mode,
+            "iosxe_build": self.iosxe_build,
+            "iosxe_sdwan": {"mode": self.iosxe_sdwan},
+            "nxos_kickstart_image": self.kickstart_image,
+            "present": list(self.present)
+        }
+
+
+def _pack_column(col):
+    # Columns are always stored little endian.
+    if sys.byteorder == "big":
+        col.byteswap()
+    data = col.tobytes()
+    return struct.pack("<I", len(data)) + data
+
+
+def pack_device_records(records):
+    """Pack DeviceRecords into a compact, columnar binary form.
+
+    Every string (platform, fs name, image, ...) is stored once, in a
+    string table, and referenced by index. Each field is a packed column.
+    The whole thing is zlib compressed.
+
+    Args:
+        - records (list): DeviceRecords.
+
+    Returns:
+        bytes: The packed records.
+    """
+    strings = {None: 0}
+
+    def ref(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    columns = [array.array("q", (rec.device_id for rec in records))]
+    for field in _RECORD_STR_FIELDS:
+        columns.append(array.array(
+            "I", (ref(getattr(rec, field)) for rec in records)
+        ))
+    columns.append(array.array(
+        "B", (rec.asa_is_lfbff | rec.asa_is_smp << 1 for rec in records)
+    ))
+    # Variable length fields: offsets, then the flattened values.
+    fs_offsets = array.array("I", [0])
+    fs_names = array.array("I")
+    fs_free = array.array("q")
+    present_offsets = array.array("I", [0])
+    present_names = array.array("I")
+    for rec in records:
+        for fs, free in rec.fs:
+            fs_names.append(ref(fs))
+            fs_free.append(free)
+        fs_offsets.append(len(fs_names))
+        present_names.extend(ref(name) for name in rec.present)
+        present_offsets.append(len(present_names))
+    columns += [fs_offsets, fs_names, fs_free, present_offsets,
+                present_names]
+
+    table = "\0".join(value for value in strings if value is not None)
+    table = table.encode("utf-8")
+    parts = [struct.pack("<4sII", DEVICE_RECORDS_MAGIC, len(records),
+                         len(strings) - 1),
+             struct.pack("<I", len(table)), table]
+    parts += [_pack_column(col) for col in columns]
+    return zlib.compress(b"".join(parts))
+
+
+def unpack_device_records(data):
+    """Inverse of pack_device_records().
+
+    Raises:
+        ValueError if the data is not packed DeviceRecords.
+    """
+    data = zlib.decompress(data)
+    magic, count, num_strings = struct.unpack_from("<4sII", data)
+    if magic != DEVICE_RECORDS_MAGIC:
+        raise ValueError("Not packed device records")
+    pos = struct.calcsize("<4sII")
+
+    def chunk():
+        nonlocal pos
+        (size,) = struct.unpack_from("<I", data, pos)
+        pos += 4 + size
+        return data[pos - size:pos]
+
+    def column(typecode):
+        col = array.array(typecode)
+        col.frombytes(chunk())
+        if sys.byteorder == "big":
+            col.byteswap()
+        return col
+
+    table = chunk().decode("utf-8")
+    strings = [None]
+    if num_strings:
+        strings += [sys.intern(value) for value in table.split("\0")]
+
+    device_ids = column("q")
+    str_columns = [column("I") for _ in _RECORD_STR_FIELDS]
+    flags = column("B")
+    fs_offsets, fs_names, fs_free = column("I"), column("I"), column("q")
+    present_offsets, present_names = column("I"), column("I")
+
+    version_cache = {}
+    records = []
+    for i in range(count):
+        values = dict(zip(_RECORD_STR_FIELDS,
+                          (strings[col[i]] for col in str_columns)))
+        key = (values['os'], values['version'])
+        version_key = version_cache.get(key)
+        if version_key is None:
+            version_key = version_cache[key] = tuple(
+                get_version_info(key[0], key[1] or "").values()
+            )
+        fs_range = range(fs_offsets[i], fs_offsets[i + 1])
+        present_range = range(present_offsets[i], present_offsets[i + 1])
+        records.append(DeviceRecord(
+            device_id=device_ids[i],
+            version_key=version_key,
+            fs=tuple((strings[fs_names[j]], fs_free[j]) for j in fs_range),
+            asa_is_lfbff=bool(flags[i] & 1),
+            asa_is_smp=bool(flags[i] & 2),
+            present=tuple(strings[present_names[j]] for j in present_range),
+            **values
+        ))
+    return records
+
+
+# A CLI command, as yielded by the steps of a probe. The steps are sent back
+# the command output. timeout None uses send_command(), anything else
+# send_async_command(command, timeout, regex). See CiscoDevice._run().
+CliCommand = collections.namedtuple("CliCommand",
+                                    ("command", "timeout", "regex"),
+                                    defaults=(None, ""))
+
+
+class _Fact:
+    """A device fact that is discovered on first read, by running the steps
+    of the 'probe' method of the device. The probe sets the instance
+    attribute, which hides this descriptor from then on (memoized)."""
+
+    def __init__(self, probe):
+        self.probe = probe
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        obj._run(getattr(obj, f"_{self.probe}")())
+        if self.name not in obj.__dict__:
+            raise AttributeError(f"{self.probe}() did not set {self.name}")
+        return obj.__dict__[self.name]
+
+
+def _requires(*facts):
+    """Decorator for the steps of probe methods. Declares the facts the probe
+    depends on.
+
+    Any that aren't known yet are discovered first, by the steps of their
+    own probe, in dependency order, and only once.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            for fact in facts:
+                if fact not in self.__dict__:
+                    probe = getattr(type(self), fact).probe
+                    yield from getattr(self, f"_{probe}")()
+            return (yield from func(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
 
 class CiscoDevice:
+    # Lazily discovered facts. See _Fact, and the probe methods.
+    asa_multi_context = _Fact("get_context_info")
+    asa_admin_context = _Fact("get_context_info")
+    asa_admin_context_name = _Fact("get_context_info")
+    nxos_default_vdc_name = _Fact("get_context_info")
+    nxos_default_vdc = _Fact("get_context_info")
+    vdc_id = _Fact("get_context_info")
+    platform = _Fact("get_system_image_info")
+    current_system_image = _Fact("get_system_image_info")
+    current_system_image_fs = _Fact("get_system_image_info")
+    nxos_kickstart_image = _Fact("get_system_image_info")
+    iosxe_boot_mode = _Fact("get_system_image_info")
+    iosxe_build = _Fact("get_system_image_info")
+    iosxe_sdwan = _Fact("get_system_image_info")
+    system_fs = _Fact("get_system_fs_info")
+    system_fs_info = _Fact("get_system_fs_info")
+
     def __init__(self, easy_class):
         self.dis = easy_class                   # NetMRI Easy instance
         self.device = easy_class.get_device()   # DeviceRemote broker
@@ -47,66 +1427,87 @@ class CiscoDevice:
         self.version = self.device.DeviceVersion# Target running version
         self.verinfo = {}                       # Running version (detailed)
         self.os = None                          # Target OS type. Used to determined CLI syntax
-        self.platform = None                    # System platform (e.g: c3560cx)
         self.in_config_mode = False             # State for config terminal
         self.active_intfs = []                  # Interfaces that have an IP and are up/up.
+        self.active_intf_addrs = {}             # IP address of each active interface.
         self.relay_intfs = {}                   # Interfaces /w relays, and the conf. relays.
-        self.current_system_image = None        # Current running image
-        self.current_system_image_fs = None     # FS where the current running image resides
-        self.system_fs = None                   # The default file system on this device
-        self.system_fs_info = {}                # Dict of system fs and their free space
-        self.asa_multi_context = False          # Boolean flag for ASA multi-context
-        self.asa_admin_context = False          # Boolean flag for admin context
-        self.asa_admin_context_name = None      # Name of the ASA admin context
         self.asa_is_lfbff = False               # ASA is using Legacy Free Boot File Format.
         self.asa_is_smp = False                 # ASA is Multi-core
-        self.iosxe_boot_mode = None             # IOS-XE boot mode (INSTALL/BUNDLE)
-        self.iosxe_build = None                 # IOS-XE build, read from packages.conf
-        self.iosxe_sdwan = {"mode": None}       # IOS-XE SD-WAN managed device
-        self.nxos_kickstart_image = None        # Current NX-OS kickstart
         self.nxos_aci_mode = False              # Boolean flag for NX-OS in ACI mode
         self.nxos_vdc = False                   # Boolean flag for N7k/N77 VDC
-        self.nxos_default_vdc_name = None       # Default VDC name
-        self.nxos_default_vdc = False           # Boolean flag for NX-OS default VDC
-        
+        # Everything else is discovered on first read. See the _Fact
+        # attributes of the class.
+
         # Determine OS type.
         # This needs to be performed on init. All other methods rely on it.
-        if "Adaptive Security" in self.device.DeviceSysDescr:
-            self.os = "ASA"
-            # asa933-7-lfbff-k8.SPA - 5506-X, 5508-X, 5516-X.
-            if any(lfbffmodel in self.model for lfbffmodel in
-                   ["5506", "5508", "5516"]):
-                self.asa_is_lfbff = True
-            # asa924-5-smp-K8.bin - 5512-X, 5515-X, 5525-X, 5545-X, 5555-X
-            #                     - 5585-X, ASAv
-            # TODO: ASAv?
-            if any(smpmodel in self.model for smpmodel in
-                   ["5512", "5515", "5525", "5545", "5555", "5585"]):
-                self.asa_is_smp = True
-
-            # NOTE: ASA prior to 9.10 uses format like this:
-            #       asa{maj}{min}{maint}-{patch}-...
-            #       After 9.10, the format changes to:
-            #       asa{maj}-{min}-{maint}-{patch}-....
-            self.verinfo = {
-                'maj': None,    # (int) Major release
-                'min': None,    # (int) Minor release
-                'maint': None,  # (int) Maintenance release
-                'rebld': None   # (int) Patch
-            }
-            match = re.search(r'(\d)-?(\d+)-?(\d)-(\d+)?', self.version)
+        # None of this needs the CLI.
+        cls = classify_device(self.device.DeviceSysDescr, self.model)
+        if cls.os is None:
+            raise ValueError("Unable to determine OS")
+        self.os = cls.os
+        self.verinfo = get_version_info(self.os, self.version)
+        self.asa_is_lfbff = cls.asa_is_lfbff
+        self.asa_is_smp = cls.asa_is_smp
+        self.nxos_aci_mode = cls.nxos_aci_mode
+        self.nxos_vdc = cls.nxos_vdc
+
+
+    def _run(self, steps):
+        """Run the steps of a probe, sending each CliCommand it yields with
+        the NetMRI Easy instance.
+
+        Every method that needs the CLI is written as steps (a generator),
+        so the same parsing can be driven without blocking (see
+        AsyncCiscoDevice.py).
+
+        Returns:
+            The return value of the steps.
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    if request.timeout is None:
+                        output = self.dis.send_command(request.command)
+                    else:
+                        output = self.dis.send_async_command(
+                            request.command, request.timeout, request.regex
+                        )
+                except Exception as err:
+                    request = steps.throw(err)
+                else:
+                    request = steps.send(output)
+        except StopIteration as stop:
+            return stop.value
 
-            if match:
-                self.verinfo['maj'] = int(match.group(1))
-                self.verinfo['min'] = int(match.group(2))
-                self.verinfo['maint'] = int(match.group(3))
-                self.verinfo['rebld'] = (
-                    int(match.group(4)) if match.group(4) else None
-                )
 
+    def get_context_info(self):
+        """Get the ASA context, or NX-OS VDC, this session is in.
+
+        Sets: Class attributes
+            - asa_multi_context (bool): ASA is in multiple context mode.
+            - asa_admin_context (bool): This is the ASA admin context.
+            - asa_admin_context_name (str): Name of the ASA admin context.
+            - vdc_id (int): NX-OS VDC ID (N7k/N77 only).
+            - nxos_default_vdc_name (str): NX-OS default VDC name.
+            - nxos_default_vdc (bool): This is the NX-OS default VDC.
+        """
+        return self._run(self._get_context_info())
+
+
+    def _get_context_info(self):
+        """Steps of get_context_info(). See _run()."""
+        self.asa_multi_context = False
+        self.asa_admin_context = False
+        self.asa_admin_context_name = None
+        self.vdc_id = None
+        self.nxos_default_vdc_name = None
+        self.nxos_default_vdc = False
+
+        if self.os == "ASA":
             # Check if this is a context.
             # If it is, then set the flag.
-            raw_output = self.dis.send_command(
+            raw_output = yield CliCommand(
                 "show version | include Cisco Adaptive"
             )
             if "<context>" in raw_output:
@@ -114,7 +1515,7 @@ class CiscoDevice:
                 # Then we need to check if we are in the admin context.
                 # Admin contexts have astrisk (*) at the beginning
                 # of the context name.
-                raw_output = self.dis.send_command(
+                raw_output = yield CliCommand(
                     "show context | include ^\*"
                 )
                 # We matched the asterisk, so we are in an admin context.
@@ -136,96 +1537,17 @@ class CiscoDevice:
             #         self.asa_admin_context = True
             #         self.asa_admin_context_name = self.device.DeviceContextName            
 
-        elif "NX-OS" in self.device.DeviceSysDescr:
-            self.os = "NX-OS"
-            if "aci" in self.device.DeviceSysDescr:
-                self.nxos_aci_mode = True
-            # If this is a N7k, get the VDC info.
-            if (self.device.DeviceModel.startswith("N7K") or
-                    self.device.DeviceModel.startswith("N77")):
-                self.nxos_vdc = True
-                raw_output = self.dis.send_command("show vdc current-vdc")
-                match = re.search(
-                    r'Current\s+vdc\s+is\s+(\d+)\s+-\s+(\S+)', raw_output
-                )
-                if match:
-                    self.vdc_id = int(match.group(1))
-                    self.nxos_default_vdc_name = match.group(2)
-                    if self.vdc_id == 1:
-                        self.nxos_default_vdc = True
-
-            # Set version info
-            self.verinfo = {
-                'maj': None,    # (int) Major release
-                'min': None,    # (int) Minor release
-                'maint': None,  # (int) Maintenance release
-                'rebld': None   # (str) Rebuild
-            }
-            match = re.search(r'(\d+)\.(\d+)\((\d+)(\w+)?\)(.*)',
-                                   self.version)
-            if match:
-                self.verinfo['maj'] = int(match.group(1))
-                self.verinfo['min'] = int(match.group(2))
-                self.verinfo['maint'] = int(match.group(3))
-                self.verinfo['rebld'] = match.group(4)
-
-        # IOS-XE has many different variations in the sysDescr.0 ...
-        elif ("IOSXE" in self.device.DeviceSysDescr
-              or "IOS-XE" in self.device.DeviceSysDescr
-              or "IOS XE" in self.device.DeviceSysDescr
-              or "LINUX_IOSD" in self.device.DeviceSysDescr
-              or "CAT3K_" in self.device.DeviceSysDescr):
-            self.os = "IOS-XE"
-
-            # Set version info
-            self.verinfo = {
-                'maj': None,    # (int) Major release
-                'rel': None,    # (int) Release version
-                'rebld': None,  # (int) Rebuild
-                'spcrel': None, # (str) Special release
-                'train': None,  # (str) Train (IOS-XE 3X)
-                'iosd': None    # (str) IOSd (IOS-XE 3X)
-            }
-            match = re.search(
-                r'(\d+)\.(\d+)\.(\d+)\.?([a-zA-Z0-9]+)\.?(\S+)?', self.version
-            )
-            if match:
-                self.verinfo['maj'] = int(match.group(1))
-                self.verinfo['rel'] = int(match.group(2))
-                self.verinfo['rebld'] = int(match.group(3))
-                # IOS-XE "Peaks"
-                if self.verinfo['maj'] >= 16:
-                    self.verinfo['spcrel'] = match.group(4)
-                # IOS-XE 3X
-                elif self.verinfo['maj'] == 3:
-                    self.verinfo['train'] = match.group(4)
-                    self.verinfo['iosd'] = match.group(5)
-
-        elif "IOS" in self.device.DeviceSysDescr:
-            self.os = "IOS"
-
-            # Set version info
-            self.verinfo = {
-                'maj': None,    # (int) Major version / Main release
-                'min': None,    # (int) Release version / Major feature
-                'feat': None,   # (str) Feature release number
-                'type': None,   # (str) Type / Train
-                'maint': None   # (str) Maintenance rebuild
-            }
+        # If this is a N7k, get the VDC info.
+        elif self.nxos_vdc:
+            raw_output = yield CliCommand("show vdc current-vdc")
             match = re.search(
-                r'(\d+)\.(\d+)\(([a-zA-Z0-9]+)\)([A-Z]+)([a-z0-9]+)?',
-                self.version
+                r'Current\s+vdc\s+is\s+(\d+)\s+-\s+(\S+)', raw_output
             )
             if match:
-                self.verinfo['maj'] = int(match.group(1))
-                self.verinfo['min'] = int(match.group(2))
-                self.verinfo['feat'] = match.group(3)
-                self.verinfo['type'] = match.group(4)
-                self.verinfo['maint'] = match.group(5)
-
-        # If we got here, we got problems.
-        else:
-            raise ValueError("Unable to determine OS")
+                self.vdc_id = int(match.group(1))
+                self.nxos_default_vdc_name = match.group(2)
+                if self.vdc_id == 1:
+                    self.nxos_default_vdc = True
 
 
     def get_system_image_info(self):
@@ -248,31 +1570,22 @@ class CiscoDevice:
                     - 'managed' if Controller-Managed
                     - None if not running SD-WAN
         """
-        # If this is an ASA admin context, then we need to change context to
-        # the system context.
-        if self.os == "ASA" and self.asa_multi_context:
-                if self.asa_admin_context:
-                    self.dis.send_command("changeto system")
-                else:
-                    raise Exception(
-                        "Cannot be called to a non-admin ASA context."
-                    )
+        return self._run(self._get_system_image_info())
 
-        if self.os == "NX-OS" and self.nxos_aci_mode == True:
-            cmd = "show version | grep image"
-        else:
-            cmd = "show version | include image"
 
-        raw_output = self.dis.send_command(cmd)
-
-        # If ASA context, put us back in the admin context
-        if self.asa_admin_context:
-            self.dis.send_command(
-                f"changeto context {self.asa_admin_context_name}"
-            )
+    @_requires("asa_multi_context")
+    def _get_system_image_info(self):
+        """Steps of get_system_image_info(). See _run()."""
+        self.platform = None
+        self.current_system_image = None
+        self.current_system_image_fs = None
+        self.nxos_kickstart_image = None
+        self.iosxe_boot_mode = None
+        self.iosxe_build = None
+        self.iosxe_sdwan = {"mode": None}
 
         # Replace spaces to make regex easier
-        raw_output = raw_output.replace(" ","")
+        raw_output = (yield from self._show_version_image()).replace(" ","")
 
         if self.os == "NX-OS":
             if self.nxos_aci_mode:
@@ -321,7 +1634,7 @@ class CiscoDevice:
                 # Capture it to bldplat, so that we can match both the build
                 # and platform later.
                 self.iosxe_boot_mode = "INSTALL"
-                bldplat = self.dis.send_command(
+                bldplat = yield CliCommand(
                     f"more {self.current_system_image_fs}:/"
                     f"{self.current_system_image} | include Platform:|Build:"
                 )
@@ -338,7 +1651,7 @@ class CiscoDevice:
                         f"more {self.current_system_image_fs}:/"
                         f"{self.current_system_image} | include rp_base.*\.pkg"
                     )
-                    rp_base = self.dis.send_command(cmd)
+                    rp_base = yield CliCommand(cmd)
                     # Lookbehind, then match maj.rel.rbld group.
                     match = re.search(
                         r'(?<=)\.(\d+\.\d+\.\d+[a-zA-Z]?)\..*', rp_base
@@ -352,12 +1665,10 @@ class CiscoDevice:
                 self.iosxe_boot_mode = "BUNDLE"
 
         # Get the platform from the running image.
-        if self.os == "ASA":
-            self.platform = self.os.lower()
-        elif self.os == "NX-OS" and self.nxos_aci_mode == True:
-            self.platform = re.search(
-                r'(aci-[a-zA-Z0-9]+)(?:-|_|\.).*$', self.current_system_image
-            ).group(1)
+        if self.os in PLATFORM_BY_OS or self.nxos_aci_mode:
+            self.platform = platform_from_image(self.os,
+                                                self.current_system_image,
+                                                self.nxos_aci_mode)
         else:
             if self.iosxe_boot_mode == "INSTALL":
                 # We already grabbed this from before.
@@ -371,10 +1682,8 @@ class CiscoDevice:
                 if match:
                     # 2023.05.31 - aensminger: IOS-XE 3X for cat3k shows
                     # platform as "ng3k". Convert it to cat3k_caa.
-                    self.platform = (
-                        "cat3k_caa" if match.group(1).lower() == "ng3k"
-                        else match.group(1).lower()
-                    )
+                    # (See PLATFORM_ALIASES)
+                    self.platform = normalize_platform(match.group(1).lower())
                 # Some IOS-XE do not have the
                 # superpackage info in the conf file. Try another method.
                 # (This was observed on a Cat93k on 16.6.6)
@@ -387,19 +1696,9 @@ class CiscoDevice:
                         # It's already in lowercase.
                         self.platform = match.group(1)
             else: # boot_mode == "BUNDLE"
-                # CAT92k uses cat9k_lite. Other use cat9k_iosxe.
-                # Updated regex pattern to match both cases.
-                # NOTE: NX-OS higher than 7.0(3)I2(1) uses one image "nxos".
-                self.platform = re.search(
-                    r'([a-zA-Z0-9]+(_lite|_iosxe)?)(?:-|_|\.).*',
-                    self.current_system_image
-                ).group(1)
-                # C8300 and C8500 used to be individual platforms.
-                # Cisco has consolidated them to "c8000"
-                if (self.platform.startswith("c8300")
-                        or self.platform.startswith("c8500")):
-                    self.platform = self.platform.replace("c8300", "c8000")
-                    self.platform = self.platform.replace("c8500", "c8000")
+                # See IMAGE_PLATFORM_RULES and PLATFORM_ALIASES.
+                self.platform = platform_from_image(self.os,
+                                                    self.current_system_image)
 
         # Figure out if this is an SD-WAN device.
         if (self.os == "IOS-XE" and
@@ -413,7 +1712,7 @@ class CiscoDevice:
             "c8000", "c8200", "c8300", "c8500"
             ))):
             cmd = "show version | include operating"
-            raw_output = self.dis.send_command(cmd)
+            raw_output = yield CliCommand(cmd)
             #If it's SD-WAN, we'll get output from the command:
             #Router operating mode: Controller-Managed
             #Router operating mode: Autonomous
@@ -453,14 +1752,21 @@ class CiscoDevice:
                 ...
             }
         """
-        # Safety net
-        if not self.current_system_image_fs:
-            raise TypeError("current_system_image_fs is not initialized")
+        return self._run(self._get_system_fs_info())
+
+
+    @_requires("current_system_image_fs", "asa_multi_context")
+    def _get_system_fs_info(self):
+        """Steps of get_system_fs_info(). See _run()."""
+        # Start over, in case this is a refresh and a fs has gone away
+        # (e.g: stack member removed).
+        self.system_fs = None
+        self.system_fs_info = {}
 
         # NX-OS does not have 'show file system'. So we just dir bootflash.
         if self.os == "NX-OS":
             cmd = f"dir {self.current_system_image_fs}: | include free"
-            raw_output = self.dis.send_command(cmd)
+            raw_output = yield CliCommand(cmd)
 
             fs_bytes_free = re.search(r'(\d+)\s\bbytes free\b',
                                         raw_output).group(1)
@@ -474,13 +1780,13 @@ class CiscoDevice:
 
         # If ASA multi-context and we are admin context, then changeto system
         if self.asa_multi_context and self.asa_admin_context:
-            self.dis.send_command("changeto system")
+            yield CliCommand("changeto system")
 
-        raw_output = self.dis.send_command("show file system")
+        raw_output = yield CliCommand("show file system")
 
         # Change context back
         if self.asa_admin_context:
-            self.dis.send_command(
+            yield CliCommand(
                 f"changeto context {self.asa_admin_context_name}"
             )
 
@@ -533,6 +1839,11 @@ class CiscoDevice:
                 - filename (str): Filename. None if not found
                 - size (int): size in bytes.
         """
+        return self._run(self._get_file_size_info(fs, name, path))
+
+
+    def _get_file_size_info(self, fs, name, path='/'):
+        """Steps of get_file_size_info(). See _run()."""
         # What regex are we going to use?
         if self.os == "NX-OS":
             # 2023.05.31 - aensminger: Change regex to have negative lookahead
@@ -551,7 +1862,7 @@ class CiscoDevice:
             # Everything else does
             cmd = f"dir {fs}:{path} | include {name}"
         # Send it
-        raw_output = self.dis.send_command(cmd)
+        raw_output = yield CliCommand(cmd)
 
         # Did we get a return?
         if not raw_output:
@@ -573,8 +1884,439 @@ class CiscoDevice:
         return (None, -1)
 
 
+    def get_old_images(self, fs_list):
+        """Find the old images on the specified file systems. Everything but
+        the current running image (or IOS-XE build) is old.
+
+        NOTE: The running image filename from "show version" output gets
+        truncated on some Cisco devices. This uses .startswith() to avoid
+        that problem.
+
+        Args:
+            - fs_list (list): File system(s) to search. NX-OS only searches
+                              the default fs.
+
+        Returns:
+            list: (fs, filename, kind) tuples. kind is "old image",
+                  "old kickstart image" or "inactive package".
+        """
+        return self._run(self._get_old_images(fs_list))
+
+
+    def _get_old_images(self, fs_list):
+        """Steps of get_old_images(). See _run()."""
+        images = []
+
+        if self.iosxe_boot_mode == "INSTALL":
+            # Similiar to 'install remove inactive', except there's no
+            # 30-minute delay for command output, and we don't remove .conf
+            # files.
+            ftype_map = {
+                ".pkg": "inactive package",
+                ".bin": "old image"
+            }
+            for fs_name in fs_list:
+                raw_output = yield CliCommand(
+                    f"dir {fs_name}:/{self.platform}* | include \.bin|\.pkg"
+                )
+                for line in raw_output.splitlines():
+                    # Group 1 is the filename: cat9k-rpboot.16.12.03a.SPA.pkg
+                    # Group 2 is the build: 16.12.03a
+                    match = re.search(
+                        fr'.*(?<=\s)({self.platform}\S+\.(\d+\.\d+\.\d+'
+                        '[a-zA-Z]?)\..*)', line
+                    )
+                    # Don't include the current running package
+                    if match and match.group(2) != self.iosxe_build:
+                        file = match.group(1)
+                        images.append((
+                            fs_name, file,
+                            ftype_map.get(file[file.rfind("."):], "unknown")
+                        ))
+            return images
+
+        if self.os == "NX-OS":
+            # Search for kickstart images, if this NX-OS has kickstart.
+            if self.nxos_kickstart_image is not None:
+                raw_output = yield CliCommand(
+                    f"dir {self.system_fs}: |"
+                    f"include {self.platform}.*\.bin$ | include kickstart"
+                )
+                for line in raw_output.splitlines():
+                    match = re.search(r'(?:.*\/|.*(?<=\s)(\S+))', line)
+                    file = match.group(1) if match else None
+                    if file and not file.startswith(self.nxos_kickstart_image):
+                        images.append((self.system_fs, file,
+                                       "old kickstart image"))
+
+            # Search for old images that are not kickstart.
+            raw_output = yield CliCommand(
+                f"dir {self.system_fs}: | include {self.platform}.*\.bin$ |"
+                " exclude kickstart"
+            )
+            for line in raw_output.splitlines():
+                match = re.search(r'(?:.*\/|.*(?<=\s)(\S+))', line)
+                file = match.group(1) if match else None
+                if file and not file.startswith(self.current_system_image):
+                    images.append((self.system_fs, file, "old image"))
+            return images
+
+        # ASA does not allow you to pipe 'dir' output.
+        # IOS/IOS-XE allow dir to be piped.
+        cmdpfx = "show" if self.os == "ASA" else "dir"
+        for fs_name in fs_list:
+            #make sure we only match .SPA or .bin
+            raw_output = yield CliCommand(
+                f"{cmdpfx} {fs_name}: | include {self.platform}"
+                ".*(\.SPA$|\.bin$)"
+            )
+            for line in raw_output.splitlines():
+                match = re.search(fr'.*(?<=\s)({self.platform}\S+)', line)
+                file = match.group(1) if match else None
+                # Don't include the current running image
+                if file and not file.startswith(self.current_system_image):
+                    images.append((fs_name, file, "old image"))
+        return images
+
+
+    def get_delete_command(self, fs, name, recursive=False):
+        """Get the command that deletes a file, without any prompt.
+
+        Args:
+            - fs (str): The file system.
+            - name (str): The file name.
+            - recursive (bool): Delete directories too (e.g: old IOS-XE
+                                packages). NX-OS ignores it.
+        """
+        if self.os == "NX-OS":
+            return f"delete {fs}:/{name} no-prompt"
+        if self.os == "ASA":
+            flags = "/noconfirm /recursive" if recursive else "/noconfirm"
+        else:
+            flags = "/force /recursive" if recursive else "/force"
+        return f"delete {flags} {fs}:/{name}"
+
+
+    def get_copy_command(self, url, name, nxos_vrf="default"):
+        """Get the command that copies 'url' to 'name' on the default fs.
+
+        Args:
+            - url (str): Source URL (e.g: http://repo/path/file.bin)
+            - name (str): Destination file name.
+            - nxos_vrf (str): VRF NX-OS copies from. (Default: "default")
+        """
+        if self.os == "ASA":
+            # ASA does not handle broken pipe. It will save what was
+            # downloaded so far, not give any error, and appear to succeed.
+            # It'll get sorted out when get_file_size_info() method is
+            # called.
+            return f"copy /noconfirm {url} {self.system_fs}:/{name}"
+        if self.os == "NX-OS":
+            # Nexus uses cURL (curl -O -f {host}).
+            return f"copy {url} {self.system_fs}:/{name} vrf {nxos_vrf}"
+        # This is for IOS/IOS-XE:
+        # Append carriage return to account addl. prompts.
+        return f"copy {url} {self.system_fs}:/{name}\r\r\r"
+
+
+    def get_transfer_status(self, raw_output):
+        """Get the status line of a copy from its output.
+
+        Args:
+            - raw_output (str|TailBuffer): Output of the copy command.
+
+        Returns:
+            str: The status line. See get_transfer_error().
+        """
+        raw_output = TailBuffer.of(raw_output).tail() or [""]
+        # Get the last line of output (transfer status)
+        xfr_status = raw_output[-1]
+        # Sometimes we get the hostname prompt as the last line, or last x
+        # amount of lines.
+        # e.g: raw_output=['!!!!','1234 bytes copied...','hostname#']
+        # Search for the last line, that is not the device prompt. This
+        # contains the status.
+        prompt = self.hostname.split('.')[0]
+        if xfr_status.startswith(prompt) and xfr_status.endswith('#'):
+            for line in reversed(raw_output[:-1]):
+                if not line.startswith(prompt):
+                    xfr_status = line
+                    break
+        return xfr_status
+
+
+    def get_verify_command(self, f_info):
+        """Get the command that verifies the integrity of an image.
+
+        NOTE: If the platform/version can support SHA-512 verification, and
+        there is a SHA-512 hash in the hast list, then SHA-512 will be
+        prioritized over MD5. (Not yet. See the TODO below.)
+
+        Args:
+            - f_info (dict): Hash list row of the image.
+
+        Returns:
+            tuple: (command, expected_hash)
+
+        Raises:
+            Exception if the hash is not in the list.
+        """
+        # TODO: Seriously cannot tell which platforms/versions support
+        # sha512? IOS 15.2(7) has it, but 15.7(3) doesn't?
+        # - ASA: All ASA 9.x supports sha-512
+        # - NX-OS 6.0(2)A7(2) does not have sha512 verify.
+        #   NX-OS 6.0(2)A8(11b) has sha256 but not sha512.
+        #   NX-OS 7.0(3)I7(6) has it. NX-OS 9.3(11) has it.
+        # - IOS-XE 03.09.00.E does not have it. 03.11.02.E has it.
+        #   16.3.7 does not have it. 16.5.1b has it.
+        # - IOS 15.2(4)M8 does not have it. 15.2(7)E has it. Some monolithic
+        #   IOS support SHA-512, but some don't. Can't find which anywhere
+        #   in the Cisco release notes.
+        # Until then, MD5 only.
+        if f_info['MD5']:
+            h_algo = 'md5'
+            expected_hash = f_info['MD5'].lower()
+        else:
+            raise Exception("MD5 hash not in the list")
+
+        if self.os == "NX-OS":
+            # NOTE: NX-OS does not verify image. Just returns hash of the
+            # file.
+            cmd = f"show file {self.system_fs}:/{f_info['Filename']} {h_algo}"
+        else:
+            cmd = (f"verify /{h_algo} {self.system_fs}:/{f_info['Filename']}"
+                   f" {expected_hash}")
+        return (cmd, expected_hash)
+
+
+    def verify_passed(self, raw_output, expected_hash):
+        """Check the output of the get_verify_command() command.
+
+        Args:
+            - raw_output (str|TailBuffer): Output of the verify command.
+            - expected_hash (str): From get_verify_command().
+
+        Returns:
+            bool: True if the image passed verification.
+        """
+        raw_output = TailBuffer.of(raw_output).tail()
+        if self.os == "NX-OS":
+            # NX-OS returns one line with the sha512sum/md5sum result
+            return bool(raw_output) and raw_output[-1] == expected_hash
+        # IOS, IOS-XE, and ASA returns "Verified" or "%Error verifying"
+        return any("Verified" in line for line in raw_output)
+
+
+    def get_install_summary(self):
+        """Get the packages known to the IOS-XE install manager.
+
+        Returns:
+            list: One dict per package, with keys:
+                - 'type' (str): e.g: IMG, SMU
+                - 'state' (str): I - Inactive (added), U - Activated &
+                  Uncommitted, C - Activated & Committed, D - Deactivated &
+                  Uncommitted
+                - 'version' (str): e.g: 17.09.04a.0.6
+        """
+        return self._run(self._get_install_summary())
+
+
+    def _get_install_summary(self):
+        """Steps of get_install_summary(). See _run()."""
+        raw_output = yield CliCommand("show install summary")
+        # Stacks list the same packages once per switch.
+        packages = []
+        for match in re.finditer(r'^([A-Z]+)\s+([IUCD])\s+(\S+)\s*$',
+                                 raw_output, re.MULTILINE):
+            item = {"type": match.group(1), "state": match.group(2),
+                    "version": match.group(3)}
+            if item not in packages:
+                packages.append(item)
+        return packages
+
+
+    def get_install_staged(self, packages, f_info):
+        """Check if an image is already added (staged) by the install
+        manager, and only waits to be activated.
+
+        Args:
+            - packages (list): From get_install_summary().
+            - f_info (dict): Hash list row of the image.
+
+        Returns:
+            bool: True if an inactive IMG package has the image version.
+        """
+        target = get_version_key(self.os, get_image_version(
+            self.os, f_info['Filename']
+        ))
+        if target is None:
+            return False
+        for item in packages:
+            # 17.09.04a.0.6 -> 17.09.04a
+            match = re.match(r'(\d+\.\d+\.\d+[a-z]?)', item['version'])
+            if (item['type'] == "IMG" and item['state'] == "I" and match
+                    and get_version_key(self.os, match.group(1)) == target):
+                return True
+        return False
+
+
+    def get_install_add_command(self, f_info):
+        """Get the command that expands and stages an image, in INSTALL
+        mode, so only 'install activate' and 'install commit' are left.
+        """
+        return f"install add file {self.system_fs}:{f_info['Filename']}"
+
+
+    def install_add_passed(self, raw_output):
+        """Check the output of the get_install_add_command() command.
+
+        Args:
+            - raw_output (str|TailBuffer): Output of the install add command.
+
+        Returns:
+            bool: True if the packages were added.
+        """
+        lines = TailBuffer.of(raw_output).tail()
+        if any("FAILED" in line or line.startswith("%Error")
+               for line in lines):
+            return False
+        # e.g: "SUCCESS: install_add  Tue Oct 17 ..." (16.x+)
+        #      "[1]: Finished Add" (per switch)
+        return any(line.startswith("SUCCESS: install_add")
+                   or "Finished Add" in line for line in lines)
+
+
+    def get_boot_config(self):
+        """Get the configured boot images, in boot order. IOS, IOS-XE and
+        ASA only.
+
+        Returns:
+            list: The 'boot system' lines of the running config.
+        """
+        return self._run(self._get_boot_config())
+
+
+    @_requires("asa_multi_context")
+    def _get_boot_config(self):
+        """Steps of get_boot_config(). See _run()."""
+        if self.os == "ASA":
+            # Boot images are set in the system context.
+            if self.asa_multi_context and self.asa_admin_context:
+                yield CliCommand("changeto system")
+            raw_output = yield CliCommand("show running-config boot system")
+            if self.asa_multi_context and self.asa_admin_context:
+                yield CliCommand(
+                    f"changeto context {self.asa_admin_context_name}"
+                )
+        else:
+            raw_output = yield CliCommand(
+                "show running-config | include ^boot system"
+            )
+        return re.findall(r'^boot system .*\S', raw_output, re.MULTILINE)
+
+
+    def get_boot_commands(self, f_info, boot_lines):
+        """Get the config commands that boot an image first, and keep the
+        running image as the fallback.
+
+        Args:
+            - f_info (dict): Hash list row of the image.
+            - boot_lines (list): From get_boot_config().
+
+        Returns:
+            list: Config commands. Empty if the image already boots first.
+        """
+        # Stack members each have their own fs (e.g: flash-2). IOS sets them
+        # all at once. A standby sup (e.g: slavebootflash) syncs on its own.
+        stack = re.compile(rf'{re.escape(self.system_fs)}-?\d+')
+        switch = ("switch all " if self.os != "ASA" and any(
+            stack.fullmatch(item['fs'])
+            for item in self.system_fs_info.values()
+        ) else "")
+        target = f"boot system {switch}{self.system_fs}:/{f_info['Filename']}"
+        if boot_lines and boot_lines[0] == target:
+            return []
+        commands = ([f"no {line}" for line in boot_lines] if self.os == "ASA"
+                    else ["no boot system"])
+        commands.append(target)
+        fallback = (f"boot system {switch}{self.current_system_image_fs}:/"
+                    f"{self.current_system_image}")
+        if fallback != target:
+            commands.append(fallback)
+        return commands
+
+
+    def get_boot_restore_commands(self, commands, boot_lines):
+        """Get the config commands that undo get_boot_commands(), back to
+        'boot_lines'."""
+        if self.os == "ASA":
+            return ([f"no {cmd}" for cmd in commands
+                     if cmd.startswith("boot system")] + boot_lines)
+        return ["no boot system"] + boot_lines
+
+
+    def get_install_impact_command(self, f_info, ks_info=None):
+        """Get the NX-OS command that checks the compatibility and impact of
+        an upgrade, without installing anything.
+
+        Args:
+            - f_info (dict): Hash list row of the system image.
+            - ks_info (dict): Hash list row of the kickstart image, if the
+                              device uses one. (Default: None)
+        """
+        system = f"{self.system_fs}:{f_info['Filename']}"
+        if ks_info:
+            return (f"show install all impact kickstart"
+                    f" {self.system_fs}:{ks_info['Filename']} system {system}")
+        return f"show install all impact nxos {system}"
+
+
+    def get_install_impact(self, raw_output):
+        """Parse the output of the get_install_impact_command() command.
+
+        Args:
+            - raw_output (str|TailBuffer): Output of the impact check. The
+              compatibility table is near the end, but not in the last few
+              lines. Keep at least INSTALL_IMPACT_LINES.
+
+        Returns:
+            dict: With keys:
+                - 'passed' (bool): Every module is bootable, and no check
+                  failed.
+                - 'disruptive' (bool): The upgrade reloads a module.
+                - 'modules' (list): One dict per module, with 'module',
+                  'bootable', 'impact', 'install_type' and 'reason'.
+        """
+        lines = TailBuffer.of(raw_output, max_lines=INSTALL_IMPACT_LINES)
+        modules = []
+        failed = False
+        for line in lines.tail():
+            match = re.match(r'\s*(\d+)\s+(yes|no)\s+(\S+)\s+(\S+)\s*(.*)$',
+                             line)
+            if match:
+                modules.append({"module": int(match.group(1)),
+                                "bootable": match.group(2) == "yes",
+                                "impact": match.group(3),
+                                "install_type": match.group(4),
+                                "reason": match.group(5)})
+            elif re.search(r'-- FAIL|failed|^%|[Ee]rror', line):
+                failed = True
+        return {
+            "passed": (bool(modules) and not failed
+                       and all(item['bootable'] for item in modules)),
+            "disruptive": any(item['impact'] == "disruptive"
+                              for item in modules),
+            "modules": modules
+        }
+
+
     def get_active_interfaces(self):
         """Get all interfaces that are up/up and have an IP address."""
+        return self._run(self._get_active_interfaces())
+
+
+    def _get_active_interfaces(self):
+        """Steps of get_active_interfaces(). See _run()."""
         # TODO: Refactor this to use "Interface" broker instead.
         cmd = "show "
         if self.os == "ASA":
@@ -584,11 +2326,115 @@ class CiscoDevice:
         else:  # self.os_type == "IOS" or self.os_type == "IOS-XE"
             cmd = cmd + "ip int br | ex (Proto|unassig|down|Any|NVI)"
 
-        raw_output = self.dis.send_command(cmd)
+        raw_output = yield CliCommand(cmd)
 
         # Regex the CLI output to get the interface list.
         self.active_intfs = re.findall(r'^([^\s]+)', raw_output,
                                        re.MULTILINE)
+        # The address is the second column, on every OS.
+        self.active_intf_addrs = dict(re.findall(
+            r'^(\S+)\s+(\d+\.\d+\.\d+\.\d+)\b', raw_output, re.MULTILINE
+        ))
+
+
+    def get_http_source_interface(self):
+        """Get the interface the HTTP client should source its transfers
+        from: the active interface with the address NetMRI manages the
+        device on, or else the first active loopback. Interfaces in a VRF
+        (e.g: GigabitEthernet0/0 in Mgmt-vrf) are skipped: the copies use
+        the global routing table. Call get_active_interfaces() first.
+
+        Returns:
+            str: Interface name, or None if neither is active, or both are
+                 in a VRF.
+        """
+        return self._run(self._get_http_source_interface())
+
+
+    def _get_http_source_interface(self):
+        """Steps of get_http_source_interface(). See _run()."""
+        mgmt_addr = getattr(self.device, "DeviceIPDotted", None)
+        candidates = [
+            intf_id for intf_id in self.active_intfs
+            if mgmt_addr and self.active_intf_addrs.get(intf_id) == mgmt_addr
+        ] + [
+            intf_id for intf_id in self.active_intfs
+            if intf_id.lower().startswith("lo")
+        ]
+        if not candidates:
+            return None
+
+        # 'ip vrf forwarding' (VRF-lite), or 'vrf forwarding' (multi-AF).
+        raw_output = yield CliCommand(
+            "show running-config | include ^interface |^ vrf forwarding|"
+            "^ ip vrf forwarding"
+        )
+        vrf_intfs = set()
+        intf_id = None
+        for line in raw_output.splitlines():
+            if line.startswith("interface "):
+                intf_id = line.split()[1]
+            elif intf_id and "vrf forwarding" in line:
+                vrf_intfs.add(intf_id)
+
+        for intf_id in candidates:
+            if intf_id not in vrf_intfs:
+                return intf_id
+        return None
+
+
+    def get_http_client_config(self):
+        """Get the config that tunes the HTTP client transfers. IOS and
+        IOS-XE only.
+
+        Returns:
+            list: The 'ip tcp window-size', 'ip tcp path-mtu-discovery' and
+                  'ip http client source-interface' lines of the running
+                  config.
+        """
+        return self._run(self._get_http_client_config())
+
+
+    def _get_http_client_config(self):
+        """Steps of get_http_client_config(). See _run()."""
+        raw_output = yield CliCommand(
+            "show running-config | include ^ip tcp window-size|"
+            "^ip tcp path-mtu-discovery|^ip http client source-interface"
+        )
+        return re.findall(r'^ip (?:tcp|http client) .*\S', raw_output,
+                          re.MULTILINE)
+
+
+    def get_http_client_tuning(self, window_size, source_interface,
+                               config_lines):
+        """Get the config commands that tune the HTTP client transfers, and
+        the commands that undo each of them.
+
+        Args:
+            - window_size (int): TCP window size, in bytes.
+            - source_interface (str): From get_http_source_interface(), or
+                                      None to leave it.
+            - config_lines (list): From get_http_client_config().
+
+        Returns:
+            list: (command, undo) tuples. Settings already configured are
+                  left out.
+        """
+        wanted = [("ip tcp window-size", f"ip tcp window-size {window_size}"),
+                  ("ip tcp path-mtu-discovery", "ip tcp path-mtu-discovery")]
+        if source_interface:
+            wanted.append(("ip http client source-interface",
+                           "ip http client source-interface"
+                           f" {source_interface}"))
+        changes = []
+        for prefix, cmd in wanted:
+            current = [line for line in config_lines
+                       if line.startswith(prefix)]
+            # Path MTU discovery may have an age timer. It's on either way.
+            if cmd in current or (current and prefix == cmd):
+                continue
+            changes.append((cmd, current[0] if current else f"no {prefix}"))
+        return changes
 
 
     def get_relay_interfaces(self):
@@ -615,6 +2461,11 @@ class CiscoDevice:
                 ...
             }
         """
+        return self._run(self._get_relay_interfaces())
+
+
+    def _get_relay_interfaces(self):
+        """Steps of get_relay_interfaces(). See _run()."""
         if not self.active_intfs:
             raise TypeError("active_intfs is not intialized")
 
@@ -625,7 +2476,7 @@ class CiscoDevice:
 
             # Get the configuration for the interface
             cmd = f"show running-config interface {intf_id}"
-            raw_output = self.dis.send_command(cmd)
+            raw_output = yield CliCommand(cmd)
 
             if self.os == "ASA":
                 helper_re = r'dhcprelay\s+server\s+(\S+)'
@@ -655,8 +2506,13 @@ class CiscoDevice:
 
     def enter_global_config(self):
         """Enter global configuration mode on the Cisco device."""
-        self.dis.send_command("enable")
-        self.dis.send_command("configure terminal")
+        return self._run(self._enter_global_config())
+
+
+    def _enter_global_config(self):
+        """Steps of enter_global_config(). See _run()."""
+        yield CliCommand("enable")
+        yield CliCommand("configure terminal")
         self.in_config_mode = True
 
 
@@ -666,15 +2522,134 @@ class CiscoDevice:
         Args:
             commit_config (bool): Commit running config to nvram.
         """
-        self.dis.send_command("end")
+        return self._run(self._exit_global_config(commit_config))
+
+
+    def _exit_global_config(self, commit_config):
+        """Steps of exit_global_config(). See _run()."""
+        yield CliCommand("end")
         self.in_config_mode = False
         if commit_config is True:
             if self.os == "ASA":
-                self.dis.send_command("write memory")
+                yield CliCommand("write memory")
             else:
                 # Send 3x carriage returns.
                 # This is because some IOS give additional confirmation prompts
                 # (e.g: overwriting a nvram config from a different version)
-                self.dis.send_command(
+                yield CliCommand(
                     "copy running-config startup-config\r\r\r"
                 )
+
+
+    def _show_version_image(self):
+        """Steps that get the image lines of 'show version'. From the system
+        context, on a multi-context ASA."""
+        # If this is an ASA admin context, then we need to change context to
+        # the system context.
+        if self.os == "ASA" and self.asa_multi_context:
+                if self.asa_admin_context:
+                    yield CliCommand("changeto system")
+                else:
+                    raise Exception(
+                        "Cannot be called to a non-admin ASA context."
+                    )
+
+        if self.os == "NX-OS" and self.nxos_aci_mode == True:
+            cmd = "show version | grep image"
+        else:
+            cmd = "show version | include image"
+
+        raw_output = yield CliCommand(cmd)
+
+        # If ASA context, put us back in the admin context
+        if self.asa_admin_context:
+            yield CliCommand(
+                f"changeto context {self.asa_admin_context_name}"
+            )
+        return raw_output
+
+
+    def check_device_facts(self, facts):
+        """Check that facts from get_device_facts() still hold: the device
+        still runs the same image (and kickstart), from the same file system.
+        The boot mode follows from the image (e.g: packages.conf).
+
+        A device reloaded on another image with the same version string
+        looks the same to NetMRI. This is one command, instead of the whole
+        of get_system_image_info().
+
+        Args:
+            - facts (dict): Dictionary from get_device_facts().
+
+        Returns:
+            bool: True if they still hold.
+        """
+        return self._run(self._check_device_facts(facts))
+
+
+    @_requires("asa_multi_context")
+    def _check_device_facts(self, facts):
+        """Steps of check_device_facts(). See _run()."""
+        raw_output = (yield from self._show_version_image()).replace(" ","")
+        expected = [facts.get('current_system_image_fs'),
+                    facts.get('current_system_image'),
+                    facts.get('nxos_kickstart_image')]
+        return (bool(facts.get('current_system_image_fs'))
+                and all(item in raw_output for item in expected if item))
+
+
+    def get_device_facts(self):
+        """Get the discovered facts of this device, as a plain dictionary.
+
+        This is what offline fleet tools (e.g: fleet_plan.py) read back, so
+        they can reason about a device without opening a CLI session to it.
+
+        Returns:
+            dict: JSON serializable dictionary of the device facts.
+        """
+        return {
+            "DeviceID": self.device.DeviceID,
+            "DeviceName": self.hostname,
+            "DeviceModel": self.model,
+            "DeviceVersion": self.version,
+            "os": self.os,
+            "platform": self.platform,
+            "current_system_image": self.current_system_image,
+            "current_system_image_fs": self.current_system_image_fs,
+            "system_fs": self.system_fs,
+            # JSON keys must be strings. Keep the fs index with the entry.
+            "system_fs_info": [
+                {"index": fs_id, "fs": item['fs'], "free": int(item['free'])}
+                for fs_id, item in sorted(self.system_fs_info.items())
+            ],
+            "asa_is_lfbff": self.asa_is_lfbff,
+            "asa_is_smp": self.asa_is_smp,
+            "iosxe_boot_mode": self.iosxe_boot_mode,
+            "iosxe_build": self.iosxe_build,
+            "iosxe_sdwan": self.iosxe_sdwan,
+            "nxos_kickstart_image": self.nxos_kickstart_image
+        }
+
+
+    def load_device_facts(self, facts):
+        """Restore facts from get_device_facts(), instead of discovering them
+        again with get_system_image_info() and get_system_fs_info().
+
+        The caller is responsible for making sure the facts still hold (see
+        check_device_facts()).
+
+        Args:
+            - facts (dict): Dictionary from get_device_facts().
+        """
+        self.platform = facts['platform']
+        self.current_system_image = facts['current_system_image']
+        self.current_system_image_fs = facts['current_system_image_fs']
+        self.system_fs = facts['system_fs']
+        self.system_fs_info = {
+            item['index']: {"fs": item['fs'], "free": item['free']}
+            for item in facts['system_fs_info']
+        }
+        self.iosxe_boot_mode = facts['iosxe_boot_mode']
+        self.iosxe_build = facts['iosxe_build']
+        self.iosxe_sdwan = facts['iosxe_sdwan']
+        self.nxos_kickstart_image = facts['nxos_kickstart_image']
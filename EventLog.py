@@ -0,0 +1,148 @@
+###########################################################################
+## Export of Script Module: EventLog
+## Language: Python
+## Category: Internal
+## Description: Structured, batched event logging for NetMRI jobs.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for structured job events
+# EventLog.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Every NetMRIEasy.log_message() call is a round trip to the NetMRI API.
+#   EventLog wraps a NetMRIEasy instance, and records each message as a typed
+#   event in memory instead. Events are flushed to log_message() in batched
+#   chunks, and every event is also written to a local JSON-lines file.
+#
+#   Anything that is not log_message() is passed through to the wrapped
+#   NetMRIEasy instance (send_command, broker, get_device, ...), so an
+#   EventLog can be used anywhere a NetMRIEasy is expected.
+#
+#   Event fields:
+#       - ts (float): Epoch time of the event.
+#       - job (int), device (int): NetMRI job and device ID.
+#       - severity (str): debug, info, notif, warn or error.
+#       - phase (str): Job phase, from set_phase().
+#       - message (str): The log message.
+#       - Optional, when known: bytes (int), duration (float, seconds),
+#         code (int, error code), plus any other keyword given.
+#------------------------------------------------------------------------------
+import json
+import os
+import time
+
+# NetMRI log severities, lowest to highest.
+SEVERITY_ORDER = ("debug", "info", "notif", "warn", "error")
+
+
+class EventLog:
+    def __init__(self, easy_class, path=None, job_id=None, device_id=None,
+                 chunk_size=50, max_delay=60):
+        self.dis = easy_class           # NetMRI Easy instance
+        self.path = path                # Local JSON-lines file (optional)
+        self.job_id = job_id            # Recorded with every event
+        self.device_id = device_id      # Recorded with every event
+        self.chunk_size = chunk_size    # Max messages per log_message() call
+        self.max_delay = max_delay      # Max seconds a message is held back
+        self.phase = None               # Current job phase
+        self.pending = []               # (severity, message) not yet sent
+        self.pending_since = None       # Time of the oldest pending message
+        self.api_calls = 0              # log_message() calls made
+        self.events = 0                 # Events recorded
+        self.stream = None              # Open JSON-lines file
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Line buffered. Every event hits the disk, even if the job
+                # is killed.
+                self.stream = open(path, "a", buffering=1)
+            except OSError as err:
+                self.pending.append(
+                    ("warn", f"Unable to open event stream {path}: {err}")
+                )
+
+    def __getattr__(self, name):
+        # Only called for attributes EventLog doesn't have.
+        return getattr(self.dis, name)
+
+    def set_phase(self, phase):
+        """Set the job phase recorded with the following events."""
+        self.phase = phase
+
+    def log_message(self, severity, message, **fields):
+        """Record an event. Drop-in for NetMRIEasy.log_message().
+
+        Args:
+            - severity (str): debug, info, notif, warn or error.
+            - message (str): The log message.
+            - fields: Typed event fields (e.g: bytes=..., duration=...,
+                      code=...). Written to the local stream only.
+        """
+        event = {
+            "ts": round(time.time(), 3),
+            "job": self.job_id,
+            "device": self.device_id,
+            "severity": severity,
+            "phase": self.phase,
+            "message": message
+        }
+        event.update(fields)
+        self.events += 1
+        if self.stream:
+            self.stream.write(json.dumps(event, default=str) + "\n")
+
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.append((severity, message))
+        # Errors are sent right away. The job is about to fail.
+        if (severity == "error"
+                or len(self.pending) >= self.chunk_size
+                or time.monotonic() - self.pending_since >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        """Send the pending messages to NetMRI, as one log_message() call.
+
+        The call uses the highest severity of the batch. When a batch has
+        mixed severities, each line keeps its own severity as a prefix, so
+        nothing is lost.
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        severity = max((sev for sev, _ in pending),
+                       key=lambda sev: (SEVERITY_ORDER.index(sev)
+                                        if sev in SEVERITY_ORDER else 1))
+        if len(pending) == 1:
+            message = pending[0][1]
+        elif all(sev == severity for sev, _ in pending):
+            message = "\n".join(msg for _, msg in pending)
+        else:
+            message = "\n".join(f"[{sev}] {msg}" for sev, msg in pending)
+        self.api_calls += 1
+        self.dis.log_message(severity, message)
+
+    def close(self):
+        """Flush everything, and close the local stream."""
+        self.flush()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
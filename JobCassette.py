@@ -0,0 +1,353 @@
+###########################################################################
+## Export of Script Module: JobCassette
+## Language: Python
+## Category: Internal
+## Description: Record and replay the CLI/API sessions of NetMRI jobs.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for job session cassettes
+# JobCassette.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   A cassette is the whole session of one job with one device: every CLI
+#   command sent, with its output (or error) and how long it took, every
+#   broker call and its result, and the device fields.
+#
+#   CassetteRecorder wraps a NetMRIEasy instance (the same way EventLog
+#   does), and records the session as it goes. CassetteEasy plays a
+#   cassette back, in place of NetMRIEasy, without NetMRI or the device:
+#   each command gets its recorded output, after its recorded time (scaled
+#   by 'time_scale', 0 doesn't wait at all).
+#
+#   Interactions are replayed in the recorded order ('strict'). With
+#   strict=False, each command gets the next unused recording of the same
+#   command, wherever it is, so commands can be reordered, batched or
+#   skipped. A command that isn't in the cassette raises CassetteMismatch.
+#
+#   Cassette format (JSON, gzipped if the file name ends with .gz):
+#       - version (int): CASSETTE_VERSION.
+#       - recorded (str): When it was recorded (UTC).
+#       - result (str): How the job ended, if the recorder was told.
+#       - settings (dict): Job settings (e.g: Script-Variables).
+#       - checkpoint (dict): Job state when it started, or None.
+#       - device (dict): DEVICE_FIELDS, parent_device and virtual_network.
+#       - interactions (list): Dicts with 'kind' ("cli" or "broker"),
+#         'start' and 'elapsed' (seconds), 'output' or 'error', and:
+#           - cli: 'command', 'timeout', 'regex'.
+#           - broker: 'broker', 'method', 'args', 'kwargs'.
+#------------------------------------------------------------------------------
+import gzip
+import json
+import os
+import time
+import types
+
+CASSETTE_VERSION = 1
+# DeviceRemote fields recorded in the cassette.
+DEVICE_FIELDS = ("DeviceID", "DeviceName", "DeviceModel", "DeviceVersion",
+                 "DeviceSysDescr", "DeviceIPDotted", "DeviceType",
+                 "DeviceVendor")
+# Fields of the DeviceRemote relations that are recorded.
+DEVICE_RELATIONS = {
+    "parent_device": ("DeviceName", "DeviceIPDotted"),
+    "virtual_network": ("VirtualNetworkName",)
+}
+
+
+class CassetteMismatch(Exception):
+    """The replayed job did something that isn't in the cassette."""
+
+
+def _to_json(value):
+    # Broker results are model objects. Keep their public data attributes.
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return {"__object__": {
+        name: _to_json(item) for name, item in vars(value).items()
+        if not name.startswith("_") and not callable(item)
+    }}
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    if isinstance(value, dict):
+        if set(value) == {"__object__"}:
+            return types.SimpleNamespace(**{
+                name: _from_json(item)
+                for name, item in value['__object__'].items()
+            })
+        return {key: _from_json(item) for key, item in value.items()}
+    return value
+
+
+def _open(path, mode, name=None):
+    # 'name' decides the compression, when 'path' is a temporary file.
+    if (name or path).endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+def load_cassette(path):
+    """Load a cassette file.
+
+    Raises:
+        ValueError if it's not a cassette of this CASSETTE_VERSION.
+    """
+    with _open(path, "r") as f:
+        cassette = json.load(f)
+    if cassette.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"{path}: not a version {CASSETTE_VERSION}"
+                         " cassette")
+    return cassette
+
+
+def _broker_key(broker, method, args, kwargs):
+    return ("broker", broker, method,
+            json.dumps([args, kwargs], sort_keys=True))
+
+
+def _key(item):
+    if item['kind'] == "cli":
+        return ("cli", item['command'])
+    return _broker_key(item['broker'], item['method'], item['args'],
+                       item['kwargs'])
+
+
+class CassetteRecorder:
+    """Wraps a NetMRIEasy instance, and records its session.
+
+    Anything that isn't recorded is passed through, like EventLog does.
+    """
+
+    def __init__(self, easy_class, settings=None, checkpoint=None):
+        self.dis = easy_class           # NetMRI Easy instance
+        self.settings = settings or {}  # Saved as-is in the cassette
+        self.checkpoint = checkpoint    # Job state when it started
+        self.result = None              # How the job ended, set by the job
+        self.interactions = []          # Recorded so far
+        self.device = None              # From get_device()
+        self.started = time.monotonic()
+
+    def __getattr__(self, name):
+        # Only called for attributes CassetteRecorder doesn't have.
+        return getattr(self.dis, name)
+
+    def _record(self, item, func, *args, **kwargs):
+        item['start'] = round(time.monotonic() - self.started, 3)
+        started = time.monotonic()
+        try:
+            value = func(*args, **kwargs)
+        except Exception as err:
+            item['error'] = {"type": type(err).__name__,
+                             "args": _to_json(err.args)}
+            raise
+        else:
+            item['output'] = _to_json(value)
+            return value
+        finally:
+            item['elapsed'] = round(time.monotonic() - started, 3)
+            self.interactions.append(item)
+
+    def get_device(self):
+        self.device = self.dis.get_device()
+        return self.device
+
+    def send_command(self, command):
+        return self._record({"kind": "cli", "command": command,
+                             "timeout": None, "regex": None},
+                            self.dis.send_command, command)
+
+    def send_async_command(self, command, timeout, regex):
+        return self._record({"kind": "cli", "command": command,
+                             "timeout": timeout, "regex": regex},
+                            self.dis.send_async_command, command, timeout,
+                            regex)
+
+    def broker(self, name):
+        return _RecordingBroker(self, name, self.dis.broker(name))
+
+    def device_snapshot(self):
+        """The DeviceRemote fields (and relations) of the device, or None if
+        get_device() wasn't called."""
+        if self.device is None:
+            return None
+        snapshot = {name: _to_json(getattr(self.device, name, None))
+                    for name in DEVICE_FIELDS}
+        for relation, fields in DEVICE_RELATIONS.items():
+            # Relations are API calls. A failed one is just not recorded.
+            try:
+                value = getattr(self.device, relation, None)
+            except Exception:
+                value = None
+            snapshot[relation] = (
+                None if value is None
+                else {name: _to_json(getattr(value, name, None))
+                      for name in fields}
+            )
+        return snapshot
+
+    def save(self, path):
+        """Write the cassette. The directory is created if needed."""
+        cassette = {
+            "version": CASSETTE_VERSION,
+            "recorded": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "result": self.result,
+            "settings": _to_json(self.settings),
+            "checkpoint": self.checkpoint,
+            "device": self.device_snapshot(),
+            "interactions": self.interactions
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with _open(path + ".tmp", "w", path) as f:
+            json.dump(cassette, f)
+        os.replace(path + ".tmp", path)
+
+
+class _RecordingBroker:
+    def __init__(self, recorder, name, broker):
+        self.recorder = recorder
+        self.name = name
+        self.broker = broker
+
+    def __getattr__(self, method):
+        func = getattr(self.broker, method)
+        if not callable(func):
+            return func
+
+        def call(*args, **kwargs):
+            return self.recorder._record(
+                {"kind": "broker", "broker": self.name, "method": method,
+                 "args": _to_json(args), "kwargs": _to_json(kwargs)},
+                func, *args, **kwargs
+            )
+        return call
+
+
+class CassetteEasy:
+    """Plays a cassette back. Drop-in for NetMRIEasy.
+
+    Attributes, once replayed:
+        - served (list): Indexes of the interactions that were replayed, in
+                         the order they were.
+        - latency (float): Recorded seconds of the served interactions.
+        - log (list): (severity, message) of every log_message() call.
+        - mismatches (list): Every CassetteMismatch raised, even the ones
+                             the job caught.
+    """
+
+    def __init__(self, cassette, time_scale=0.0, strict=True):
+        self.cassette = cassette
+        self.time_scale = time_scale
+        self.strict = strict
+        self.interactions = cassette['interactions']
+        self.served = []
+        self.latency = 0.0
+        self.log = []
+        self.mismatches = []
+        self.position = 0               # Next interaction, if strict
+        self.queues = {}                # Key -> unused indexes, if not
+        for index, item in enumerate(self.interactions):
+            self.queues.setdefault(_key(item), []).append(index)
+        self.device = self._device(cassette.get("device") or {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def _device(snapshot):
+        fields = {name: value for name, value in snapshot.items()
+                  if name not in DEVICE_RELATIONS}
+        for relation in DEVICE_RELATIONS:
+            value = snapshot.get(relation)
+            fields[relation] = (None if value is None
+                                else types.SimpleNamespace(**value))
+        return types.SimpleNamespace(**fields)
+
+    def _mismatch(self, message):
+        err = CassetteMismatch(message)
+        self.mismatches.append(err)
+        raise err
+
+    def _next(self, key):
+        if self.strict:
+            index = self.position
+            if (index >= len(self.interactions)
+                    or _key(self.interactions[index]) != key):
+                expected = (_key(self.interactions[index])[:3]
+                            if index < len(self.interactions)
+                            else "the end of the cassette")
+                self._mismatch(f"Interaction {index}: expected {expected},"
+                               f" got {key[:3]}")
+            self.position += 1
+            self.queues[key].remove(index)
+        else:
+            queue = self.queues.get(key)
+            if not queue:
+                self._mismatch(f"Not in the cassette: {key[:3]}")
+            index = queue.pop(0)
+        item = self.interactions[index]
+        self.served.append(index)
+        self.latency += item.get("elapsed", 0)
+        if self.time_scale:
+            time.sleep(item.get("elapsed", 0) * self.time_scale)
+        if "error" in item:
+            raise Exception(*_from_json(item['error']['args']))
+        return _from_json(item.get("output"))
+
+    def unused(self):
+        """Indexes of the interactions that were never replayed."""
+        return sorted(index for queue in self.queues.values()
+                      for index in queue)
+
+    def get_device(self):
+        return self.device
+
+    def send_command(self, command):
+        return self._next(("cli", command))
+
+    def send_async_command(self, command, timeout, regex):
+        return self._next(("cli", command))
+
+    def broker(self, name):
+        return _ReplayBroker(self, name)
+
+    def log_message(self, severity, message):
+        self.log.append((severity, message))
+
+
+class _ReplayBroker:
+    def __init__(self, easy, name):
+        self.easy = easy
+        self.name = name
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self.easy._next(_broker_key(
+                self.name, method, _to_json(args), _to_json(kwargs)
+            ))
+        return call
@@ -0,0 +1,192 @@
+###########################################################################
+## Export of Script Module: JobMetrics
+## Language: Python
+## Category: Internal
+## Description: Prometheus textfile metrics for NetMRI jobs.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for job metrics
+# JobMetrics.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Counters and histograms for a job, written in the Prometheus textfile
+#   format (e.g: for node_exporter --collector.textfile.directory).
+#
+#   Every NetMRI job runs in its own process, one per device. Each job
+#   collects its metrics in memory, and merges them into a shared state file
+#   when it ends (under a file lock). The .prom file is then re-rendered from
+#   the merged state, and atomically replaced. The scraper always sees fleet
+#   totals, and never a half written file.
+#
+#   Default labels (e.g: os, platform) can be set once the device is known.
+#   They are added to every series recorded after that.
+#------------------------------------------------------------------------------
+import fcntl
+import json
+import os
+import time
+
+METRICS_VERSION = 1
+# Histogram buckets, in seconds.
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+                    14400)
+
+
+def _escape(value):
+    """Escape a label value."""
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _series_key(name, labels):
+    """Prometheus series name, e.g: name{a="1",b="2"}"""
+    if not labels:
+        return name
+    pairs = ",".join(
+        f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())
+    )
+    return f"{name}{{{pairs}}}"
+
+
+class JobMetrics:
+    def __init__(self, metrics_dir, prefix, help_text=None):
+        self.metrics_dir = metrics_dir  # Textfile collector directory
+        self.prefix = prefix            # Metric name prefix
+        self.help_text = help_text or {}  # HELP line, keyed by metric name
+        self.labels = {}                # Default labels, for every series
+        self.counters = {}              # {name: {series: value}}
+        self.histograms = {}            # {name: {series: {...}}}
+        self.current_phase = None       # (phase, start time)
+
+    def inc(self, name, value=1, **labels):
+        """Add 'value' to a counter."""
+        series = self.counters.setdefault(self.prefix + name, {})
+        key = _series_key(self.prefix + name, {**self.labels, **labels})
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """Record 'value' in a histogram."""
+        series = self.histograms.setdefault(self.prefix + name, {})
+        key = _series_key(self.prefix + name, {**self.labels, **labels})
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = {
+                "buckets": list(buckets),
+                "counts": [0] * len(buckets),
+                "sum": 0.0,
+                "count": 0
+            }
+        for i, bound in enumerate(hist['buckets']):
+            if value <= bound:
+                hist['counts'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+    def phase(self, phase):
+        """Start a new job phase. The previous phase's duration is recorded
+        in the 'phase_duration_seconds' histogram. None ends the last one."""
+        now = time.monotonic()
+        if self.current_phase:
+            name, started = self.current_phase
+            self.observe("phase_duration_seconds", now - started, phase=name)
+        self.current_phase = (phase, now) if phase else None
+
+    def _merge(self, state):
+        for name, series in self.counters.items():
+            merged = state['counters'].setdefault(name, {})
+            for key, value in series.items():
+                merged[key] = merged.get(key, 0) + value
+        for name, series in self.histograms.items():
+            merged = state['histograms'].setdefault(name, {})
+            for key, hist in series.items():
+                old = merged.get(key)
+                if old is None or old['buckets'] != hist['buckets']:
+                    merged[key] = hist
+                    continue
+                old['counts'] = [a + b for a, b in zip(old['counts'],
+                                                       hist['counts'])]
+                old['sum'] += hist['sum']
+                old['count'] += hist['count']
+
+    def _render(self, state):
+        lines = []
+        for kind, metrics in (("counter", state['counters']),
+                              ("histogram", state['histograms'])):
+            for name in sorted(metrics):
+                if name in self.help_text:
+                    lines.append(f"# HELP {name} {self.help_text[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(metrics[name].items()):
+                    if kind == "counter":
+                        lines.append(f"{key} {value}")
+                        continue
+                    # name{labels} -> name_bucket{labels,le="..."}
+                    labels = key[len(name) + 1:-1] if key != name else ""
+                    sep = "," if labels else ""
+                    for bound, count in zip(value['buckets'],
+                                            value['counts']):
+                        lines.append(f'{name}_bucket{{{labels}{sep}'
+                                     f'le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}}'
+                                 f" {value['count']}")
+                    suffix = f"{{{labels}}}" if labels else ""
+                    lines.append(f"{name}_sum{suffix} {value['sum']:.3f}")
+                    lines.append(f"{name}_count{suffix} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def render(self):
+        """This job's metrics (not merged with the shared state), in the
+        Prometheus text format. (e.g: to serve them over HTTP)"""
+        return self._render({"counters": self.counters,
+                             "histograms": self.histograms})
+
+    def write(self, filename):
+        """Merge this job's metrics into the shared state, and re-render
+        {metrics_dir}/{filename}.
+
+        Raises:
+            OSError if the metrics directory can't be written.
+        """
+        self.phase(None)
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        state_path = os.path.join(self.metrics_dir, f".{filename}.json")
+        prom_path = os.path.join(self.metrics_dir, filename)
+        with open(os.path.join(self.metrics_dir, f".{filename}.lock"),
+                  "w") as lock:
+            # Other jobs are doing the same thing. One at a time.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(state_path, "r") as f:
+                    state = json.load(f)
+                if state.get("version") != METRICS_VERSION:
+                    raise ValueError
+            except (FileNotFoundError, ValueError):
+                state = {"version": METRICS_VERSION, "counters": {},
+                         "histograms": {}}
+            self._merge(state)
+            for path, data in ((state_path, json.dumps(state)),
+                               (prom_path, self._render(state))):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        # Only merge once.
+        self.counters = {}
+        self.histograms = {}
@@ -0,0 +1,169 @@
+###########################################################################
+## Export of Script Module: JobTrace
+## Language: Python
+## Category: Internal
+## Description: Tracing spans for NetMRI jobs, exported as OTLP JSON.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for job tracing
+# JobTrace.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Nested tracing spans for a job, without any dependency on the
+#   OpenTelemetry SDK (which isn't available in the NetMRI sandbox).
+#
+#   One trace is recorded per job (device). Spans are opened with:
+#       with tracer.span("name", attr=value) as span:
+#           ...
+#           span.set_attribute("other", value)
+#   A span opened inside another one is its child. If the block raises, the
+#   span status is set to error, with the exception as the message.
+#
+#   The trace is written with JobTrace.write(), in the OTLP/JSON format
+#   (same as an OTLP/HTTP JSON ExportTraceServiceRequest). It can be loaded
+#   by anything that reads OTLP JSON (e.g: the otel collector "otlpjsonfile"
+#   receiver), or by json.load().
+#------------------------------------------------------------------------------
+import json
+import os
+import time
+
+# OTLP span status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+# OTLP span kind: internal
+SPAN_KIND_INTERNAL = 1
+
+
+def _otlp_value(value):
+    """Convert a python value to an OTLP AnyValue."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 is a string in OTLP/JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attrs):
+    return [{"key": key, "value": _otlp_value(value)}
+            for key, value in attrs.items() if value is not None]
+
+
+class Span:
+    def __init__(self, tracer, name, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = ""
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.tracer.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.status = STATUS_ERROR
+            self.status_message = str(exc)
+        self.tracer.stack.pop()
+        self.tracer.finished.append(self)
+        # Don't swallow the exception.
+        return False
+
+    def to_otlp(self, trace_id):
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": self.status}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.status_message:
+            span['status']['message'] = self.status_message
+        return span
+
+
+class JobTrace:
+    def __init__(self, service_name, resource=None):
+        self.service_name = service_name  # OTLP service.name
+        self.resource = resource or {}    # Resource attributes
+        self.trace_id = os.urandom(16).hex()
+        self.stack = []                   # Open spans, innermost last
+        self.finished = []                # Closed spans
+
+    def span(self, name, **attributes):
+        """Open a child span of the current span. Use as a context manager.
+
+        Args:
+            - name (str): Span name.
+            - attributes: Span attributes. None values are left out.
+        """
+        parent_id = self.stack[-1].span_id if self.stack else None
+        return Span(self, name, parent_id, attributes)
+
+    def current(self):
+        """The innermost open span, or None."""
+        return self.stack[-1] if self.stack else None
+
+    def to_otlp(self):
+        """The trace as an OTLP/JSON ExportTraceServiceRequest dict.
+
+        Spans that are still open (e.g: the job was killed) are included,
+        and end now.
+        """
+        spans = self.finished + list(reversed(self.stack))
+        resource = {"service.name": self.service_name, **self.resource}
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes(resource)},
+                "scopeSpans": [{
+                    "scope": {"name": self.service_name},
+                    "spans": [span.to_otlp(self.trace_id) for span in spans]
+                }]
+            }]
+        }
+
+    def write(self, path):
+        """Write the trace to 'path', as OTLP/JSON.
+
+        Raises:
+            OSError if the file can't be written.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_otlp(), f, separators=(",", ":"))
+        os.replace(tmp_path, path)
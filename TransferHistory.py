@@ -0,0 +1,292 @@
+###########################################################################
+## Export of Script Module: TransferHistory
+## Language: Python
+## Category: Internal
+## Description: Transfer history of NetMRI jobs, in a local SQLite database.
+###########################################################################
+#------------------------------------------------------------------------------
+# NetMRI Python Library for the transfer history
+# TransferHistory.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Every image transfer and integrity check of the jobs, one row each, in a
+#   SQLite database: device, OS, platform, repo, file, bytes, duration,
+#   throughput, attempt (0 is the first try), result, error code, whether
+#   the HTTP client was tuned for it, and when (with the hour of the day,
+#   local time).
+#
+#   Every NetMRI job runs in its own process, one per device. The database
+#   is in WAL mode, so the jobs of a batch can all write to it at once.
+#
+#   Throughput percentiles are computed over the passed rows only, by repo,
+#   platform, OS, file, hour of the day, tuning, or site. Each grouping
+#   column has an index of (kind, result, column, mbps, ts), so a
+#   throughput() query, or a rate() with one filter, reads the rows already
+#   in order, without touching the table (even with 'since'). A rate() with
+#   more filters reads the table rows of the first one. Sites aren't known
+#   to the job. They are joined from a DeviceID -> Site map (e.g: the
+#   inventory export of fleet_plan.py), with set_sites().
+#
+#   The first job to open a new database creates the schema. The others
+#   wait for it.
+#
+#   Percentiles are nearest-rank: p50 of 4 values is the 2nd smallest.
+#------------------------------------------------------------------------------
+import os
+import sqlite3
+import time
+
+HISTORY_VERSION = 1
+# Rows of a group needed before rate() trusts it.
+MIN_SAMPLES = 5
+# Columns throughput can be grouped by.
+GROUP_COLUMNS = ("repo", "platform", "os", "file", "hour", "tuned", "site")
+# Row kinds.
+KIND_TRANSFER = "transfer"
+KIND_VERIFY = "verify"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    hour INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    job_id INTEGER,
+    device_id INTEGER,
+    device_name TEXT,
+    os TEXT,
+    platform TEXT,
+    repo TEXT,
+    file TEXT,
+    bytes INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    mbps REAL,
+    attempt INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    code INTEGER,
+    tuned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS transfers_repo
+    ON transfers (kind, result, repo, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_platform
+    ON transfers (kind, result, platform, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_os
+    ON transfers (kind, result, os, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_file
+    ON transfers (kind, result, file, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_hour
+    ON transfers (kind, result, hour, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_tuned
+    ON transfers (kind, result, tuned, mbps, ts);
+CREATE INDEX IF NOT EXISTS transfers_device
+    ON transfers (device_id);
+CREATE INDEX IF NOT EXISTS transfers_ts
+    ON transfers (ts);
+"""
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted 'values'."""
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+class TransferHistory:
+    """The transfer history database.
+
+    Args:
+        - path (str): Database file. Created (with its directory) if needed.
+        - timeout (float): Seconds to wait for another job's write.
+
+    Raises:
+        sqlite3.Error if it can't be opened, or is a newer version.
+    """
+
+    def __init__(self, path, timeout=30):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Autocommit. Every record() is one short transaction.
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  isolation_level=None)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > HISTORY_VERSION:
+            self.db.close()
+            raise sqlite3.DatabaseError(f"{path} is a version {version}"
+                                        " history")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        if version < HISTORY_VERSION:
+            self._create()
+        self.sites = False
+
+    def _create(self):
+        # The jobs of a batch all open the history at once. The write lock
+        # makes the others wait, and they then find it done.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version < HISTORY_VERSION:
+                # executescript() would commit. One statement at a time.
+                for statement in SCHEMA.split(";"):
+                    if statement.strip():
+                        self.db.execute(statement)
+                self.db.execute(f"PRAGMA user_version = {HISTORY_VERSION}")
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        self.db.close()
+
+    def record(self, kind, result, duration, size, code=None, attempt=0,
+               tuned=False, **fields):
+        """Record a transfer or integrity check, that just ended.
+
+        Args:
+            - kind (str): KIND_TRANSFER or KIND_VERIFY.
+            - result (str): "pass" or "fail".
+            - duration (float): Seconds.
+            - size (int): Bytes of the file.
+            - code (int): Error code, if it failed (e.g: 0xbf).
+            - attempt (int): 0 for the first try, then 1 per retry.
+            - tuned (bool): The HTTP client was tuned for it.
+            - fields: Any of job_id, device_id, device_name, os, platform,
+                      repo, file.
+        """
+        now = time.time()
+        started = now - duration
+        mbps = (round(size * 8 / (duration * 1e6), 3)
+                if result == "pass" and duration > 0 else None)
+        row = dict(fields, ts=round(started, 3),
+                   hour=time.localtime(started).tm_hour, kind=kind,
+                   bytes=size, duration=duration, mbps=mbps, attempt=attempt,
+                   result=result, code=code, tuned=int(bool(tuned)))
+        columns = ", ".join(row)
+        marks = ", ".join("?" * len(row))
+        self.db.execute(f"INSERT INTO transfers ({columns}) VALUES ({marks})",
+                        tuple(row.values()))
+
+    def set_sites(self, sites):
+        """Set the site of each device, for the 'site' grouping.
+
+        Args:
+            - sites (dict): Site, keyed by DeviceID.
+        """
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS sites"
+                        " (device_id INTEGER PRIMARY KEY, site TEXT)")
+        self.db.execute("DELETE FROM temp.sites")
+        self.db.executemany("INSERT INTO temp.sites VALUES (?, ?)",
+                            ((int(key), value) for key, value in sites.items()
+                             if str(key).isdigit() and value))
+        self.sites = True
+
+    def _select(self, by, kind, since, where):
+        # The passed rows of a kind, ordered by group then throughput.
+        if by == "site":
+            if not self.sites:
+                raise ValueError("set_sites() first")
+            column = "s.site"
+            source = ("transfers t JOIN temp.sites s"
+                      " ON s.device_id = t.device_id")
+        elif by in GROUP_COLUMNS or by is None:
+            column = f"t.{by}" if by else "NULL"
+            source = "transfers t"
+        else:
+            raise ValueError(f"Can't group by {by}")
+        clauses = ["t.kind = ?", "t.result = 'pass'", "t.mbps IS NOT NULL"]
+        args = [kind]
+        if since:
+            clauses.append("t.ts >= ?")
+            args.append(since)
+        for name, value in where.items():
+            if name not in GROUP_COLUMNS or name == "site":
+                raise ValueError(f"Can't filter by {name}")
+            clauses.append(f"t.{name} IS ?")
+            args.append(value)
+        order = f"{column}, t.mbps" if by else "t.mbps"
+        return self.db.execute(
+            f"SELECT {column}, t.mbps FROM {source}"
+            f" WHERE {' AND '.join(clauses)} ORDER BY {order}", args
+        )
+
+    def throughput(self, by, kind=KIND_TRANSFER, since=None,
+                   percentiles=(50, 95)):
+        """Throughput percentiles (in Mbps) of the passed rows, per group.
+
+        Args:
+            - by (str): One of GROUP_COLUMNS.
+            - kind (str): KIND_TRANSFER or KIND_VERIFY.
+            - since (float): Only the rows since then (epoch seconds).
+            - percentiles (tuple): Percentiles to compute.
+
+        Returns:
+            list: Dicts, by group, with keys:
+                - by (e.g: 'repo'): The group.
+                - 'count' (int): Passed rows.
+                - 'failed' (int): Failed rows. (Not for 'site')
+                - 'p<N>' (float): Each percentile.
+        """
+        groups = []
+        values = []
+        current = None
+
+        def close():
+            if values:
+                group = {by: current, "count": len(values), "failed": 0}
+                for pct in percentiles:
+                    group[f"p{pct}"] = percentile(values, pct)
+                groups.append(group)
+
+        for group, mbps in self._select(by, kind, since, {}):
+            if group != current or not values:
+                close()
+                current = group
+                values = []
+            values.append(mbps)
+        close()
+        if by != "site":
+            failed = dict(self.db.execute(
+                f"SELECT {by}, COUNT(*) FROM transfers WHERE kind = ?"
+                f" AND result = 'fail'{' AND ts >= ?' if since else ''}"
+                f" GROUP BY {by}", (kind, since) if since else (kind,)
+            ).fetchall())
+            for group in groups:
+                group['failed'] = failed.get(group[by], 0)
+        return groups
+
+    def rate(self, pct=50, kind=KIND_TRANSFER, since=None,
+             min_samples=MIN_SAMPLES, fallback=True, **where):
+        """A throughput percentile, in Mbps, of the passed rows matching
+        'where' (e.g: repo="10.0.0.1", platform="c3560cx").
+
+        If there are fewer than 'min_samples' rows, and 'fallback' is True,
+        the filters are dropped from the last one, until there are enough.
+
+        Returns:
+            float: Mbps, or None if there isn't enough history.
+        """
+        filters = list(where.items())
+        while True:
+            values = [mbps for _, mbps in self._select(None, kind, since,
+                                                       dict(filters))]
+            if len(values) >= min_samples:
+                return percentile(values, pct)
+            if not (filters and fallback):
+                return None
+            filters.pop()
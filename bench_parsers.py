@@ -0,0 +1,357 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# bench_parsers.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Microbenchmarks for the CLI output parsers of CiscoDevice.py, over a
+#   corpus of captured outputs (bench_corpus/). Runs offline: the steps of
+#   each probe (see CiscoDevice._run()) are sent the corpus outputs, instead
+#   of going through NetMRI.
+#
+#   Parsers:
+#       - system_image_info: show version (and packages.conf on IOS-XE)
+#       - system_fs_info: show file system (dir ... | include free on NX-OS)
+#       - file_size_info: the dir size regexes
+#       - old_images: the dir line matchers of remove_old_images()
+#
+#   Every case is checked against its expected result first, then timed.
+#   The best of --repeat rounds is kept, in parses per second and MB/s of
+#   output parsed.
+#
+# USAGE:
+#   python bench_parsers.py
+#   python bench_parsers.py -k asa_ --min-time 1
+#
+#   Save a baseline, then fail (exit 1) on anything slower than it, by more
+#   than --tolerance:
+#   python bench_parsers.py --save-baseline baseline.json
+#   python bench_parsers.py --baseline baseline.json
+#
+# NOTES:
+#   1. bench_corpus/cases.json is versioned. Bump its "version" whenever an
+#      output or case changes, so old baselines are not compared to it.
+#   2. An output is a file in bench_corpus/, or {"file": ..., "repeat": N}.
+#      Lines of the file with "{i}" in them are repeated N times, with the
+#      line number, to build the large outputs (e.g: ASA dir).
+#   3. Outputs are stored the way NetMRI returns them: quotes are escaped
+#      (e.g: show version).
+#   4. After a parser change that is meant to change its results, review
+#      them, and then update the corpus with --record-expected.
+#   5. Baselines are only comparable on the same machine and Python.
+#------------------------------------------------------------------------------
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import types
+from CiscoDevice import CiscoDevice
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "bench_corpus")
+CORPUS_FILE = "cases.json"
+
+# Defaults for the timing.
+DEFAULT_MIN_TIME = 0.2      # Seconds per round
+DEFAULT_REPEAT = 5          # Rounds per case. The best is kept.
+DEFAULT_TOLERANCE = 0.25    # Slowdown allowed against the baseline
+
+# Parser name -> (steps of the probe, result after the steps ran).
+PARSERS = {
+    "system_image_info": (
+        lambda device: device._get_system_image_info(),
+        lambda device, _: {
+            name: device.__dict__.get(name) for name in (
+                "platform", "current_system_image", "current_system_image_fs",
+                "nxos_kickstart_image", "iosxe_boot_mode", "iosxe_build",
+                "iosxe_sdwan"
+            )
+        }
+    ),
+    "system_fs_info": (
+        lambda device: device._get_system_fs_info(),
+        lambda device, _: {"system_fs": device.system_fs,
+                           "system_fs_info": device.system_fs_info}
+    ),
+    "file_size_info": (
+        lambda device, fs, name, path="/": device._get_file_size_info(
+            fs, name, path
+        ),
+        lambda device, value: value
+    ),
+    "old_images": (
+        lambda device, fs_list: device._get_old_images(fs_list),
+        lambda device, value: value
+    )
+}
+
+
+class _CorpusEasy:
+    """Just enough of NetMRIEasy for CiscoDevice(). Commands are never sent
+    through it (see replay())."""
+
+    def __init__(self, fields):
+        self.device = types.SimpleNamespace(DeviceName="bench", **fields)
+
+    def get_device(self):
+        return self.device
+
+
+def load_output(spec, corpus_dir=CORPUS_DIR):
+    """Load a corpus output.
+
+    Args:
+        - spec (str or dict): A file name, or {"file": ..., "repeat": N}.
+        - corpus_dir (str): Directory of the corpus.
+
+    Returns:
+        str: The output.
+    """
+    if isinstance(spec, str):
+        spec = {"file": spec}
+    with open(os.path.join(corpus_dir, spec['file']), "r") as f:
+        text = f.read()
+    repeat = spec.get("repeat")
+    if not repeat:
+        return text
+    lines = []
+    for line in text.splitlines(keepends=True):
+        if "{i}" in line:
+            lines.extend(line.replace("{i}", str(i)) for i in range(repeat))
+        else:
+            lines.append(line)
+    return "".join(lines)
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Load bench_corpus/cases.json, with every output read in.
+
+    Returns:
+        dict: The corpus. Each case has 'outputs' loaded (command -> str),
+              and 'bytes', the size of all of them.
+    """
+    with open(os.path.join(corpus_dir, CORPUS_FILE), "r") as f:
+        corpus = json.load(f)
+    for case in corpus['cases']:
+        case['outputs'] = {command: load_output(spec, corpus_dir)
+                           for command, spec in case['outputs'].items()}
+        case['bytes'] = sum(len(output)
+                            for output in case['outputs'].values())
+    return corpus
+
+
+def replay(steps, outputs):
+    """Run the steps of a probe, sending back the corpus output of each
+    command they yield. Same as CiscoDevice._run(), without the CLI.
+
+    Raises:
+        KeyError if the corpus has no output for a command.
+    """
+    try:
+        request = next(steps)
+        while True:
+            if request.command not in outputs:
+                raise KeyError(f"No output in the corpus for"
+                               f" {request.command!r}")
+            request = steps.send(outputs[request.command])
+    except StopIteration as stop:
+        return stop.value
+
+
+def _normalize(value):
+    # The way it round trips through cases.json (tuples are lists, keys are
+    # strings).
+    return json.loads(json.dumps(value))
+
+
+def make_runner(case, devices):
+    """Build the function that parses a case once.
+
+    Returns:
+        function: No arguments. Returns the parser result.
+    """
+    steps, result = PARSERS[case['parser']]
+    fields = devices[case['device']]
+    facts = case.get("facts", {})
+    args = case.get("args", [])
+    outputs = case['outputs']
+
+    def run():
+        # A new device every time, so facts of the last run don't leak.
+        device = CiscoDevice(_CorpusEasy(fields))
+        device.__dict__.update(facts)
+        value = replay(steps(device, *args), outputs)
+        return result(device, value)
+    return run
+
+
+def time_case(run, min_time=DEFAULT_MIN_TIME, repeat=DEFAULT_REPEAT):
+    """Time a parser.
+
+    Returns:
+        float: Best seconds per parse, over 'repeat' rounds of at least
+               'min_time' seconds.
+    """
+    # Find how many parses take min_time.
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def check_baseline(results, baseline, tolerance):
+    """Compare the results to a baseline.
+
+    Returns:
+        list: Names of the cases slower than the baseline by more than
+              'tolerance'. Cases that aren't in the baseline are skipped.
+    """
+    slower = []
+    for name, item in results.items():
+        base = baseline['cases'].get(name)
+        if base and item['ops'] < base['ops'] * (1 - tolerance):
+            slower.append(name)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CiscoDevice CLI output parsers over the"
+        " captured output corpus."
+    )
+    parser.add_argument("-c", "--corpus", default=CORPUS_DIR,
+                        help="Corpus directory.")
+    parser.add_argument("-k", "--filter", default="",
+                        help="Only run cases with this in their name.")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME,
+                        help="Seconds per timing round.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Timing rounds per case.")
+    parser.add_argument("--baseline",
+                        help="Fail on cases slower than this baseline.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Slowdown allowed against the baseline"
+                        " (0.25 is 25%%).")
+    parser.add_argument("--save-baseline",
+                        help="Save the results as a baseline.")
+    parser.add_argument("--record-expected", action="store_true",
+                        help="Save the parser results as the expected"
+                        " results in the corpus, and don't time anything.")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus)
+    cases = [case for case in corpus['cases'] if args.filter in case['name']]
+    if not cases:
+        parser.error(f"no case matches {args.filter!r}")
+
+    if args.record_expected:
+        path = os.path.join(args.corpus, CORPUS_FILE)
+        with open(path, "r") as f:
+            raw = json.load(f)
+        for item in raw['cases']:
+            case = next((case for case in cases
+                         if case['name'] == item['name']), None)
+            if case:
+                item['expected'] = _normalize(
+                    make_runner(case, corpus['devices'])()
+                )
+        with open(path, "w", newline="\n") as f:
+            json.dump(raw, f, indent=1)
+            f.write("\n")
+        print(f"Recorded the expected results of {len(cases)} cases.")
+        return 0
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus_version") != corpus['version']:
+            parser.error(f"baseline is for corpus version"
+                         f" {baseline.get('corpus_version')}, the corpus is"
+                         f" version {corpus['version']}")
+
+    failed = []
+    results = {}
+    print(f"{'case':<34} {'parser':<18} {'parses/s':>11} {'MB/s':>8}"
+          f" {'vs base':>8}")
+    for case in cases:
+        run = make_runner(case, corpus['devices'])
+        try:
+            value = _normalize(run())
+        except Exception as err:
+            print(f"{case['name']:<34} ERROR {type(err).__name__}: {err}")
+            failed.append(case['name'])
+            continue
+        if "expected" in case and value != case['expected']:
+            print(f"{case['name']:<34} WRONG RESULT {json.dumps(value)}")
+            failed.append(case['name'])
+            continue
+
+        seconds = time_case(run, args.min_time, args.repeat)
+        results[case['name']] = {
+            "parser": case['parser'],
+            "ops": round(1 / seconds, 1),
+            "mb_s": round(case['bytes'] / seconds / 1e6, 2)
+        }
+        base = baseline['cases'].get(case['name']) if baseline else None
+        ratio = (f"{results[case['name']]['ops'] / base['ops']:.2f}x"
+                 if base else "-")
+        print(f"{case['name']:<34} {case['parser']:<18}"
+              f" {results[case['name']]['ops']:>11.1f}"
+              f" {results[case['name']]['mb_s']:>8.2f} {ratio:>8}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({
+                "corpus_version": corpus['version'],
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "generated": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                           time.gmtime()),
+                "cases": results
+            }, f, indent=1)
+
+    if baseline:
+        slower = check_baseline(results, baseline, args.tolerance)
+        for name in slower:
+            print(f"REGRESSION: {name} is slower than the baseline by more"
+                  f" than {args.tolerance:.0%}")
+        failed.extend(slower)
+    if failed:
+        print(f"{len(failed)} of {len(cases)} cases failed.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# build_hash_list.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Builds the "Cisco OS SW Hashes" CSV from a local image repo directory.
+#   This is run on the repo host (or anywhere the images are mounted), not
+#   inside of NetMRI.
+#
+#   A manifest is kept next to the CSV. Each file is keyed by its path, and
+#   the manifest stores the inode, size and mtime that were seen when it was
+#   last hashed. On the next run, only files that are new, or whose key
+#   changed, are hashed again. Files that disappeared are dropped.
+#
+#   Every run also writes a diff CSV (added/removed/changed rows), so the
+#   NetMRI list can be updated in place instead of being re-imported.
+#
+# USAGE:
+#   python build_hash_list.py /srv/repo/pub/cisco/ios
+#   python build_hash_list.py /srv/repo/pub/cisco/ios -o cisco_os_sw_hashes.csv
+#
+# NOTES:
+#   1. The hash list is keyed by filename, not path. If the same filename
+#      exists in more than one sub-directory, a warning is printed and the
+#      first one found wins.
+#   2. Like git's index, a file that was modified within the same mtime tick
+#      as the previous run is treated as changed, and gets hashed again.
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+
+MANIFEST_VERSION = 1
+HASH_LIST_FIELDS = ["Filename", "Size", "MD5", "SHA512"]
+DIFF_FIELDS = ["Action"] + HASH_LIST_FIELDS
+# Read size for hashing. Images are large, so use big reads.
+READ_CHUNK = 1024 * 1024
+# Files that are never part of the hash list.
+IGNORED_SUFFIXES = (".csv", ".json", ".tmp", ".part")
+
+
+def scan_repo(repo_path):
+    """Walk the repo directory and stat every image file.
+
+    Args:
+        - repo_path (str): Root directory of the image repo.
+
+    Returns:
+        dict: Keyed by path relative to repo_path, with values:
+            - (inode, size, mtime_ns) tuple.
+    """
+    found = {}
+    pending = [repo_path]
+    while pending:
+        top = pending.pop()
+        with os.scandir(top) as it:
+            for entry in it:
+                # Skip hidden files/dirs (e.g: .hashlist_manifest.json)
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    continue
+                if (not entry.is_file()
+                        or entry.name.endswith(IGNORED_SUFFIXES)):
+                    continue
+                st = entry.stat()
+                relpath = os.path.relpath(entry.path, repo_path)
+                found[relpath] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return found
+
+
+def hash_file(path):
+    """MD5 and SHA-512 of a file, in a single read pass.
+
+    Args:
+        - path (str): Path to the file.
+
+    Returns:
+        tuple: (md5, sha512) hex digests.
+    """
+    md5 = hashlib.md5()
+    sha512 = hashlib.sha512()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            md5.update(chunk)
+            sha512.update(chunk)
+    return (md5.hexdigest(), sha512.hexdigest())
+
+
+def load_manifest(manifest_path):
+    """Load the manifest from the previous run.
+
+    Returns:
+        dict: With keys:
+            - 'generated_ns' (int): When the previous run started.
+            - 'files' (dict): Keyed by relative path, with values:
+                - 'inode' (int), 'size' (int), 'mtime_ns' (int),
+                  'md5' (str), 'sha512' (str)
+    """
+    empty = {"generated_ns": 0, "files": {}}
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return empty
+    except ValueError:
+        print(f"WARNING: {manifest_path} is corrupt. Rehashing everything.",
+              file=sys.stderr)
+        return empty
+    if manifest.get("version") != MANIFEST_VERSION:
+        return empty
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    """Atomically write the manifest."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"), sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def update_manifest(repo_path, manifest, rehash_all=False):
+    """Bring the manifest up to date with the repo contents.
+
+    Only files that are new, or have a different inode, size or mtime, are
+    hashed. Unchanged entries are carried over as-is.
+
+    Args:
+        - repo_path (str): Root directory of the image repo.
+        - manifest (dict): From load_manifest().
+        - rehash_all (bool): Ignore the manifest and hash everything.
+
+    Returns:
+        tuple: (new_manifest, diff)
+            - new_manifest (dict): Same structure as load_manifest().
+            - diff (dict): Keys 'added', 'removed', 'changed'. Each is a list
+              of relative paths.
+    """
+    generated_ns = time.time_ns()
+    old_files = manifest["files"]
+    # Entries whose mtime is not older than the previous run could have been
+    # modified again within the same mtime tick. Don't trust them.
+    racy_ns = manifest["generated_ns"]
+    new_files = {}
+    diff = {"added": [], "removed": [], "changed": []}
+
+    for relpath, (inode, size, mtime_ns) in scan_repo(repo_path).items():
+        old = old_files.get(relpath)
+        if (old is not None and not rehash_all
+                and old["inode"] == inode
+                and old["size"] == size
+                and old["mtime_ns"] == mtime_ns
+                and mtime_ns < racy_ns):
+            new_files[relpath] = old
+            continue
+
+        md5, sha512 = hash_file(os.path.join(repo_path, relpath))
+        new_files[relpath] = {
+            "inode": inode,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "md5": md5,
+            "sha512": sha512
+        }
+        if old is None:
+            diff["added"].append(relpath)
+        # A racy or touched file that hashes the same is not a change.
+        elif old["md5"] != md5 or old["sha512"] != sha512:
+            diff["changed"].append(relpath)
+
+    diff["removed"] = [path for path in old_files if path not in new_files]
+
+    new_manifest = {
+        "version": MANIFEST_VERSION,
+        "generated_ns": generated_ns,
+        "files": new_files
+    }
+    return (new_manifest, diff)
+
+
+def hash_list_row(relpath, entry):
+    """Build a hash list CSV row from a manifest entry."""
+    return {
+        "Filename": os.path.basename(relpath),
+        "Size": entry["size"],
+        "MD5": entry["md5"],
+        "SHA512": entry["sha512"]
+    }
+
+
+def write_hash_list(csv_path, files):
+    """Write the full hash list CSV, in the format NetMRI imports.
+
+    Args:
+        - csv_path (str): Output path.
+        - files (dict): The manifest 'files' dictionary.
+    """
+    seen = {}
+    rows = []
+    for relpath in sorted(files):
+        row = hash_list_row(relpath, files[relpath])
+        if row["Filename"] in seen:
+            print(f"WARNING: Duplicate filename {relpath}. Keeping"
+                  f" {seen[row['Filename']]}", file=sys.stderr)
+            continue
+        seen[row["Filename"]] = relpath
+        rows.append(row)
+
+    tmp_path = csv_path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=HASH_LIST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, csv_path)
+
+
+def write_diff(diff_path, diff, old_files, new_files):
+    """Write the added/removed/changed rows.
+
+    Removed rows carry the values that were in the old list, so they can be
+    matched against the NetMRI list rows being deleted.
+    """
+    with open(diff_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=DIFF_FIELDS)
+        writer.writeheader()
+        for action in ("added", "changed"):
+            for relpath in sorted(diff[action]):
+                row = hash_list_row(relpath, new_files[relpath])
+                row["Action"] = action
+                writer.writerow(row)
+        for relpath in sorted(diff["removed"]):
+            row = hash_list_row(relpath, old_files[relpath])
+            row["Action"] = "removed"
+            writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the Cisco OS SW Hashes CSV for NetMRI."
+    )
+    parser.add_argument("repo_path", help="Directory containing the images.")
+    parser.add_argument("-o", "--output", default="cisco_os_sw_hashes.csv",
+                        help="Hash list CSV to write.")
+    parser.add_argument("-m", "--manifest",
+                        help="Manifest path. Default is"
+                        " <repo_path>/.hashlist_manifest.json")
+    parser.add_argument("-d", "--diff",
+                        help="Diff CSV path. Default is <output>.diff.csv")
+    parser.add_argument("--rehash", action="store_true",
+                        help="Ignore the manifest and hash every file.")
+    args = parser.parse_args(argv)
+
+    manifest_path = args.manifest or os.path.join(
+        args.repo_path, ".hashlist_manifest.json"
+    )
+    diff_path = args.diff or os.path.splitext(args.output)[0] + ".diff.csv"
+
+    started = time.monotonic()
+    old_manifest = load_manifest(manifest_path)
+    new_manifest, diff = update_manifest(args.repo_path, old_manifest,
+                                         args.rehash)
+    changed = any(diff.values())
+
+    # Don't rewrite anything if nothing changed, and the CSV is still there.
+    if changed or not os.path.exists(args.output):
+        write_hash_list(args.output, new_manifest["files"])
+    write_diff(diff_path, diff, old_manifest["files"], new_manifest["files"])
+    save_manifest(manifest_path, new_manifest)
+
+    print(f"{len(new_manifest['files'])} files:"
+          f" {len(diff['added'])} added,"
+          f" {len(diff['changed'])} changed,"
+          f" {len(diff['removed'])} removed"
+          f" ({time.monotonic() - started:.2f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
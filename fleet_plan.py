@@ -0,0 +1,444 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# fleet_plan.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Offline "plan" mode for the Cisco OS Software Transfer job.
+#
+#   Unlike 'dry_run', this does not open a CLI session to any device. It
+#   simulates the job for the whole fleet from:
+#       - A NetMRI inventory export (CSV), with the columns:
+#           DeviceID, DeviceName, DeviceSysDescr, DeviceModel, DeviceVersion,
+#           Network View (or VirtualNetworkName), and optionally Site and
+#           Device Groups (comma separated).
+#       - The Cisco OS SW Hashes CSV.
+#       - The Cisco OS SW Target Rules CSV, if the job uses them
+#         ('use_target_rules'). See CiscoDevice.TargetRules.
+#       - The Cisco OS SW Regional Repos CSV (or a repo override).
+#       - The device facts cached by previous job runs
+#         (na_ciscoswtransfer.LOCAL_STATE_DIR/facts), if available.
+#
+#   For every device it computes whether it is already current, whether the
+#   target image is already present, whether old images need to be cleaned
+#   up, how many bytes need to be transferred, and from which repo.
+#
+# USAGE:
+#   python fleet_plan.py -i inventory.csv -l cisco_os_sw_hashes.csv \
+#       -r cisco_os_sw_regional_repos.csv --region Region -f facts/ \
+#       -o plan.json
+#
+#   Loading thousands of JSON facts files is slow. Save them once in the
+#   packed DeviceRecord format, and use that instead:
+#   python fleet_plan.py ... -f facts/ --save-facts fleet.cdr
+#   python fleet_plan.py ... -f fleet.cdr
+#
+#   With target rules:
+#   python fleet_plan.py ... -t cisco_os_sw_target_rules.csv
+#
+#   With the transfer rates of the job's transfer history:
+#   python fleet_plan.py ... --history history.sqlite
+#
+# NOTES:
+#   1. Without cached facts, the platform is derived from the sysDescr. This
+#      is not always possible (e.g: ISR4k reports X86_64_LINUX_IOSD). Those
+#      devices are planned as "unknown_platform", and need one job run (or
+#      a dry run) to populate the facts cache.
+#   2. Without cached facts, "already current" and "needs cleanup" cannot be
+#      determined, so the device is planned as a full transfer, and
+#      'needs_cleanup' is null.
+#   3. With --history, each transfer is estimated at the median throughput
+#      the history has for its repo and platform (or the repo alone, or the
+#      whole history, if there's too little of it), instead of
+#      --device-mbps. The rate is in the plan ('mbps'), for
+#      fleet_schedule.py.
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from TransferHistory import KIND_TRANSFER, TransferHistory
+from CiscoDevice import (classify_device, classify_inventory,
+                         platform_from_sysdescr, prefilter_current)
+from CiscoDevice import OS_ROLES, get_manifest_file, match_manifest
+from CiscoDevice import TargetRules
+from CiscoDevice import DeviceRecord, pack_device_records
+from CiscoDevice import unpack_device_records
+
+# Plan status for each device.
+STATUS_CURRENT = "current"              # Already running the target.
+STATUS_PRESENT = "present"              # Target already on the device.
+STATUS_TRANSFER = "transfer"            # Target needs to be transferred.
+STATUS_UNKNOWN_PLATFORM = "unknown_platform"
+STATUS_NO_TARGET = "no_target"          # Nothing in the hash list.
+STATUS_NO_REPO = "no_repo"              # No repo for region/network view.
+STATUS_UNSUPPORTED = "unsupported"      # Unknown OS, ACI, etc.
+
+# Default link speeds used to estimate durations, in Mbps.
+DEFAULT_DEVICE_MBPS = 20.0
+DEFAULT_REPO_MBPS = 1000.0
+
+
+def load_csv(path):
+    """Read a CSV file into a list of dicts."""
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def load_facts(path):
+    """Load the device facts cache.
+
+    Args:
+        - path (str): Either the facts directory written by the job
+                      (one <DeviceID>.json per device), a JSON-lines file
+                      with one facts dictionary per line, or a .cdr file
+                      written with --save-facts.
+
+    Returns:
+        dict: DeviceRecords, keyed by DeviceID (str).
+    """
+    facts = {}
+    if not path:
+        return facts
+    if path.endswith(".cdr"):
+        with open(path, "rb") as f:
+            for record in unpack_device_records(f.read()):
+                facts[str(record.device_id)] = record
+        return facts
+
+    version_cache = {}
+    if os.path.isdir(path):
+        for fname in glob.glob(os.path.join(path, "*.json")):
+            with open(fname, "r") as f:
+                item = json.load(f)
+            facts[str(item['DeviceID'])] = DeviceRecord.from_facts(
+                item, version_cache
+            )
+    else:
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    facts[str(item['DeviceID'])] = DeviceRecord.from_facts(
+                        item, version_cache
+                    )
+    return facts
+
+
+def build_repo_index(repo_rows, region):
+    """Index the Cisco OS SW Regional Repos rows for a region.
+
+    Returns:
+        dict: Repo address, keyed by Network View.
+    """
+    index = {}
+    for item in repo_rows:
+        if item['Region'] == region:
+            # First match wins, the same as get_repo_info().
+            index.setdefault(item['Network View'], item['Address'])
+    return index
+
+
+def plan_device(row, facts, hash_rows, repo_index, repo_override,
+                device_mbps, target_cache, cls=None, current=False,
+                rules=None, rate=None):
+    """Simulate the job for a single device.
+
+    Args:
+        - row (dict): Inventory row.
+        - facts (DeviceRecord): Cached facts for this device, or None.
+        - hash_rows (list): Hash list rows.
+        - repo_index (dict): From build_repo_index().
+        - repo_override (str): Repo address override, or None.
+        - device_mbps (float): Estimated transfer rate per device.
+        - target_cache (dict): Memo of target lookups, shared across calls.
+        - cls (Classification): From classify_inventory(). Classified from
+                                the row if None.
+        - current (bool): prefilter_current() found this device already
+                          running the target version.
+        - rules (TargetRules): Targeting rules, or None.
+        - rate (callable): rate(repo, platform) returns the transfer rate
+                           (Mbps) of a device, or None for 'device_mbps'.
+
+    Returns:
+        dict: The plan for this device.
+    """
+    plan = {
+        "DeviceID": row.get('DeviceID'),
+        "DeviceName": row.get('DeviceName'),
+        "Site": row.get('Site'),
+        "os": None,
+        "platform": None,
+        "targets": [],
+        "status": STATUS_UNSUPPORTED,
+        "needs_cleanup": None,
+        "bytes": 0,
+        "repo": None,
+        "mbps": None,
+        "est_seconds": 0.0,
+        "facts": facts is not None
+    }
+    if cls is None:
+        cls = classify_device(row.get('DeviceSysDescr'),
+                              row.get('DeviceModel'))
+    os_type = cls.os
+    if os_type is None:
+        return plan
+    plan['os'] = os_type
+    if cls.nxos_aci_mode:
+        return plan
+
+    if facts:
+        platform = facts.platform
+        asa_is_lfbff = facts.asa_is_lfbff
+        asa_is_smp = facts.asa_is_smp
+    else:
+        platform = platform_from_sysdescr(cls,
+                                          row.get('DeviceVersion') or "")
+        asa_is_lfbff = cls.asa_is_lfbff
+        asa_is_smp = cls.asa_is_smp
+    plan['platform'] = platform
+    if not platform:
+        plan['status'] = STATUS_UNKNOWN_PLATFORM
+        return plan
+
+    # NX-OS with kickstart. Prior to 7.0(3)I2(1), everything but "nxos".
+    if facts:
+        has_kickstart = bool(facts.kickstart_image)
+    else:
+        has_kickstart = os_type == "NX-OS" and platform != "nxos"
+
+    system = rules.resolve(
+        os_type, platform, row.get('DeviceModel'), row.get('DeviceVersion'),
+        row.get('Network View') or row.get('VirtualNetworkName'),
+        (row.get('Device Groups') or "").split(",")
+    ) if rules else None
+    # Most of the fleet shares a handful of platforms. Only search the hash
+    # list once per combination.
+    key = (os_type, platform, asa_is_lfbff, asa_is_smp, has_kickstart,
+           system['Filename'] if system else None)
+    if key not in target_cache:
+        target_cache[key] = match_manifest(hash_rows, os_type, platform,
+                                           asa_is_lfbff, asa_is_smp,
+                                           has_kickstart, system)
+    targets = target_cache[key]
+    if not targets or (has_kickstart
+                       and not get_manifest_file(targets, "kickstart")):
+        plan['status'] = STATUS_NO_TARGET
+        return plan
+    image = targets[0]
+    plan['targets'] = [item['Filename'] for item in targets]
+
+    # Already running the target? Same checks as main().
+    if facts and facts.image and not current:
+        current = ((facts.iosxe_boot_mode == "INSTALL"
+                    and f".{facts.iosxe_build}." in image['Filename'])
+                   or image['Filename'].startswith(facts.image))
+    if current:
+        # The other files of the manifest (e.g: ASDM) may still be missing.
+        targets = [item for item in targets if item['Role'] not in OS_ROLES]
+        if not targets:
+            plan['status'] = STATUS_CURRENT
+            return plan
+
+    present = set(facts.present) if facts else set()
+    missing = [item for item in targets if item['Filename'] not in present]
+    if not missing:
+        plan['status'] = STATUS_CURRENT if current else STATUS_PRESENT
+        return plan
+
+    plan['bytes'] = sum(item['Size'] for item in missing)
+    if facts and facts.fs:
+        plan['needs_cleanup'] = any(free < plan['bytes']
+                                    for _, free in facts.fs)
+
+    plan['repo'] = repo_override or repo_index.get(
+        row.get('Network View') or row.get('VirtualNetworkName')
+    )
+    if not plan['repo']:
+        plan['status'] = STATUS_NO_REPO
+        return plan
+
+    plan['status'] = STATUS_TRANSFER
+    plan['mbps'] = (rate and rate(plan['repo'], platform)) or device_mbps
+    plan['est_seconds'] = round(plan['bytes'] * 8 / (plan['mbps'] * 1e6), 1)
+    return plan
+
+
+def build_plan(inventory, facts, hash_rows, repo_index, repo_override=None,
+               device_mbps=DEFAULT_DEVICE_MBPS, repo_mbps=DEFAULT_REPO_MBPS,
+               rules=None, history=None, since=None):
+    """Simulate the job for the whole fleet.
+
+    With a TransferHistory, the devices are estimated at the median rate of
+    their repo and platform, since 'since' (epoch seconds).
+
+    Returns:
+        dict: The plan, with keys:
+            - 'summary' (dict): Device count per status.
+            - 'repos' (dict): Keyed by repo address, with values:
+                - 'devices' (int), 'bytes' (int),
+                - 'est_seconds' (float): Time to serve all bytes at the
+                  repo link speed.
+                - 'longest_device_seconds' (float)
+            - 'devices' (list): The per-device plans.
+    """
+    target_cache = {}
+    rates = {}
+
+    def rate(repo, platform):
+        # One query per repo and platform.
+        if (repo, platform) not in rates:
+            rates[repo, platform] = history.rate(50, KIND_TRANSFER, since,
+                                                 repo=repo,
+                                                 platform=platform)
+        return rates[repo, platform]
+
+    devices = []
+    summary = {}
+    repos = {}
+    # Classify the whole inventory in one pass.
+    classes = classify_inventory(
+        [row.get('DeviceSysDescr') for row in inventory],
+        [row.get('DeviceModel') for row in inventory]
+    )
+    # Devices the job skips before any CLI, by DeviceVersion.
+    current = prefilter_current(inventory, hash_rows, classes, rules)
+    for row, cls in zip(inventory, classes):
+        plan = plan_device(row, facts.get(str(row.get('DeviceID'))),
+                           hash_rows, repo_index, repo_override, device_mbps,
+                           target_cache, cls, row.get('DeviceID') in current,
+                           rules, rate if history else None)
+        devices.append(plan)
+        summary[plan['status']] = summary.get(plan['status'], 0) + 1
+        if plan['status'] == STATUS_TRANSFER:
+            repo = repos.setdefault(plan['repo'], {
+                "devices": 0, "bytes": 0, "est_seconds": 0.0,
+                "longest_device_seconds": 0.0
+            })
+            repo['devices'] += 1
+            repo['bytes'] += plan['bytes']
+            repo['longest_device_seconds'] = max(
+                repo['longest_device_seconds'], plan['est_seconds']
+            )
+
+    for repo in repos.values():
+        # The repo link is shared, but a device can't go faster than its own
+        # link. Whichever is longer bounds the rollout for this repo.
+        repo['est_seconds'] = round(max(
+            repo['bytes'] * 8 / (repo_mbps * 1e6),
+            repo['longest_device_seconds']
+        ), 1)
+
+    return {
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "device_mbps": device_mbps,
+        "repo_mbps": repo_mbps,
+        "summary": summary,
+        "repos": repos,
+        "devices": devices
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Plan a Cisco OS software transfer for the whole fleet,"
+        " without connecting to any device."
+    )
+    parser.add_argument("-i", "--inventory", required=True,
+                        help="NetMRI inventory export (CSV).")
+    parser.add_argument("-l", "--hash-list", required=True,
+                        help="Cisco OS SW Hashes CSV.")
+    parser.add_argument("-t", "--target-rules",
+                        help="Cisco OS SW Target Rules CSV.")
+    parser.add_argument("-r", "--repos",
+                        help="Cisco OS SW Regional Repos CSV.")
+    parser.add_argument("--region", default="Region",
+                        help="Region to select repos from.")
+    parser.add_argument("--repo-override",
+                        help="Use this repo for every device.")
+    parser.add_argument("-f", "--facts",
+                        help="Device facts directory, JSON-lines file,"
+                        " or .cdr file.")
+    parser.add_argument("--save-facts",
+                        help="Save the loaded facts to this .cdr file.")
+    parser.add_argument("--device-mbps", type=float,
+                        default=DEFAULT_DEVICE_MBPS,
+                        help="Estimated transfer rate per device.")
+    parser.add_argument("--repo-mbps", type=float, default=DEFAULT_REPO_MBPS,
+                        help="Estimated link speed of each repo.")
+    parser.add_argument("--history",
+                        help="Transfer history database, to estimate the"
+                        " transfer rate per repo and platform.")
+    parser.add_argument("--history-days", type=float, default=30,
+                        help="Only the history of the last this many days.")
+    parser.add_argument("-o", "--output", default="plan.json",
+                        help="Plan file to write.")
+    args = parser.parse_args(argv)
+
+    if not args.repos and not args.repo_override:
+        parser.error("one of --repos or --repo-override is required")
+
+    started = time.monotonic()
+    inventory = load_csv(args.inventory)
+    hash_rows = load_csv(args.hash_list)
+    try:
+        rules = (TargetRules(load_csv(args.target_rules), hash_rows)
+                 if args.target_rules else None)
+    except ValueError as err:
+        parser.error(str(err))
+    repo_index = (build_repo_index(load_csv(args.repos), args.region)
+                  if args.repos else {})
+    facts = load_facts(args.facts)
+    if args.save_facts:
+        with open(args.save_facts, "wb") as f:
+            f.write(pack_device_records(list(facts.values())))
+
+    history = None
+    if args.history:
+        if not os.path.isfile(args.history):
+            parser.error(f"{args.history} not found")
+        history = TransferHistory(args.history)
+    try:
+        plan = build_plan(inventory, facts, hash_rows, repo_index,
+                          args.repo_override, args.device_mbps,
+                          args.repo_mbps, rules, history,
+                          time.time() - args.history_days * 24 * 3600)
+    finally:
+        if history:
+            history.close()
+
+    with open(args.output, "w") as f:
+        json.dump(plan, f, indent=1)
+
+    for status, count in sorted(plan['summary'].items()):
+        print(f"{status:>18}: {count}")
+    for addr, repo in sorted(plan['repos'].items()):
+        print(f"repo {addr}: {repo['devices']} devices, {repo['bytes']} bytes,"
+              f" ~{repo['est_seconds']:.0f}s")
+    print(f"Planned {len(plan['devices'])} devices in"
+          f" {time.monotonic() - started:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
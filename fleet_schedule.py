@@ -0,0 +1,286 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# fleet_schedule.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Maintenance window scheduler for fleet transfers.
+#
+#   Takes the plan written by fleet_plan.py (bytes and selected repo for each
+#   device), and a sites CSV with the maintenance window and link speed of
+#   each site. Every transfer is packed into fixed time slots, so that:
+#       - It finishes inside its site's maintenance window.
+#       - The bandwidth in use per repo never exceeds the repo link speed.
+#       - The bandwidth in use per site never exceeds the site link speed.
+#
+#   Devices are placed highest priority first, then earliest deadline
+#   (window end) first, then longest transfer first. Each one is placed at
+#   the earliest slot where it fits (first-fit).
+#
+#   The output is an ordered schedule CSV, by start time, that can be used
+#   to submit the jobs (e.g: one device group, or batch, per start time).
+#
+#   Sites CSV columns:
+#       Site, Window Start, Window End, Link Mbps, Priority (optional)
+#   Window Start/End are either "HH:MM" (combined with --date, and an end
+#   before the start rolls over to the next day), or "YYYY-MM-DDTHH:MM".
+#
+#   Repos CSV columns (optional. --repo-mbps applies to repos not listed):
+#       Address, Link Mbps
+#
+# USAGE:
+#   python fleet_schedule.py -p plan.json -s sites.csv --date 2023-06-10 \
+#       -o schedule.csv
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import datetime
+import json
+import math
+import sys
+
+DEFAULT_SLOT_MINUTES = 5
+DEFAULT_REPO_MBPS = 1000.0
+DEFAULT_SITE_MBPS = 100.0
+SCHEDULE_FIELDS = ["Order", "Start", "End", "DeviceID", "DeviceName", "Site",
+                   "Repo", "Bytes", "Mbps", "Priority"]
+
+
+def parse_window_time(value, date):
+    """Parse a window time, either "HH:MM" or "YYYY-MM-DDTHH:MM"."""
+    value = value.strip()
+    if "T" in value or "-" in value:
+        return datetime.datetime.fromisoformat(value)
+    clock = datetime.datetime.strptime(value, "%H:%M").time()
+    return datetime.datetime.combine(date, clock)
+
+
+def load_sites(path, date):
+    """Load the sites CSV.
+
+    Returns:
+        dict: Keyed by site name, with values:
+            - 'start' (datetime), 'end' (datetime)
+            - 'mbps' (float): Site link speed.
+            - 'priority' (int): Higher is scheduled first.
+    """
+    sites = {}
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            start = parse_window_time(row['Window Start'], date)
+            end = parse_window_time(row['Window End'], date)
+            # e.g: 22:00 - 04:00
+            if end <= start:
+                end += datetime.timedelta(days=1)
+            sites[row['Site']] = {
+                "start": start,
+                "end": end,
+                "mbps": float(row.get('Link Mbps') or DEFAULT_SITE_MBPS),
+                "priority": int(row.get('Priority') or 0)
+            }
+    return sites
+
+
+def load_repo_speeds(path):
+    """Load the repos CSV. Returns link speed (Mbps), keyed by address."""
+    speeds = {}
+    if path:
+        with open(path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                speeds[row['Address']] = float(row['Link Mbps'])
+    return speeds
+
+
+class SlotCapacity:
+    """Bandwidth left, per time slot, for one shared link (repo or site)."""
+
+    def __init__(self, mbps, num_slots):
+        self.mbps = mbps
+        self.free = [mbps] * num_slots
+
+    def first_conflict(self, start, length, mbps):
+        """Return the last slot in [start, start+length) without room for
+        'mbps', or -1 if the transfer fits."""
+        free = self.free
+        for slot in range(start + length - 1, start - 1, -1):
+            if free[slot] < mbps:
+                return slot
+        return -1
+
+    def reserve(self, start, length, mbps):
+        for slot in range(start, start + length):
+            self.free[slot] -= mbps
+
+
+def build_schedule(devices, sites, repo_speeds, default_repo_mbps,
+                   device_mbps, slot_minutes=DEFAULT_SLOT_MINUTES):
+    """Pack the planned transfers into time slots.
+
+    Args:
+        - devices (list): fleet_plan.py device plans with status "transfer".
+        - sites (dict): From load_sites().
+        - repo_speeds (dict): From load_repo_speeds().
+        - default_repo_mbps (float): Link speed of repos not in repo_speeds.
+        - device_mbps (float): Transfer rate of a single device, if its
+                               plan has no rate ('mbps').
+        - slot_minutes (int): Slot length.
+
+    Returns:
+        tuple: (scheduled, unscheduled)
+            - scheduled (list): Dicts with SCHEDULE_FIELDS, by start time.
+            - unscheduled (list): (device plan, reason) tuples.
+    """
+    unscheduled = []
+    jobs = []
+    for plan in devices:
+        site = sites.get(plan.get('Site'))
+        if site is None:
+            unscheduled.append((plan, "NO_SITE_WINDOW"))
+            continue
+        jobs.append((plan, site))
+    if not jobs:
+        return ([], unscheduled)
+
+    slot = datetime.timedelta(minutes=slot_minutes)
+    epoch = min(site['start'] for _, site in jobs)
+    horizon = max(site['end'] for _, site in jobs)
+    num_slots = int(math.ceil((horizon - epoch) / slot))
+
+    site_caps = {}
+    repo_caps = {}
+
+    # Priority first, then earliest deadline, then longest job.
+    jobs.sort(key=lambda job: (-job[1]['priority'], job[1]['end'],
+                               -job[0]['bytes']))
+
+    scheduled = []
+    for plan, site in jobs:
+        repo_cap = repo_caps.get(plan['repo'])
+        if repo_cap is None:
+            repo_cap = repo_caps[plan['repo']] = SlotCapacity(
+                repo_speeds.get(plan['repo'], default_repo_mbps), num_slots
+            )
+        site_cap = site_caps.get(plan['Site'])
+        if site_cap is None:
+            site_cap = site_caps[plan['Site']] = SlotCapacity(
+                site['mbps'], num_slots
+            )
+
+        # fleet_plan.py --history gives each device its own rate.
+        mbps = min(plan.get('mbps') or device_mbps, site_cap.mbps,
+                   repo_cap.mbps)
+        seconds = plan['bytes'] * 8 / (mbps * 1e6)
+        length = max(1, int(math.ceil(seconds / slot.total_seconds())))
+        # Round up so a transfer never starts before its window opens.
+        first = int(math.ceil((site['start'] - epoch) / slot))
+        last = int((site['end'] - epoch) / slot) - length
+
+        start = first
+        placed = False
+        while start <= last:
+            # Skip past the latest conflicting slot of either link.
+            conflict = max(site_cap.first_conflict(start, length, mbps),
+                           repo_cap.first_conflict(start, length, mbps))
+            if conflict < 0:
+                placed = True
+                break
+            start = conflict + 1
+
+        if not placed:
+            reason = ("WINDOW_TOO_SHORT" if first > last
+                      else "NO_CAPACITY_IN_WINDOW")
+            unscheduled.append((plan, reason))
+            continue
+
+        site_cap.reserve(start, length, mbps)
+        repo_cap.reserve(start, length, mbps)
+        scheduled.append({
+            "Start": epoch + start * slot,
+            "End": epoch + (start + length) * slot,
+            "DeviceID": plan['DeviceID'],
+            "DeviceName": plan['DeviceName'],
+            "Site": plan['Site'],
+            "Repo": plan['repo'],
+            "Bytes": plan['bytes'],
+            "Mbps": mbps,
+            "Priority": site['priority']
+        })
+
+    scheduled.sort(key=lambda item: (item['Start'], -item['Priority']))
+    for order, item in enumerate(scheduled, start=1):
+        item['Order'] = order
+    return (scheduled, unscheduled)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Schedule fleet transfers inside maintenance windows."
+    )
+    parser.add_argument("-p", "--plan", required=True,
+                        help="Plan file from fleet_plan.py.")
+    parser.add_argument("-s", "--sites", required=True,
+                        help="Sites CSV with windows and link speeds.")
+    parser.add_argument("-r", "--repos",
+                        help="Repos CSV with link speeds.")
+    parser.add_argument("--repo-mbps", type=float, default=DEFAULT_REPO_MBPS,
+                        help="Link speed of repos not in --repos.")
+    parser.add_argument("--device-mbps", type=float,
+                        help="Transfer rate of the devices without a rate"
+                        " in the plan. Default is the rate the plan was"
+                        " built with.")
+    parser.add_argument("--date", default=datetime.date.today().isoformat(),
+                        help="Date for HH:MM windows (YYYY-MM-DD).")
+    parser.add_argument("--slot-minutes", type=int,
+                        default=DEFAULT_SLOT_MINUTES, help="Slot length.")
+    parser.add_argument("-o", "--output", default="schedule.csv",
+                        help="Schedule CSV to write.")
+    args = parser.parse_args(argv)
+
+    with open(args.plan, "r") as f:
+        plan = json.load(f)
+    date = datetime.date.fromisoformat(args.date)
+    sites = load_sites(args.sites, date)
+    devices = [item for item in plan['devices']
+               if item['status'] == "transfer"]
+
+    scheduled, unscheduled = build_schedule(
+        devices, sites, load_repo_speeds(args.repos), args.repo_mbps,
+        args.device_mbps or plan['device_mbps'], args.slot_minutes
+    )
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SCHEDULE_FIELDS)
+        writer.writeheader()
+        for item in scheduled:
+            row = dict(item)
+            row['Start'] = item['Start'].isoformat(timespec="minutes")
+            row['End'] = item['End'].isoformat(timespec="minutes")
+            writer.writerow(row)
+
+    print(f"Scheduled {len(scheduled)} of {len(devices)} transfers.")
+    reasons = {}
+    for _, reason in unscheduled:
+        reasons[reason] = reasons.get(reason, 0) + 1
+    for reason, count in sorted(reasons.items()):
+        print(f"  Unscheduled ({reason}): {count}")
+    return 0 if not unscheduled else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -32,6 +32,13 @@
 #nxos_use_mgmt_vrf = "on"
 #dry_run = "on"
 #enable_debug = "on"
+#enable_profiling = "on"
+#iosxe_prestage_install = "on"
+#prestage_boot_vars = "on"
+#use_target_rules = "on"
+#record_cassette = "on"
+#use_transfer_history = "on"
+#tune_http_client = "on"
 #------------------------------------------------------------------------------
 # NetMRI Cisco OS Software Transfer
 # na_ciscoswtransfer.py
@@ -73,7 +80,8 @@
 #   5. Regional repo list imported in to NetMRI.
 #      (It is possible to just select "Override Automatic Repo Selection", and
 #       then provide an ad-hoc repo)
-#   6. CLI credentials must have have sufficient AAA command authorization:
+#   6. Target rules list imported in to NetMRI, for 'use_target_rules' only.
+#   7. CLI credentials must have have sufficient AAA command authorization:
 #       - show *
 #       - dir *
 #       - changeto *
@@ -83,25 +91,104 @@
 #       - verify *
 #       - request software *
 #       - configure terminal
+#       - boot system * (prestage_boot_vars)
+#       - show install all impact * (prestage_boot_vars)
+#       - install add * (iosxe_prestage_install)
 #       - write memory
 #       - NOTE:... what else?
 #
 # NOTES:
-#   1. The software hash list must only contain ONE filename, per-platform,
-#      to match the target upgrade file. (NX-OS kickstart is exception)
+#   1. The software hash list must only contain ONE system image filename,
+#      per-platform, to match the target upgrade file (or more, selected by
+#      target rules, see 13). A platform can also have other files, with an
+#      optional 'Role' column (kickstart, rommon, asdm, or smu, see
+#      CiscoDevice.MANIFEST_ROLES), and an optional 'Platform' column for
+#      filenames that don't start with the platform (e.g: asdm-7181.bin is
+#      for "asa"). NX-OS kickstart images are also recognized by name. All
+#      the files of a platform (its manifest) get one combined free space
+#      check, and are transferred back to back, in role order, in the same
+#      session.
 #   2. This script transfers only to the default file system for the device. It
 #      will warn you if the current running image is not on the default file
 #      system, but it will transfer the target upgrade to the default fs.
 #   3. It's recommended to have 'ip tcp path-mtu-discovery' configured on the
-#      device.
+#      device (or turn on 'tune_http_client', see 16).
 #   4. If the repos all have the same directory path, you can change the
 #      default value for 'repo_directory_path' in the CCS script section below.
+#   5. Progress is checkpointed per device in LOCAL_STATE_DIR. If a job dies
+#      mid-way (e.g: Script-Timeout), running it again resumes at the first
+#      incomplete stage, instead of starting over from discovery.
+#   6. Log messages are batched (see EventLog.py), so the custom log is
+#      updated in chunks, and right before each long running copy/verify.
+#      Every message is also kept as a JSON line, with the job phase, bytes,
+#      duration and error code, in LOCAL_STATE_DIR/events.
+#   7. Transfer/verify/phase metrics for all jobs are merged in to one
+#      Prometheus textfile, in LOCAL_STATE_DIR/metrics (see JobMetrics.py).
+#   8. Each job writes a trace of nested spans (device discovery, hash list
+#      lookup, cleanup, transfer, verify, stack copies) to
+#      LOCAL_STATE_DIR/traces, as OTLP/JSON (see JobTrace.py).
+#   9. 'enable_profiling' runs the job under cProfile and tracemalloc, and
+#      writes the profile to LOCAL_STATE_DIR/profiles. It slows the job
+#      down, so only turn it on for a few devices at a time.
+#   10. Before any CLI, the DeviceVersion from inventory is compared to the
+#       version of the target image in the hash list (parsed from the
+#       filename, see CiscoDevice.get_image_version()). Devices already on
+#       the target version end there, without opening a CLI session.
+#       fleet_plan.py reports the same devices as "current".
+#   11. 'iosxe_prestage_install' runs 'install add file' on IOS-XE devices in
+#       INSTALL mode, once the image is verified (and copied to the stack
+#       members). The packages are expanded and staged ahead of the
+#       maintenance window, which then only needs 'install activate' and
+#       'install commit'. The free space for the expanded packages is
+#       checked first (INSTALL_EXPAND_RATIO times the image size), and the
+#       image file is deleted once the packages are added.
+#   12. 'prestage_boot_vars' sets the boot images of IOS, IOS-XE (BUNDLE
+#       mode) and ASA once the target is verified: the target first, the
+#       running image as the fallback. The config is saved only if every
+#       boot command went through. On NX-OS, 'show install all impact' is
+#       run with the target system (and kickstart) image instead, and the
+#       job fails if any module isn't bootable. The results are kept in the
+#       checkpoint ('boot_staged' stage).
+#   13. 'use_target_rules' selects the target system image with the rules of
+#       the "Cisco OS SW Target Rules" list, by platform, model, running
+#       version range, network view and device group, instead of the first
+#       one of the platform in the hash list (see CiscoDevice.TargetRules).
+#       Devices no rule matches still get the platform's first one. The
+#       device groups are only looked up if a rule uses them.
+#   14. 'record_cassette' records the whole session (every command and its
+#       output and timing, broker calls, device fields, and the job settings)
+#       to a cassette in LOCAL_STATE_DIR/cassettes (see JobCassette.py).
+#       replay_job.py runs main() against cassettes, without NetMRI or the
+#       device. Cassettes hold the device's CLI output, in clear text.
+#   15. Every transfer and integrity check (result, bytes, duration, attempt,
+#       error code) is recorded in LOCAL_STATE_DIR/history.sqlite (see
+#       TransferHistory.py, and transfer_history.py for the reports). With
+#       'use_transfer_history', the history is also used: the copy and
+#       verify timeouts are sized from the slowest throughput seen for the
+#       repo and platform (instead of TRANSFER_TIMEOUT/VERIFY_TIMEOUT), and
+#       if the region and network view have more than one repo, the fastest
+#       one is selected. Repos with too little history are selected first,
+#       so they get some.
+#   16. With 'tune_http_client', IOS and IOS-XE devices get a larger TCP
+#       window ('ip tcp window-size', HTTP_TCP_WINDOW_SIZE), path MTU
+#       discovery, and an HTTP client source interface (the active interface
+#       with the management address, or else a loopback) for the copies. It
+#       is only in the running config, and is reverted after the copies,
+#       even if they failed. A job that dies before reverting it leaves the
+#       revert commands in its checkpoint, for the next run. Tuned copies
+#       are marked in the transfer history, to compare their throughput
+#       (transfer_history.py --by tuned).
 #
 # LIMITATIONS:
-#   1. This does not automate the actual upgrade process (yet!)
+#   1. This does not automate the actual upgrade process (yet!). With
+#      'prestage_boot_vars', it stops right before it: the boot images are
+#      set (or the NX-OS install impact is checked), and the window is only
+#      a reload (or 'install all').
 #   2. This does not check if the target upgrade image is actually a downgrade.
-#   3. This does not transfer an ASDM image to ASA.
-#   4. This does not transfer ROMMON upgrades.
+#   3. This does not install an ASDM image on ASA. (It is transferred if
+#      it's in the hash list, with the 'asdm' Role.)
+#   4. This does not upgrade ROMMON. (ROMMON files are transferred if
+#      they're in the hash list, with the 'rommon' Role.)
 #   5. Since this script does not delete the current running image during
 #      space reclamation, it will fail for devices that can only store one
 #      image on the fs at a time (e.g: old 3560, 2960, etc.)
@@ -144,9 +231,27 @@
 # https://community.cisco.com/t5/server-networking/what-does-nexus-1000v-version-number-say/m-p/2909762#M11124
 # https://www.cisco.com/c/en/us/td/docs/security/asa/upgrade/asa-upgrade/planning.html#ID-2152-0000008d
 #------------------------------------------------------------------------------
+import cProfile
+import functools
+import json
+import os
+import pstats
 import re
+import sqlite3
+import time
+import tracemalloc
 from infoblox_netmri.easy import NetMRIEasy
-from CiscoDevice import CiscoDevice
+from CiscoDevice import CiscoDevice, prefilter_current
+from CiscoDevice import OS_ROLES, get_manifest_file, match_manifest
+from CiscoDevice import TargetRules
+from CiscoDevice import RETRY_TRANSFER_CODES, get_ccs_transfer_status
+from CiscoDevice import INSTALL_EXPAND_RATIO, INSTALL_IMPACT_LINES
+from CiscoDevice import TailBuffer, get_transfer_error
+from EventLog import EventLog
+from JobCassette import CassetteRecorder
+from JobMetrics import JobMetrics
+from JobTrace import JobTrace
+from TransferHistory import TransferHistory, KIND_TRANSFER, KIND_VERIFY
 #------------------------------------------------------------------------------
 # BEGIN-SCRIPT-BLOCK
 #
@@ -169,9 +274,94 @@ from CiscoDevice import CiscoDevice
 #       $nxos_use_mgmt_vrf boolean
 #       $dry_run boolean
 #       $enable_debug boolean
+#       $enable_profiling boolean
+#       $iosxe_prestage_install boolean
+#       $prestage_boot_vars boolean
+#       $use_target_rules boolean
+#       $record_cassette boolean
+#       $use_transfer_history boolean
+#       $tune_http_client boolean
 #
 # END-SCRIPT-BLOCK
 #------------------------------------------------------------------------------
+# Local directory for state this job keeps between runs, on the appliance.
+# (e.g: device facts cache, read by fleet_plan.py)
+LOCAL_STATE_DIR = "/tmp/na_ciscoswtransfer"
+# Checkpoints older than this (in seconds) are ignored, and the job starts
+# over from discovery.
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+CHECKPOINT_VERSION = 1
+# Prometheus textfile metrics, merged across all jobs.
+METRICS_DIR = os.path.join(LOCAL_STATE_DIR, "metrics")
+METRICS_FILE = "na_ciscoswtransfer.prom"
+METRICS_PREFIX = "ciscoswtransfer_"
+METRICS_HELP = {
+    "ciscoswtransfer_jobs_total": "Jobs run, by result.",
+    "ciscoswtransfer_prefiltered_total": "Jobs skipped before any CLI,"
+                                         " already running the target"
+                                         " version.",
+    "ciscoswtransfer_transfer_bytes_total": "Bytes of images transferred.",
+    "ciscoswtransfer_transfers_total": "Image transfers, by result.",
+    "ciscoswtransfer_transfer_errors_total": "Failed transfers, by error"
+                                             " code.",
+    "ciscoswtransfer_transfer_retries_total": "Transfer retries, by error"
+                                              " code.",
+    "ciscoswtransfer_transfer_duration_seconds": "Image transfer duration.",
+    "ciscoswtransfer_verify_duration_seconds": "Integrity check duration.",
+    "ciscoswtransfer_prestage_total": "IOS-XE 'install add' pre-stages, by"
+                                      " result.",
+    "ciscoswtransfer_boot_stage_total": "Boot config / install impact"
+                                        " pre-stages, by result.",
+    "ciscoswtransfer_http_tuning_total": "HTTP client tunings and reverts,"
+                                         " by result.",
+    "ciscoswtransfer_phase_duration_seconds": "Job phase duration."
+}
+# Per-job traces (OTLP/JSON), one file per job.
+TRACES_DIR = os.path.join(LOCAL_STATE_DIR, "traces")
+# Profiles, when enable_profiling is on.
+PROFILES_DIR = os.path.join(LOCAL_STATE_DIR, "profiles")
+PROFILE_TOP = 30            # Functions/allocation sites in the report
+PROFILE_MALLOC_FRAMES = 8   # Stack depth kept per allocation
+# Copy and integrity check timeouts, in seconds.
+TRANSFER_TIMEOUT = 15300
+VERIFY_TIMEOUT = 1200
+# Transfer history, shared by all jobs.
+HISTORY_FILE = os.path.join(LOCAL_STATE_DIR, "history.sqlite")
+HISTORY_DAYS = 30           # Only the history this recent is used
+# Timeouts sized from the history: the time at this throughput percentile,
+# times the margin, within the bounds (seconds).
+HISTORY_TIMEOUT_PCT = 5
+HISTORY_TIMEOUT_MARGIN = 2
+HISTORY_TIMEOUT_BOUNDS = (600, 43200)
+# TCP window for the tuned HTTP client copies ('tune_http_client'), in bytes.
+# Older IOS only takes up to 65535. The window is then left as it is.
+HTTP_TCP_WINDOW_SIZE = 131072
+# 'install add' timeout, in seconds. Expanding takes 10-20 minutes.
+INSTALL_ADD_TIMEOUT = 3600
+# 'show install all impact' timeout, in seconds. It unpacks the images.
+INSTALL_IMPACT_TIMEOUT = 1800
+# Session cassettes, when record_cassette is on. One file per job.
+CASSETTES_DIR = os.path.join(LOCAL_STATE_DIR, "cassettes")
+# Globals main() reads, once __main__ has converted the Script-Variables.
+# Saved in cassettes, so replay_job.py runs main() with the same settings.
+JOB_SETTINGS = ("job_id", "device_id", "batch_id", "hash_list",
+                "repo_region", "ovr_repo", "repo_host_override",
+                "repo_directory_path", "max_retries", "reclaim",
+                "clean_old_images", "nxos_use_mgmt_vrf", "dry_run",
+                "enable_debug", "enable_profiling", "iosxe_prestage_install",
+                "prestage_boot_vars", "use_target_rules",
+                "use_transfer_history", "tune_http_client")
+#------------------------------------------------------------------------------
+def traced(func):
+    """Decorator. Run the function inside a tracing span of the same name."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@traced
 def get_list_id(nmri, list_name):
     """Search for a NetMRI list by name and return the ID
     
@@ -196,62 +386,149 @@ def get_list_id(nmri, list_name):
     raise Exception(err)
 
 
-def get_upgrade_file_info(nmri, device, list_id, kickstart=False):
-    """Get the filename, size, and hashes of the target upgrade file
+@traced
+def get_list_rows(nmri, list_id):
+    """Get the rows of a NetMRI list.
+
+    Args:
+        - nmri: NetMRIEasy class reference.
+        - list_id: ID integer of the NetMRI list.
+
+    Returns:
+        List of the row dictionaries.
+    """
+    broker = nmri.broker("ConfigList")
+    return broker.search_rows(id=list_id)['list_rows']
+
+
+@traced
+def get_target_rules(nmri, hash_rows):
+    """Compile the rules of the "Cisco OS SW Target Rules" list.
+
+    Args:
+        - nmri: NetMRIEasy class reference.
+        - hash_rows: Hash list rows the rules select from.
+
+    Returns:
+        CiscoDevice.TargetRules
+
+    Raises:
+        Exception if the list does not exist.
+        ValueError if a rule is invalid.
+    """
+    #TODO: Make the list a UI variable
+    list_id = get_list_id(nmri, "Cisco OS SW Target Rules")
+    try:
+        rules = TargetRules(get_list_rows(nmri, list_id), hash_rows)
+    except ValueError as err:
+        nmri.log_message("error", f"{' '*2}{err}")
+        raise
+    nmri.log_message("info", f"{' '*2}Loaded {rules.count} target rules.")
+    return rules
+
+
+@traced
+def get_device_groups(nmri, device):
+    """Get the names of the device groups the device is a member of.
+
+    Args:
+        - nmri: NetMRIEasy class reference.
+        - device: CiscoDevice class reference.
+
+    Returns:
+        List of the group names.
+    """
+    broker = nmri.broker("DeviceGroupMember")
+    members = broker.index(DeviceID=device.device.DeviceID,
+                           select=["GroupID"])
+    group_ids = {item.GroupID for item in members}
+    if not group_ids:
+        return []
+    broker = nmri.broker("DeviceGroup")
+    return [item.GroupName
+            for item in broker.index(select=["GroupID", "GroupName"])
+            if item.GroupID in group_ids]
+
+
+@traced
+def prefilter_device(nmri, device, hash_rows, rules=None, groups=()):
+    """Check if the device already runs the target version, without CLI.
+
+    Only the DeviceRemote fields (sysDescr, model, version) are compared to
+    the hash list. See CiscoDevice.prefilter_current().
+
+    Args:
+        - nmri: NetMRIEasy class reference.
+        - device: CiscoDevice class reference.
+        - hash_rows: Hash list rows.
+        - rules: CiscoDevice.TargetRules, or None. Default is None.
+        - groups: Device group names, for the rules. Default is ().
+
+    Returns:
+        The target filename if the device is current, None otherwise.
+    """
+    row = {
+        "DeviceID": device.device.DeviceID,
+        "DeviceSysDescr": device.device.DeviceSysDescr,
+        "DeviceModel": device.model,
+        "DeviceVersion": device.version,
+        "Network View": device.device.virtual_network.VirtualNetworkName,
+        "Device Groups": ",".join(groups)
+    }
+    return prefilter_current([row], hash_rows,
+                             rules=rules).get(row['DeviceID'])
+
+
+@traced
+def get_upgrade_manifest(nmri, device, list_id, rows=None, rules=None,
+                         groups=()):
+    """Search the hash list for the target manifest of the device: the
+    system image, and the other files of its platform (NX-OS kickstart,
+    ROMMON, ASDM, SMUs). See CiscoDevice.match_manifest().
 
     Args:
         - nmri: NetMRIEasy class reference.
         - device: CiscoDevice class reference.
         - list_id: ID integer of the NetMRI list to search.
-        - kickstart: True returns NX-OS kickstart image. Default is false.
+        - rows: Rows of the list, if already fetched. Default is None.
+        - rules: CiscoDevice.TargetRules, to select the system image. The
+                 platform's first one is used if no rule matches. Default is
+                 None.
+        - groups: Device group names, for the rules. Default is ().
 
     Returns:
-        Dictionary of the first match, from the hash list.
+        list: Hash list rows, in transfer order, with 'Role' set. The system
+              image is first.
 
     Raises:
-        Exception if nothing was found.
+        Exception if the system image (or a needed kickstart) wasn't found.
     """
     platform = device.platform
-    broker = nmri.broker("ConfigList")
-    response = broker.search_rows(id=list_id)
-    for item in response['list_rows']:
-        # 2023.05.25 - aensminger - Add generator, so we match
-        # "c800-" to c800-univeralk9-mz.xxx-x.xx.bin,
-        # instead of c800 getting matched with c8000aep-universalk9...
-        if (device.os != "ASA" and
-            any(item['Filename'].startswith(plat)
-                for plat in (platform + '-', platform + '_', platform + '.'))):
-            # Remove commas and store size as integer.
-            item['Size'] = int(item['Size'].replace(",", ""))
-
-            # Return the kickstart image for NX-OS
-            if kickstart and "kickstart" in item['Filename']:
-                return item
-
-            # Return the match
-            if not kickstart:
-                return item
-
-        # ASA does not have delimiter between the platform and version.
-        # So we have to put it's own handling here.
-        if device.os == "ASA" and item['Filename'].startswith(platform):
-            # Remove commas and store size as integer.
-            item['Size'] = int(item['Size'].replace(",", ""))
-
-            # Return appropriate item for ASA.
-            # 5506-X, 5508-X, 5516-X.
-            if device.asa_is_lfbff and "lfbff" in item['Filename']:
-                return item
-
-            # 5512-X, 5515-X, 5525-X, 5545-X, 5555-X, 5585-X, ASAv
-            if device.asa_is_smp and "smp" in item['Filename']:
-                return item
-
-            # Legacy ASA.
-            return item
+    if rows is None:
+        rows = get_list_rows(nmri, list_id)
+    kickstart = device.os == "NX-OS" and bool(device.nxos_kickstart_image)
+    system = None
+    if rules:
+        system = rules.resolve(
+            device.os, platform, device.model, device.version,
+            device.device.virtual_network.VirtualNetworkName, groups
+        )
+        if system:
+            nmri.log_message("info", f"{' '*2}Target rule selected:"
+                             f" {system['Filename']}")
+        else:
+            nmri.log_message("info", f"{' '*2}No target rule matched. Using"
+                             " the first image of the platform.")
+    manifest = match_manifest(rows, device.os, platform, device.asa_is_lfbff,
+                              device.asa_is_smp, kickstart, system)
+    if not manifest:
+        err = f'Unable to find target image for platform "{platform}"'
+    elif kickstart and not get_manifest_file(manifest, "kickstart"):
+        err = f'Unable to find kickstart image for platform "{platform}"'
+    else:
+        return manifest
 
     # No match, raise exception.
-    err = f'Unable to find target image for platform "{platform}"'
     nmri.log_message("error", f"- {err}")
     raise Exception(err)
 
@@ -288,208 +565,153 @@ def validate_fs_space_available(nmri, size, fs_dict):
     return fs_validation_failed
 
 
-def get_repo_info(list_id, region, network_view):
+def get_repo_info(list_id, region, network_view, platform=None):
     """Reads Cisco OS SW Regional Repos and returns the repo information
     
     Args:
         - list_id: The list ID of the Cisco OS SW Regional Repos list.
         - region: The region from the Cisco OS SW Regional Repos list.
         - network_view: Network View. Passed from DeviceRemote.network_name
+        - platform: Device platform, to rank the repos with the transfer
+                    history ('use_transfer_history').
 
     Returns:
         str: The address of the repo which network view and region matches.
+             The first one, unless ranked by the transfer history.
 
     Raises:
         Exception if no repo found.
     """
     broker = nmri.broker("ConfigList")
     response = broker.search_rows(id=list_id)
-    for item in response['list_rows']:
-        if item['Region'] == region and item['Network View'] == network_view:
-            nmri.log_message("info",
-                             f"{' '*2}Selected repo: {item['Address']}")
-            return item['Address']
+    addresses = [item['Address'] for item in response['list_rows']
+                 if item['Region'] == region
+                 and item['Network View'] == network_view]
+    if len(addresses) > 1 and use_transfer_history and history:
+        addresses = rank_repos(addresses, platform)
+    if addresses:
+        nmri.log_message("info", f"{' '*2}Selected repo: {addresses[0]}")
+        return addresses[0]
     # No match, raise exception.
     err = f'Unable to find repo for region "{region}", view {network_view}'
     nmri.log_message("error", f"{' '*2}{err}")
     raise Exception(err)
 
 
-def remove_old_images(nmri, device, fs_list):
+def history_since():
+    return time.time() - HISTORY_DAYS * 24 * 3600
+
+
+def rank_repos(addresses, platform=None):
+    """Order repos by their median throughput in the transfer history,
+    fastest first. Repos with too little history go first, in list order.
+
+    Args:
+        - addresses (list): Repo addresses.
+        - platform (str): Rank by the transfers of this platform, if there's
+                          enough of them.
+    """
+    rates = {}
+    for addr in addresses:
+        try:
+            rates[addr] = (history.rate(50, KIND_TRANSFER, history_since(),
+                                        fallback=False, repo=addr,
+                                        platform=platform)
+                           or history.rate(50, KIND_TRANSFER,
+                                           history_since(), fallback=False,
+                                           repo=addr))
+        except sqlite3.Error as err:
+            nmri.log_message("warn", f"{' '*2}Unable to read the transfer"
+                             f" history: {err}")
+            return addresses
+        nmri.log_message("info", f"{' '*2}Repo {addr}: median"
+                         f" {rates[addr] or 'unknown'} Mbps")
+    # sorted() is stable, so unknown repos keep their list order.
+    return sorted(addresses, key=lambda addr: (rates[addr] is not None,
+                                               -(rates[addr] or 0)))
+
+
+def history_timeout(kind, size, default, **where):
+    """Timeout for a copy or integrity check of 'size' bytes.
+
+    With 'use_transfer_history', it's sized from the slow end of the
+    throughput history of the same kind (see TransferHistory.rate(), for
+    'where'). Otherwise, or without enough history, it's 'default'.
+    """
+    if not (use_transfer_history and history):
+        return default
+    try:
+        mbps = history.rate(HISTORY_TIMEOUT_PCT, kind, history_since(),
+                            **where)
+    except sqlite3.Error as err:
+        nmri.log_message("warn", f"{' '*2}Unable to read the transfer"
+                         f" history: {err}")
+        return default
+    if not mbps:
+        return default
+    low, high = HISTORY_TIMEOUT_BOUNDS
+    timeout = int(min(max(size * 8 / (mbps * 1e6) * HISTORY_TIMEOUT_MARGIN,
+                          low), high))
+    nmri.log_message("info", f"{' '*2}Timeout: {timeout}s (p"
+                     f"{HISTORY_TIMEOUT_PCT} {mbps} Mbps in the history)")
+    return timeout
+
+
+def record_history(kind, device, f_info, duration, result, code=None,
+                   attempt=0, repo=None, tuned=False):
+    """Record a copy or integrity check in the transfer history. A history
+    that can't be written is only a warning."""
+    if history is None:
+        return
+    try:
+        history.record(kind, result, duration, f_info['Size'], code, attempt,
+                       tuned, job_id=job_id, device_id=device_id,
+                       device_name=device.hostname, os=device.os,
+                       platform=device.platform, repo=repo,
+                       file=f_info['Filename'])
+    except sqlite3.Error as err:
+        nmri.log_message("warn", f"{' '*2}Unable to write the transfer"
+                         f" history: {err}")
+
+
+@traced
+def remove_old_images(nmri, device, fs_list, keep=()):
     """Deletes all old images, except the current running image,
     on the specified file system
 
-    NOTE: The running image filename from "show version" output gets truncated
-    on some Cisco devices. This func uses .startswith() to avoid that problem.
-
     Args:
         - nmri: NetMRIEasy class reference.
         - device: CiscoDevice class reference.        
         - fs: List of file system(s) to delete from.
+        - keep: Filenames to never delete (e.g: the target manifest).
     """
-    # Initialize list for found files to delete.
-    image_list = []
-
-    if device.iosxe_boot_mode == "INSTALL":
-        # Similiar to 'install remove inactive', except there's no 30-minute
-        # delay for command output, and we don't remove .conf files.
-        for fs_name in fs_list:
-            nmri.log_message(
-                "info",
-                f"{' '*2}Enumerating old images/inactive packages from"
-                f" {fs_name}:"
-            )
-            # Set extension map.
-            ftype_map = {
-                ".pkg": "inactive package",
-                ".bin": "old image"
-            }
-            # Prepare command
-            cmd = (
-                f"dir {fs_name}:/{device.platform}* | include \.bin|\.pkg"
-            )
-            # Send it and parse output
-            raw_output = device.dis.send_command(cmd)
-            for line in raw_output.splitlines():
-                # Group 1 is the filename: cat9k-rpboot.16.12.03a.SPA.pkg
-                # Group 2 is the build: 16.12.03a
-                match = re.search(
-                    fr'.*(?<=\s)({device.platform}\S+\.(\d+\.\d+\.\d+[a-zA-Z]?'
-                    ')\..*)', line
-                )
-                if match:
-                    file = match.group(1)
-                    build = match.group(2)
-                    ftype = ftype_map.get(file[file.rfind("."):], "unknown")
-                    # Don't include the current running package
-                    if build != device.iosxe_build:
-                        nmri.log_message(
-                            "info",
-                            f"{' '*4}Found {ftype}: {fs_name}:/{file}"
-                        )
-                        image_list.append(file)
-
-            # Delete old images from the list
-            if len(image_list) > 0:
-                nmri.log_message(
-                    "info",
-                    f"{' '*6}Deleting {len(image_list)} old images/"
-                    f"inactive packages from {fs_name}:"
-                )
-                for i, image in enumerate(image_list, start=1):
-                    nmri.log_message(
-                        "info",
-                        f"{' '*8}({i}/{len(image_list)})"
-                        f" Deleting {fs_name}:/{image}"
-                    )
-                    cmd = f"delete /force /recursive {fs_name}:/{image}"
-                    if dry_run:
-                        nmri.log_message("info", f"dry_run send_command: {cmd}")
-                    else:
-                        device.dis.send_command(cmd)
-            else:
-                nmri.log_message(
-                    "info", f"{' '*4}No old images/inactive packages"
-                    f" found in {fs_name}:"
-                )
-        return
-
-    if device.os == "NX-OS":
-        nmri.log_message("info", f"{' '*2}Enumerating old images from"
-                         f" {device.system_fs}")
-        
-        # Search for kickstart images, if this NX-OS has kickstart.
-        if device.nxos_kickstart_image is not None:
-            nmri.log_message("info", f"{' '*2}Enumerating old kickstart images"
-                             f" from {device.system_fs}:")
-            cmd = (f"dir {device.system_fs}: |"
-                   f"include {device.platform}.*\.bin$ | include kickstart")
-            raw_output = device.dis.send_command(cmd)
-            for line in raw_output.splitlines():
-                match = re.search(r'(?:.*\/|.*(?<=\s)(\S+))', line)
-                file = match.group(1) if match else None
-                if not file.startswith(device.nxos_kickstart_image):
-                    nmri.log_message("info", f"{' '*4}Found old kickstart"
-                                    f" image: {device.system_fs}:/{file}")
-                    image_list.append(file)
-
-        # Search for old images that are not kickstart.
-        cmd = (f"dir {device.system_fs}: | include {device.platform}.*\.bin$ |"
-               " exclude kickstart")
-        raw_output = device.dis.send_command(cmd)
-        for line in raw_output.splitlines():
-            match = re.search(r'(?:.*\/|.*(?<=\s)(\S+))', line)
-            file = match.group(1) if match else None
-            if not file.startswith(device.current_system_image):
-                nmri.log_message("info", f"{' '*4}Found old image:"
-                                f" {device.system_fs}:/{file}")
-                image_list.append(file)
-        # Delete old images from the list
-        if len(image_list) > 0:
-            nmri.log_message("info",
-                             f"{' '*6} Deleting {len(image_list)}"
-                             f" old images from {device.system_fs}:")
-            for i, image in enumerate(image_list, start=1):
-                nmri.log_message("info", 
-                                 f"{' '*8}({i}/{len(image_list)})"
-                                 f" Deleting {device.system_fs}:/{image}")
-                cmd = f"delete {device.system_fs}:/{image} no-prompt"
-                if dry_run:
-                    nmri.log_message("info", f"dry_run send_command: {cmd}")
-                else:
-                    device.dis.send_command(cmd)
-        else:
-            nmri.log_message("info",
-                             f"{' '*4} No old images found in"
-                             f" {device.system_fs}:")
+    nmri.log_message("info", f"{' '*2}Enumerating old images from"
+                     f" {', '.join(f'{fs}:' for fs in fs_list)}")
+    # See CiscoDevice.get_old_images() for what is considered old.
+    image_list = [item for item in device.get_old_images(fs_list)
+                  if item[1] not in keep]
+    if not image_list:
+        nmri.log_message("info", f"{' '*4}No old images found.")
         return
 
-    # ASA/IOS/IOS-XE device
-    if device.os == "ASA":
-        # ASA does not allow you to pipe 'dir' output.
-        cmdpfx = "show"
-        delargs = "/noconfirm /recursive"
-    else:
-        # IOS/IOS-XE/NX-OS allow dir to be piped.
-        cmdpfx = "dir"
-        delargs = "/force /recursive"
-    
-    for fs_name in fs_list:
-        nmri.log_message("info",
-                         f"{' '*2} Enumerating old images from {fs_name}:")
-        cmd = (f"{cmdpfx} {fs_name}: | include {device.platform}"
-               ".*(\.SPA$|\.bin$)") #make sure we only match .SPA or .bin
-        raw_output = device.dis.send_command(cmd)
-        for line in raw_output.splitlines():
-            match = re.search(fr'.*(?<=\s)({device.platform}\S+)',line)
-            file = match.group(1) if match else None
-            # Don't include the current running image
-            if not file.startswith(device.current_system_image):
-                nmri.log_message("info",
-                                    f"{' '*4} Found old image:"
-                                    f"{fs_name}:/{file}")
-                image_list.append(file)
-        # Delete old images from the list
-        if len(image_list) > 0:
-            nmri.log_message("info", f"{' '*6}Deleting {len(image_list)}"
-                            f" old images from {fs_name}:")
-            for i, image in enumerate(image_list, start=1):
-                nmri.log_message("info",
-                                 f"{' '*8}({i}/{len(image_list)})"
-                                 f" Deleting {fs_name}:/{image}"
-                )
-                cmd = f"delete {delargs} {fs_name}:/{image}"
-                if dry_run:
-                    nmri.log_message("info", f"dry_run send_command: {cmd}")
-                else:
-                    device.dis.send_command(cmd)
+    for fs_name, image, kind in image_list:
+        nmri.log_message("info", f"{' '*4}Found {kind}: {fs_name}:/{image}")
+    # Delete old images from the list
+    nmri.log_message("info", f"{' '*6}Deleting {len(image_list)} old"
+                     " images:")
+    for i, (fs_name, image, _) in enumerate(image_list, start=1):
+        nmri.log_message("info", f"{' '*8}({i}/{len(image_list)})"
+                         f" Deleting {fs_name}:/{image}")
+        cmd = device.get_delete_command(fs_name, image, recursive=True)
+        if dry_run:
+            nmri.log_message("info", f"dry_run send_command: {cmd}")
         else:
-            nmri.log_message("info",
-                             f"{' '*4} No old images found in {fs_name}:")
-    return
+            device.dis.send_command(cmd)
 
 
-def transfer_upgrade_image(nmri, repo_addr, image, device):
+@traced
+def transfer_upgrade_image(nmri, repo_addr, image, device, attempt=0,
+                           tuned=False):
     """Copies the target upgrade image from the regional repo to the device.
     
     Transfer protocol is http.   
@@ -499,6 +721,8 @@ def transfer_upgrade_image(nmri, repo_addr, image, device):
         - repo_addr: The repo address.
         - image: The dict from upgrade_file_info().
         - device: CiscoDevice class reference.
+        - attempt: 0 for the first try, then 1 per retry. (For the history)
+        - tuned: The HTTP client is tuned. (For the history)
 
     Raises:
         Exception if failure.
@@ -511,156 +735,54 @@ def transfer_upgrade_image(nmri, repo_addr, image, device):
             - 0xff : API error
     """
     proto="http" # TODO: Make this optional argument
+    span = tracer.current()
+    span.set_attribute("repo", repo_addr)
+    span.set_attribute("file", image['Filename'])
+    span.set_attribute("bytes", image['Size'])
 
     # Set up the copy command.
-    if device.os == "ASA":
-        # ASA does not handle broken pipe. It will save what was
-        # downloaded so far, not give any error, and appear to succeed.
-        # It'll get sorted out when get_file_size_info() method is called.
-        copy_cmd = (f"copy /noconfirm {proto}://{repo_addr}"
-                    f"{repo_directory_path}/{image['Filename']}"
-                    f" {device.system_fs}:/{image['Filename']}")
-
-    elif device.os == "NX-OS":
-        # Nexus uses cURL (curl -O -f {host}).
-        copy_cmd = (f"copy {proto}://{repo_addr}{repo_directory_path}/"
-                    f"{image['Filename']} {device.system_fs}"
-                    f":/{image['Filename']} vrf ")
-        # UI option to use management VRF for NX-OS
-        if nxos_use_mgmt_vrf:
-            copy_cmd = copy_cmd + "management"
-        else:
-            copy_cmd = copy_cmd + "default"
-
-
-    else:
-        # This is for IOS/IOS-XE:
-        copy_cmd = (f"copy {proto}://{repo_addr}{repo_directory_path}/"
-                    f"{image['Filename']} {device.system_fs}"
-                    f":/{image['Filename']}\r\r\r")
-                    #Append carriage return to account addl. prompts.
+    # UI option to use management VRF for NX-OS
+    copy_cmd = device.get_copy_command(
+        f"{proto}://{repo_addr}{repo_directory_path}/{image['Filename']}",
+        image['Filename'], "management" if nxos_use_mgmt_vrf else "default"
+    )
     
     # Start transfer
     nmri.log_message("info",
                      f"{' '*2}Starting transfer. Waiting for return prompt"
                      " (See Session Log tab for progress) ...")
-    ex = None
+    # Send what's buffered, before blocking on the transfer.
+    nmri.flush()
+    started = time.monotonic()
     try:
         if dry_run:
-            raw_output = "\nDRY RUN"
             nmri.log_message("info", f"dry_run send_async_command: {copy_cmd}")
             return
-        else:
-            # USE BLANK REGEX FOR POS ARG 3, OTHERWISE YOU WILL SEE RED..
-            raw_output = device.dis.send_async_command(copy_cmd, 15300, "")
-        raw_output = raw_output.splitlines()
-        # Get the last line of output (transfer status)
-        xfr_status = raw_output[-1]
-        # Sometimes we get the hostname prompt as the last line, or last x
-        # amount of lines.
-        # e.g: raw_output=['!!!!','1234 bytes copied...','hostname#']
-        # Search for the last line, that is not the device prompt. This
-        # contains the status.
-        if (xfr_status.startswith(device.hostname.split('.')[0])
-                and xfr_status.endswith('#')):
-            for line in reversed(raw_output[:-1]):
-                if not line.startswith(device.hostname.split('.')[0]):
-                    xfr_status = line
-                    break
-        # Should have grabbed it.
+        # USE BLANK REGEX FOR POS ARG 3, OTHERWISE YOU WILL SEE RED..
+        # Only the tail of the output is kept. Hours of progress marks can
+        # be megabytes.
+        timeout = history_timeout(KIND_TRANSFER, image['Size'],
+                                  TRANSFER_TIMEOUT, repo=repo_addr,
+                                  platform=device.platform)
+        raw_output = TailBuffer.of(
+            device.dis.send_async_command(copy_cmd, timeout, "")
+        )
+        xfr_status = device.get_transfer_status(raw_output)
         if enable_debug:
-            nmri.log_message("debug", f"raw_output={raw_output}\n"
+            nmri.log_message("debug", f"raw_output={raw_output.summary()}\n"
                              f"xfr_status={xfr_status}")
     # Handle CCS error on our own.
     except Exception as ccs_error:
-        ccs_err_info = ccs_error.args[0]
-        # IOS/IOS-XE/ASA/NX-OS 0x7f Host unresponsive, or file not found.
-        if ("Error opening" in ccs_err_info['message'] #IOS/IOS-XE/ASA
-                or "404 Not Found" in ccs_err_info['message']): #NX-OS
-            xfr_status = "%(ERR_OPEN)"
-        # ASA partial transfer (broken pipe)
-        elif "Signature not valid" in ccs_err_info['message']:
-            xfr_status = "%(Error reading)"
-        # Connection closed by remote side (e.g: clear line vty)
-        elif "Connection closed by foreign host" in ccs_err_info['message']:
-            xfr_status = "%(CONNECTION_CLOSED)"
-        # send_async_command returns sometimes returns blank output in cases
-        # where xfer completes in under 30 seconds.
-        # Not sure how to handle this yet.
-        else:
-            xfr_status = "%(API_ERR)"
+        xfr_status = get_ccs_transfer_status(ccs_error)
         if enable_debug:
-            nmri.log_message("debug", f"ccs_err_info: {ccs_err_info}")
+            nmri.log_message("debug", f"ccs_err_info: {ccs_error.args[0]}")
 
     nmri.log_message("info", f"{' '*2}Prompt returned. Validating status ...")
+    ex = get_transfer_error(device.os, xfr_status)
 
-    # IOS/IOS-XE/ASA shows "%" in line with error.
-    if device.os != "NX-OS" and "%" in xfr_status:
-        match = re.search(r'%(?:.*\((.*)\))', xfr_status)
-        last_status = match.group(1) if match else "Unknown"
-        if "ERR_OPEN" in last_status:
-            ex = Exception("Host unresponsive or file not found")
-            ex.args += (0x7f,)
-        elif "CONNECTION_CLOSED" in last_status:
-            ex = Exception("Connection closed by remote host")
-            ex.args += (0x40,)
-        elif "API_ERR" in last_status:
-            ex = Exception("API error")
-            ex.args += (0xff,)
-        elif "Broken pipe" in last_status:
-            ex = Exception("Broken pipe")
-            ex.args += (0x3f,)
-        else:
-            # There are instances where we get jacked up return, and we can't
-            # see last_status.... If "Error reading", then more than likely it
-            # is broken pipe. So send broken pipe code and retry.
-            if "Error reading" in xfr_status:
-                ex = Exception("Transfer read error")
-                ex.args += (0x3f,)
-            # Or some other shenanigans we can't handle, yet.
-            else:
-                ex = Exception(f"General error [{last_status}]")
-                ex.args += (0x00,)
-
-    # NX-OS uses cURL, so we get to use cURL error codes (man 3 libcurl-errors)
-    elif device.os == "NX-OS":
-        if "Copy complete" in xfr_status:
-            last_status = 0 #CURLE_OK
-        elif "curl:" in xfr_status:
-            match = re.search(r'(?:curl:\s+)\((\d+)\)', xfr_status)
-            if match:
-                last_status = int(match.group(1))
-        # This shouldn't happen?
-        else:
-            raise ValueError(f"Undetermined cURL return code: {xfr_status}")
-
-        # Was code anything except CURLE_OK?
-        if last_status > 0:
-            #CURLE_COULDNT_RESOLVE_HOST
-            if last_status == 6:
-                ex = Exception("Host unresolvable")
-                ex.args += (0x70,)
-            #CURLE_COULDNT_CONNECT
-            if last_status == 7:
-                ex = Exception("Host unresponsive")
-                ex.args += (0x7f,)
-            #CURLE_PARTIAL_FILE
-            elif last_status == 18:
-                ex = Exception("Broken pipe")
-                ex.args += (0x3f,)
-            # CURLE_HTTP_RETURNED_ERROR
-            elif last_status == 22:
-                ex = Exception("File not found")
-                ex.args += (0x7f,)
-            else:
-            # Something else. Send code back.
-            # If it needs to be handled, then handle it.
-                ex = Exception(f"cURL error: {last_status}")
-                ex.args += (0x00,)
-
-    # There was no error (that we could see).
-    # Validate transfer.
-    else:
+    # There was no error (that we could see). NX-OS cURL says so itself.
+    # Everything else, validate the transfer.
+    if ex is None and device.os != "NX-OS":
         sz = device.get_file_size_info(device.system_fs, image['Filename'])
         # If there is a file, then get the file size. Otherwise, -1.
         if sz[0] and sz[1] >= 0:
@@ -674,16 +796,33 @@ def transfer_upgrade_image(nmri, repo_addr, image, device):
             ex.args += (0xbf,)
 
     # Pass or fail?
+    duration = round(time.monotonic() - started, 1)
+    result = "fail" if ex else "pass"
+    metrics.inc("transfers_total", repo=repo_addr, result=result)
+    metrics.observe("transfer_duration_seconds", duration, repo=repo_addr,
+                    result=result)
+    record_history(KIND_TRANSFER, device, image, duration, result,
+                   ex.args[1] if ex else None, attempt, repo_addr, tuned)
+    if tuned and not ex and duration > 0:
+        log_tuning_gain(device, repo_addr, image['Size'] * 8 / duration / 1e6)
     if ex:
+        metrics.inc("transfer_errors_total", repo=repo_addr,
+                    code=f"0x{ex.args[1]:02x}")
         nmri.log_message("info", f"{' '*2}[FAIL] Reason:"
-                         f" [{hex(ex.args[1])} - {ex.args[0]}]")
+                         f" [{hex(ex.args[1])} - {ex.args[0]}]",
+                         file=image['Filename'], duration=duration,
+                         code=ex.args[1])
         raise ex
     else:
-        nmri.log_message("info", f"{' '*2}[PASS] Transfer completed")
+        metrics.inc("transfer_bytes_total", image['Size'], repo=repo_addr)
+        nmri.log_message("info", f"{' '*2}[PASS] Transfer completed",
+                         file=image['Filename'], bytes=image['Size'],
+                         duration=duration)
         return   
 
 
-def verify_image_integrity(f_info, device):
+@traced
+def verify_image_integrity(f_info, device, attempt=0):
     """Verifies the integrity of an image file.
     
     NOTE: If the platform/version can support SHA-512 verification, and there
@@ -693,6 +832,8 @@ def verify_image_integrity(f_info, device):
     Args:
         - f_info (dict): See upgrade_file_info() documentation.
         - device (cls): CiscoDevice reference.
+        - attempt (int): 0 for the first try, then 1 per retry. (For the
+                         history)
 
     Returns:
         - bool: True if succeed. False if failed.
@@ -701,158 +842,52 @@ def verify_image_integrity(f_info, device):
                      " Waiting for return prompt (See Session Log tab for"
                      " progress) ...")
 
-    # TODO: Seriously cannot tell which platforms/versions support sha512?
-    # IOS 15.2(7) has it, but 15.7(3) doesn't? Commented everything for SHA-512
-    # out, until I can find out how to properly determine which IOS version
-    # supports SHA-512 verification.
-
-    # Set the algo used for the verification command
-    # if f_info['SHA512']:
-    #     h_algo = "sha512"
-    # elif f_info['MD5']:
-    #     h_algo = "md5"
-    # else:
-    #     raise Exception("Hash algo and value not found")
-    if f_info['MD5']:
-        h_algo = 'md5'
-        expected_hash = f_info['MD5'].lower()
-    else:
-        raise Exception("MD5 hash not in the list")
-
-    # Pre-set the flag for if the version supports sha512.
-    #sha512able = False
-
-    if device.os == "ASA":
-    # All ASA 9.x supports sha-512
-        #h_algo = "sha-512" if "sha512" in h_algo else h_algo
-        #expected_hash = f_info['SHA512']
-        cmd = (
-            f"verify /{h_algo} {device.system_fs}:/{f_info['Filename']}"
-            f" {expected_hash}"
-        )
-    if device.os == "NX-OS":
-    # Which NX-OS supports sha512?
-    # NX-OS 6.0(2)A7(2) does not have sha512 verify.
-    # NX-OS 6.0(2)A8(11b) has sha256 but not sha512.
-    # NX-OS 7.0(3)I7(6) has it.
-    # NX-OS 9.3(11) has it
-    # So just check if higher than major version 7
-        # NOTE: NX-OS does not verify image. Just returns hash of the file.
-        # match = re.search(r'(\d+)\.(\d+)\((\d+)(\w+)?\)(.*)', device.version)
-        # if match:
-        #     v_maj = int(match.group(1)) # Major release
-        #     v_min = int(match.group(2)) # Minor release
-        #     v_mnt = int(match.group(3)) # Maintenance release
-        #     v_rbld = match.group(4)     # Rebuild
-
-        #     if ((v_maj == 7 and ((v_min == 0 and v_mnt >= 3) or (v_min > 0)))
-        #             or (v_maj > 7)):
-        #         sha512able = True
-
-        # if sha512able and f_info['SHA512']:
-        #     expected_hash = f_info['SHA512']
-        #     h_algo = "sha512sum" if "sha512" in h_algo else h_algo
-        # else:
-        #     expected_hash = f_info['MD5']
-        #     h_algo = "md5"
-        cmd = f"show file {device.system_fs}:/{f_info['Filename']} {h_algo}"
-
-    if device.os == "IOS-XE":
-    # Which IOS-XE supports sha512?
-    # Version 03.09.00.E does not have it
-    # Version 03.11.02.E has it
-    # Version 16.3.7 does not have it.
-    # Version 16.5.1b has it. (Everest. idk if 16.4 has it.)
-    # So check if higher than 03.11.02 or 16.5.1.
-        # match = re.search(r'(\d+)\.(\d+)\.(\d+)\.?(\S+)?', device.version)
-        # if match:
-        #     v_maj = int(match.group(1))     # Major version
-        #     v_rel = int(match.group(2))     # Release version
-        #     v_rbld = int(match.group(3))    # Rebuild
-        #     v_spcrel = match.group(4)       # Special release
-
-        #     # IOS-XE 3.x
-        #     if v_maj == 3:
-        #         if (v_rel == 11 and v_rbld == 2) or (v_rel >= 11):
-        #             h_algo = "sha512"
-
-        #     # IOS-XE "Peaks"
-        #     if v_maj > 16:
-        #         sha512able = True
-        #     if v_maj == 16:
-        #         if ((v_rel == 5 and v_rbld == 1 and v_spcrel == "b")
-        #                 or (v_rel >= 5 and v_rbld > 1)):
-        #             sha512able = True
-
-        # if sha512able and f_info['SHA512']:
-        #     expected_hash = f_info['SHA512']
-        #     h_algo = "sha512" if "sha512" in h_algo else h_algo
-        # else:
-        #     expected_hash = f_info['MD5']
-        #     h_algo = "md5"
-        cmd = (
-            f"verify /{h_algo} {device.system_fs}:/{f_info['Filename']}"
-            f" {expected_hash}"
-        )
-    if device.os == "IOS":
-    # NOTE: Same for IOS.. Some monolithic IOS support SHA-512, but some don't.
-    # How to tell which ones support SHA-512?? Can't find anywhere in Cisco
-    # release notes.
-    # Version 15.2(4)M8 does not have it.
-    # Version 15.2(7)E has it
-    # So check if higher than Train 15.2, Throttle 7 ...
-        # if device.version.startswith("15"):
-        #     match = re.search(r'([0-9.]+)\((\d+)\)', device.version)
-        #     train = float(match.group(1))
-        #     throttle = int(match.group(2))
-        #     if (train == 15.2 and throttle >= 7) or train > 15.2:
-        #         sha512able = True
-
-        # if sha512able and f_info['SHA512']:
-        #     expected_hash = f_info['SHA512']
-        #     h_algo = "sha512" if "sha512" in h_algo else h_algo
-        # else:
-        #     expected_hash = f_info['MD5']
-        #     h_algo = "md5"
-        cmd = (
-            f"verify /{h_algo} {device.system_fs}:/{f_info['Filename']}"
-            f" {expected_hash}"
-        )
+    # See CiscoDevice.get_verify_command() for the hash algo used.
+    cmd, expected_hash = device.get_verify_command(f_info)
 
     # Verify the image
     result = False
+    tracer.current().set_attribute("file", f_info['Filename'])
     if dry_run:
-        raw_output = "\nDRY RUN"
         nmri.log_message("info", f"dry_run send_async_command: {cmd}")
         return True
     else:
         # Use send_async_command. Some devices take longer than 5 minutes
         # to verify integrity, which puts it over the send_command time out
         # threshold.
-        raw_output = device.dis.send_async_command(cmd, 1200, "")
+        nmri.flush()
+        started = time.monotonic()
+        timeout = history_timeout(KIND_VERIFY, f_info['Size'],
+                                  VERIFY_TIMEOUT, platform=device.platform)
+        raw_output = TailBuffer.of(device.dis.send_async_command(cmd, timeout,
+                                                                  ""))
+        duration = round(time.monotonic() - started, 1)
         nmri.log_message("info",
                          f"{' '*2}Prompt returned. Validating status ...")
         if enable_debug:
-            nmri.log_message("debug", f"return: {repr(raw_output)}")
-        raw_output = raw_output.splitlines()
-        if device.os == "NX-OS":
-        # NX-OS returns one line with the sha512sum/md5sum result
-            result = True if raw_output[-1] == expected_hash else False
-        else:
-        # IOS, IOS-XE, and ASA returns "Verified" or "%Error verifying"
-            for line in raw_output:
-                if "Verified" in line:
-                    result = True
+            nmri.log_message("debug", f"return: {raw_output.summary()}")
+        result = device.verify_passed(raw_output, expected_hash)
+    metrics.observe("verify_duration_seconds", duration,
+                    result="pass" if result else "fail")
+    record_history(KIND_VERIFY, device, f_info, duration,
+                   "pass" if result else "fail", None if result else 0xdf,
+                   attempt)
+    tracer.current().set_attribute("result", result)
     if result:
         nmri.log_message("info",
-                         f"{' '*2}[PASS] Integrity verification OK")
+                         f"{' '*2}[PASS] Integrity verification OK",
+                         file=f_info['Filename'], duration=duration)
     else:
         nmri.log_message("info",
-                         f"{' '*2}[FAIL] Integrity verification failed")
+                         f"{' '*2}[FAIL] Integrity verification failed",
+                         file=f_info['Filename'], duration=duration,
+                         code=0xdf)
     return result
 
 
-def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
+@traced
+def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0, ckpt=None,
+                 tuned=False):
     """Handler loop for image transfers.
 
     Args:
@@ -861,6 +896,9 @@ def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
         - file_info (dict): The dict from upgrade_file_info().
         - device (cls): CiscoDevice class reference.
         - xfr_retry (int): Number of retry attempts. (Default: 0)
+        - ckpt (dict): Checkpoint to record the completed stages to.
+                       (Default: None)
+        - tuned (bool): The HTTP client is tuned. (Default: False)
 
     Raises:
         Exception if failure, or exhausted max retries.
@@ -870,19 +908,27 @@ def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
     # Single pass, or not?
     single_pass = True if xfr_retry < 1 else False
     xfr_retry = 0 if xfr_retry < 1 else xfr_retry
+    attempt = 0
     # Begin loop
     while xfr_retry >= 0:
         try:
-            transfer_upgrade_image(nmri, repo_addr, file_info, device)
+            transfer_upgrade_image(nmri, repo_addr, file_info, device,
+                                   attempt, tuned)
             nmri.log_message("notif", "Upgrade image transfer complete.")
+            if ckpt is not None:
+                mark_stage(nmri, ckpt, f"transferred:{file_info['Filename']}")
             # Returned ok, so we're good.
             nmri.log_message("notif",
                              "Starting integrity check of upgrade image ...")
-            img_hash_pass = verify_image_integrity(file_info, device)
+            img_hash_pass = verify_image_integrity(file_info, device,
+                                                   attempt)
             # If integrity check passed, break from the loop. We're complete.
             if img_hash_pass:
                 nmri.log_message("notif",
                                  "Upgrade image integrity check passed.")
+                if ckpt is not None:
+                    mark_stage(nmri, ckpt,
+                               f"verified:{file_info['Filename']}")
                 break
             else:
             # Transfer completed, but integrity check failed.
@@ -896,17 +942,14 @@ def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
             # NOTE: Set xfr_retry to -1, to break the loop early.
             # Don't do break, otherwise we'll stay in the loop.
             if len(xfr_exp.args) > 1:
-                # These are the conditions that we allow xfer retry:
-                # - 0x00: General error
-                # - 0x3f: Broken pipe
-                # - 0xbf: Incomplete transfer
-                # - 0xdf: Integrity check failed
-                if (xfr_exp.args[1] == 0x00
-                        or xfr_exp.args[1] == 0x3f
-                        or xfr_exp.args[1] == 0xbf
-                        or xfr_exp.args[1] == 0xdf): 
+                # These are the conditions that we allow xfer retry.
+                # See RETRY_TRANSFER_CODES.
+                if xfr_exp.args[1] in RETRY_TRANSFER_CODES:
                     xfr_retry -= 1
+                    attempt += 1
                     if xfr_retry >= 0:
+                        metrics.inc("transfer_retries_total", repo=repo_addr,
+                                    code=f"0x{xfr_exp.args[1]:02x}")
                         nmri.log_message(
                             "notif",
                             f"({max_retries - xfr_retry}/"
@@ -914,21 +957,9 @@ def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
                             " Retrying transfer of upgrade image ..."
                         )
                         # Prepare command to delete partial file.
-                        if device.os == "NX-OS":
-                            cmd = (
-                                f"delete {device.system_fs}:/"
-                                f"{file_info['Filename']} no-prompt"
-                            )
-                        if device.os == "ASA":
-                            cmd = (
-                                f"delete /noconfirm {device.system_fs}:/"
-                                f"{file_info['Filename']}"
-                            )
-                        if device.os == "IOS" or device.os == "IOS-XE":
-                            cmd = (
-                                f"delete /force {device.system_fs}:/"
-                                f"{file_info['Filename']}"
-                            )
+                        cmd = device.get_delete_command(
+                            device.system_fs, file_info['Filename']
+                        )
                         # Delete the partial file.
                         if dry_run:
                             nmri.log_message(
@@ -990,13 +1021,615 @@ def xfer_handler(nmri, repo_addr, file_info, device, xfr_retry=0):
     return
 
 
+def save_device_facts(nmri, device, present):
+    """Cache the discovered device facts, for offline fleet tools.
+
+    Facts are written to {LOCAL_STATE_DIR}/facts/{DeviceID}.json. Failing to
+    write the cache is not fatal to the job.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+        - present (list): Target upgrade filenames that exist, and passed
+                          integrity verification, on the default fs.
+    """
+    facts = device.get_device_facts()
+    facts['present'] = sorted(present)
+    facts_dir = os.path.join(LOCAL_STATE_DIR, "facts")
+    path = os.path.join(facts_dir, f"{facts['DeviceID']}.json")
+    try:
+        os.makedirs(facts_dir, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(facts, f)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        nmri.log_message("warn", f"Unable to cache device facts: {err}")
+
+
+def load_checkpoint(nmri, device):
+    """Load the stage checkpoint left by a previous run, for this device.
+
+    Jobs can die mid-way (Script-Timeout, appliance restart, CLI drop). The
+    checkpoint records which stages completed, so the next run can resume at
+    the first incomplete stage.
+
+    The checkpoint is discarded if it is too old, or if NetMRI reports a
+    different running version or sysDescr than when it was written (e.g: the
+    device was upgraded or replaced since). main() also checks that the
+    device still runs the image of the 'discovered' stage.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+
+    Returns:
+        dict: Checkpoint with keys:
+            - 'DeviceID', 'DeviceVersion', 'DeviceSysDescr': Device identity.
+            - 'updated' (float): When the checkpoint was last written.
+            - 'targets' (dict): Target upgrade MD5s, keyed by filename.
+            - 'stages' (dict): Completed stages. Values are the stage facts,
+                               or True. Stage names are:
+                - 'discovered': Facts from CiscoDevice.get_device_facts().
+                - 'cleaned': Old images were removed.
+                - 'transferred:<file>': Transferred to the default fs.
+                - 'verified:<file>': Integrity verified on the default fs.
+                - 'copied:<fs>:<file>': Copied to another fs (e.g: member).
+                - 'http_tuned': Config commands that revert the HTTP client
+                                tuning. Empty once reverted.
+                - 'complete': The job completed.
+    """
+    fresh = new_checkpoint(device)
+    # Dry runs don't do anything worth resuming.
+    if dry_run:
+        return fresh
+    path = os.path.join(LOCAL_STATE_DIR, "checkpoints",
+                        f"{device.device.DeviceID}.json")
+    try:
+        with open(path, "r") as f:
+            ckpt = json.load(f)
+    except (OSError, ValueError):
+        return fresh
+    if (ckpt.get('version') != CHECKPOINT_VERSION
+            or time.time() - ckpt.get('updated', 0) > CHECKPOINT_MAX_AGE
+            or ckpt.get('DeviceVersion') != fresh['DeviceVersion']
+            or ckpt.get('DeviceSysDescr') != fresh['DeviceSysDescr']):
+        nmri.log_message("info", "Discarding stale checkpoint.")
+        return new_checkpoint(device, ckpt)
+    return ckpt
+
+
+def new_checkpoint(device, stale=None):
+    """A checkpoint with no stages. See load_checkpoint().
+
+    Args:
+        - device (cls): CiscoDevice class reference.
+        - stale (dict): The checkpoint this one replaces. Its pending HTTP
+                        client tuning revert ('http_tuned') is carried over,
+                        so it still runs. (Default: None)
+    """
+    ckpt = {
+        "version": CHECKPOINT_VERSION,
+        "DeviceID": device.device.DeviceID,
+        "DeviceVersion": device.version,
+        "DeviceSysDescr": device.device.DeviceSysDescr,
+        "updated": 0,
+        "targets": {},
+        "stages": {}
+    }
+    undo = stale and stale.get('stages', {}).get("http_tuned")
+    if undo:
+        ckpt['stages']['http_tuned'] = undo
+    return ckpt
+
+
+def mark_stage(nmri, ckpt, stage, facts=True):
+    """Record a completed stage, and write the checkpoint.
+
+    Failing to write the checkpoint is not fatal to the job.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - ckpt (dict): The checkpoint from load_checkpoint().
+        - stage (str): Stage name. See load_checkpoint().
+        - facts: Facts to keep for this stage. Default is True.
+    """
+    ckpt['stages'][stage] = facts
+    if dry_run:
+        return
+    ckpt['updated'] = time.time()
+    ckpt_dir = os.path.join(LOCAL_STATE_DIR, "checkpoints")
+    path = os.path.join(ckpt_dir, f"{ckpt['DeviceID']}.json")
+    try:
+        os.makedirs(ckpt_dir, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(ckpt, f)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        nmri.log_message("warn", f"Unable to write checkpoint: {err}")
+
+
+def check_checkpoint_targets(ckpt, targets):
+    """Forget the stages of a checkpoint, if the target upgrade images changed
+    since it was written (e.g: the hash list was updated).
+
+    Args:
+        - ckpt (dict): The checkpoint from load_checkpoint().
+        - targets (list): Target upgrade file info dicts.
+    """
+    targets = {item['Filename']: item['MD5'] for item in targets}
+    if ckpt['targets'] != targets:
+        # Discovery, and a pending tuning revert, still hold.
+        ckpt['stages'] = {stage: facts for stage, facts
+                          in ckpt['stages'].items()
+                          if stage in ("discovered", "http_tuned")}
+        ckpt['targets'] = targets
+
+
+def checkpoint_verified(ckpt, f_info, f_size):
+    """Check if a previous run already verified the integrity of a file on
+    the default fs, and its size still matches.
+
+    This is the cheap validation (one 'dir'), instead of re-hashing a file
+    that can take several minutes to verify.
+
+    Returns:
+        bool: True if the previous verification still holds.
+    """
+    return (f"verified:{f_info['Filename']}" in ckpt['stages']
+            and f_size == f_info['Size'])
+
+
+@traced
+def copy_to_other_fs(nmri, device, f_info, ckpt):
+    """Copy the target upgrade image from the default fs to the other file
+    systems (e.g: switch stack members). IOS/IOS-XE only.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+        - f_info (dict): The dict from upgrade_file_info().
+        - ckpt (dict): The checkpoint from load_checkpoint().
+    """
+    if ((device.os != "IOS" and device.os != "IOS-XE")
+            or len(device.system_fs_info) < 2):
+        return
+    for item in list(device.system_fs_info.values())[1:]:
+        # Start at the 2nd key. We don't need key 0 (default fs), because
+        # that's where we just transferred to..
+        stage = f"copied:{item['fs']}:{f_info['Filename']}"
+        if stage in ckpt['stages']:
+            # Copied by a previous run. Make sure it's still there.
+            sz = device.get_file_size_info(item['fs'], f_info['Filename'])
+            if sz[1] == f_info['Size']:
+                nmri.log_message("info", f"'{item['fs']}' already has"
+                                 f" {f_info['Filename']} from a previous"
+                                 " run.")
+                continue
+        nmri.log_message("notif", f"Copying {f_info['Filename']}"
+                         f" to '{item['fs']}' ...")
+        cmd = (f"copy {device.system_fs}:/{f_info['Filename']}"
+               f" {item['fs']}:/{f_info['Filename']}\r\r\r")
+        if dry_run:
+            nmri.log_message("info", f"dry_run send_async_command: {cmd}")
+        else:
+            # Use send_async_command, otherwise long copy operations
+            # will time out. 1 hour timeout should suffice.
+            nmri.flush()
+            with tracer.span("copy", fs=item['fs'],
+                             file=f_info['Filename']):
+                device.dis.send_async_command(cmd, 3600, "")
+        mark_stage(nmri, ckpt, stage)
+
+
+def prestage_install(nmri, device, f_info, ckpt):
+    """Expand and stage an IOS-XE image with 'install add', ahead of the
+    maintenance window, then delete the image file. INSTALL mode only.
+
+    A failure here doesn't fail the job. The image is already transferred,
+    and the packages can still be added in the window.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+        - f_info (dict): The dict from upgrade_file_info().
+        - ckpt (dict): The checkpoint from load_checkpoint().
+
+    Returns:
+        bool: True if the image is staged.
+    """
+    if (not iosxe_prestage_install or device.os != "IOS-XE"
+            or device.iosxe_boot_mode != "INSTALL"):
+        return False
+    stage = f"staged:{f_info['Filename']}"
+    if stage in ckpt['stages']:
+        nmri.log_message("info", f"{f_info['Filename']} was already staged"
+                         " by a previous run.")
+        return True
+    set_phase("prestage")
+
+    # The packages are expanded next to the image, on every member.
+    expand_sz = int(f_info['Size'] * INSTALL_EXPAND_RATIO)
+    nmri.log_message("notif", "Checking free space for the expanded"
+                     f" packages (~{expand_sz} bytes) ...")
+    device.get_system_fs_info()
+    fs_validated = validate_fs_space_available(nmri, expand_sz,
+                                               device.system_fs_info)
+    if not fs_validated['pass']:
+        nmri.log_message("warn", "Insufficient space to stage the packages."
+                         " Skipping 'install add'.")
+        metrics.inc("prestage_total", result="no_space")
+        return False
+
+    cmd = device.get_install_add_command(f_info)
+    nmri.log_message("notif", f"Staging packages: {cmd} ...")
+    if dry_run:
+        nmri.log_message("info", f"dry_run send_async_command: {cmd}")
+        return False
+    nmri.flush()
+    started = time.monotonic()
+    error = None
+    try:
+        raw_output = TailBuffer.of(device.dis.send_async_command(
+            cmd, INSTALL_ADD_TIMEOUT, ""
+        ))
+        passed = device.install_add_passed(raw_output)
+    except Exception as err:
+        raw_output = None
+        passed = False
+        # CCS error, or timeout. It's the reason 'install add' failed.
+        error = err
+        if enable_debug:
+            nmri.log_message("debug", f"install add error: {err!r}")
+    duration = round(time.monotonic() - started, 1)
+    tracer.current().set_attribute("result", passed)
+    metrics.inc("prestage_total", result="pass" if passed else "fail")
+    if not passed:
+        reason = ((str(error) or type(error).__name__) if error
+                  else raw_output.tail()[-3:])
+        nmri.log_message("warn", "'install add' failed. The packages must be"
+                         f" added in the maintenance window. {reason}",
+                         duration=duration)
+        return False
+    nmri.log_message("notif", f"Packages staged in {duration}s. Only"
+                     " 'install activate' and 'install commit' are left.",
+                     duration=duration)
+    mark_stage(nmri, ckpt, stage)
+
+    # The image file isn't needed anymore.
+    for item in device.system_fs_info.values():
+        name, _ = device.get_file_size_info(item['fs'], f_info['Filename'])
+        if name:
+            nmri.log_message("info", f"Deleting {item['fs']}:/{name}")
+            device.dis.send_command(device.get_delete_command(item['fs'],
+                                                              name))
+    return True
+
+
+def prestage_boot(nmri, device, f_info, ks_info, ckpt):
+    """Prepare the maintenance window, once the target images are verified,
+    so it's only a reload:
+        - IOS, IOS-XE (BUNDLE mode) and ASA: boot the target image first,
+          with the running image as the fallback, and save the config.
+        - NX-OS: run 'show install all impact' with the target pair.
+    IOS-XE in INSTALL mode is left to 'install activate' (see
+    prestage_install()).
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+        - f_info (dict): The dict from upgrade_file_info().
+        - ks_info (dict): The kickstart dict, or None.
+        - ckpt (dict): The checkpoint from load_checkpoint().
+
+    Raises:
+        Exception if the boot config fails, or the impact check doesn't
+        pass. Exception.args[1] is 0xef.
+    """
+    if (not prestage_boot_vars or device.iosxe_boot_mode == "INSTALL"
+            or "boot_staged" in ckpt['stages']):
+        return
+    set_phase("prestage_boot")
+    if device.os == "NX-OS":
+        cmd = device.get_install_impact_command(f_info, ks_info)
+        nmri.log_message("notif", f"Checking the upgrade impact: {cmd} ...")
+        if dry_run:
+            nmri.log_message("info", f"dry_run send_async_command: {cmd}")
+            return
+        nmri.flush()
+        raw_output = TailBuffer(max_lines=INSTALL_IMPACT_LINES)
+        try:
+            raw_output.feed(device.dis.send_async_command(
+                cmd, INSTALL_IMPACT_TIMEOUT, ""
+            ))
+        except Exception as err:
+            # CCS error, or timeout.
+            ex = Exception(f"Upgrade impact check failed: {err}")
+            ex.args += (0xef,)
+            nmri.log_message("error", f"{ex.args[0]}", code=0xef)
+            metrics.inc("boot_stage_total", result="fail")
+            raise ex
+        impact = device.get_install_impact(raw_output)
+        for item in impact['modules']:
+            nmri.log_message("info", f"{' '*2}Module {item['module']}:"
+                             f" bootable={item['bootable']},"
+                             f" impact={item['impact']},"
+                             f" install_type={item['install_type']}"
+                             f" {item['reason']}")
+        metrics.inc("boot_stage_total",
+                    result="pass" if impact['passed'] else "fail")
+        if not impact['passed']:
+            nmri.log_message("error", "The upgrade impact check failed:"
+                             f" {raw_output.tail()[-5:]}", code=0xef)
+            ex = Exception("Upgrade impact check failed")
+            ex.args += (0xef,)
+            raise ex
+        nmri.log_message("notif", "Upgrade impact check passed."
+                         f" Disruptive: {impact['disruptive']}.")
+        mark_stage(nmri, ckpt, "boot_staged", impact)
+        return
+
+    boot_lines = device.get_boot_config()
+    commands = device.get_boot_commands(f_info, boot_lines)
+    if not commands:
+        nmri.log_message("notif", f"{f_info['Filename']} already boots"
+                         " first.")
+        mark_stage(nmri, ckpt, "boot_staged", boot_lines)
+        return
+    nmri.log_message("notif", "Setting the boot images ...")
+    for cmd in commands:
+        nmri.log_message("info", f"{' '*2}{cmd}")
+    if dry_run:
+        nmri.log_message("info", "dry_run: boot config not changed.")
+        return
+    # Boot images are set in the system context.
+    system_context = device.asa_multi_context and device.asa_admin_context
+    if system_context:
+        device.dis.send_command("changeto system")
+    saved = False
+    try:
+        device.enter_global_config()
+        for cmd in commands:
+            raw_output = device.dis.send_command(cmd)
+            if re.search(r'^\s*(%|ERROR:)', raw_output or "", re.MULTILINE):
+                ex = Exception(f"'{cmd}' failed: {raw_output.strip()}")
+                ex.args += (0xef,)
+                raise ex
+        saved = True
+    except Exception as err:
+        # A rejected command, or a CCS error (or timeout) part way through.
+        # Either way, put the running config back.
+        if len(err.args) > 1 and err.args[1] == 0xef:
+            ex = err
+        else:
+            ex = Exception(f"Setting the boot images failed: {err}")
+            ex.args += (0xef,)
+        nmri.log_message("error", f"{ex.args[0]}. Restoring the boot"
+                         " images.", code=0xef)
+        metrics.inc("boot_stage_total", result="fail")
+        if device.in_config_mode:
+            try:
+                for undo in device.get_boot_restore_commands(commands,
+                                                             boot_lines):
+                    device.dis.send_command(undo)
+            except Exception as restore_err:
+                nmri.log_message("error", "Unable to restore the boot"
+                                 f" images: {restore_err}. Check the"
+                                 " 'boot system' config.", code=0xef)
+        raise ex
+    finally:
+        # Save only if every command went through. On failure, leaving
+        # config mode (or the system context) must not hide the 0xef error.
+        try:
+            device.exit_global_config(saved)
+            if system_context:
+                device.dis.send_command(
+                    f"changeto context {device.asa_admin_context_name}"
+                )
+        except Exception as err:
+            if saved:
+                raise
+            nmri.log_message("warn", "Unable to leave the boot config:"
+                             f" {err}")
+    boot_lines = device.get_boot_config()
+    metrics.inc("boot_stage_total", result="pass")
+    nmri.log_message("notif", "Boot images set, and saved: "
+                     + "; ".join(boot_lines))
+    mark_stage(nmri, ckpt, "boot_staged", boot_lines)
+
+
+def apply_http_tuning(nmri, device, ckpt, undo):
+    """Tune the HTTP client for the copies ('tune_http_client'). IOS and
+    IOS-XE only.
+
+    The tuning is only an aid. A command the device rejects is skipped, and
+    if the CLI fails, the copies run with what was applied.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+        - device (cls): CiscoDevice class reference.
+        - ckpt (dict): The checkpoint. Keeps 'undo' until it's reverted.
+        - undo (list): Filled with the commands that revert what was
+                       applied, in order. See revert_http_tuning().
+    """
+    if not tune_http_client or device.os not in ("IOS", "IOS-XE"):
+        return
+    device.get_active_interfaces()
+    source = device.get_http_source_interface()
+    changes = device.get_http_client_tuning(HTTP_TCP_WINDOW_SIZE, source,
+                                            device.get_http_client_config())
+    if not changes:
+        nmri.log_message("info", f"{' '*2}HTTP client already tuned.")
+        return
+    nmri.log_message("notif", "Tuning the HTTP client for the transfer ...")
+    for cmd, _ in changes:
+        nmri.log_message("info", f"{' '*2}{cmd}")
+    if dry_run:
+        nmri.log_message("info", "dry_run: HTTP client not tuned.")
+        return
+    try:
+        device.enter_global_config()
+        for cmd, restore in changes:
+            raw_output = device.dis.send_command(cmd)
+            if re.search(r'^\s*(%|ERROR:)', raw_output or "", re.MULTILINE):
+                nmri.log_message("warn", f"{' '*2}'{cmd}' failed:"
+                                 f" {raw_output.strip()}. Skipped.")
+                continue
+            undo.insert(0, restore)
+    except Exception as err:
+        nmri.log_message("warn", f"Unable to tune the HTTP client: {err}")
+    finally:
+        # Kept first, in case leaving config mode fails too.
+        if undo:
+            mark_stage(nmri, ckpt, "http_tuned", list(undo))
+        # Running config only. It's reverted after the copies.
+        if device.in_config_mode:
+            try:
+                device.exit_global_config(False)
+            except Exception as err:
+                nmri.log_message("warn", "Unable to leave config mode after"
+                                 f" the HTTP client tuning: {err}")
+    metrics.inc("http_tuning_total", result="applied" if undo else "failed")
+
+
+def revert_http_tuning(nmri, device, ckpt, undo):
+    """Revert apply_http_tuning(), with its 'undo' commands (or the ones a
+    previous run left in the checkpoint).
+
+    It runs in main()'s finally, so it never raises: that would hide why
+    the transfer failed. If the CLI fails, the commands stay in the
+    checkpoint, for the next run.
+    """
+    if not undo:
+        return
+    nmri.log_message("notif", "Reverting the HTTP client tuning ...")
+    failed = []
+    try:
+        device.enter_global_config()
+        for cmd in undo:
+            nmri.log_message("info", f"{' '*2}{cmd}")
+            raw_output = device.dis.send_command(cmd)
+            if re.search(r'^\s*(%|ERROR:)', raw_output or "", re.MULTILINE):
+                failed.append(cmd)
+        device.exit_global_config(False)
+    except Exception as err:
+        nmri.log_message("warn", "Unable to revert the HTTP client tuning:"
+                         f" {err}. The next run reverts it.")
+        metrics.inc("http_tuning_total", result="revert_failed")
+        if device.in_config_mode:
+            try:
+                device.exit_global_config(False)
+            except Exception:
+                pass
+        return
+    # Failed commands would fail again. Don't leave them for the next run.
+    mark_stage(nmri, ckpt, "http_tuned", [])
+    if failed:
+        nmri.log_message("warn", "Unable to revert the HTTP client tuning:"
+                         f" {'; '.join(failed)}")
+    metrics.inc("http_tuning_total",
+                result="revert_failed" if failed else "reverted")
+
+
+def log_tuning_gain(device, repo_addr, mbps):
+    """Log the throughput of a tuned copy, next to the median of the untuned
+    copies of the same repo and platform in the transfer history."""
+    before = None
+    if history:
+        try:
+            before = history.rate(50, KIND_TRANSFER, history_since(),
+                                  fallback=False, repo=repo_addr,
+                                  platform=device.platform, tuned=0)
+        except sqlite3.Error as err:
+            nmri.log_message("warn", f"{' '*2}Unable to read the transfer"
+                             f" history: {err}")
+    nmri.log_message("info", f"{' '*2}Tuned throughput: {mbps:.1f} Mbps."
+                     " Untuned median for this repo and platform:"
+                     f" {f'{before} Mbps' if before else 'unknown'}.")
+
+
+def set_phase(phase):
+    """Start a new job phase, for the event log and the phase metrics."""
+    nmri.set_phase(phase)
+    metrics.phase(phase)
+
+
+def profile_main(nmri):
+    """Run main() under cProfile and tracemalloc.
+
+    Writes, to {PROFILES_DIR}/{job_id}-{device_id}:
+        - .pstats: The cProfile stats (e.g: python -m pstats <file>).
+        - .txt: Top functions by cumulative and own time, and top
+                allocation sites with their tracebacks.
+    Failing to write the profile is not fatal to the job.
+
+    Args:
+        - nmri (cls): The NetMRIEasy class reference.
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start(PROFILE_MALLOC_FRAMES)
+    try:
+        profiler.runcall(main, nmri)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ])
+        tracemalloc.stop()
+
+        base = os.path.join(PROFILES_DIR, f"{job_id}-{device_id}")
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            profiler.dump_stats(f"{base}.pstats")
+            with open(f"{base}.txt", "w") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.strip_dirs()
+                f.write(f"Peak traced memory: {peak} bytes\n")
+                for sort_key in ("cumulative", "tottime"):
+                    f.write(f"\n=== Top {PROFILE_TOP} by {sort_key} ===\n")
+                    stats.sort_stats(sort_key).print_stats(PROFILE_TOP)
+                f.write(f"\n=== Top {PROFILE_TOP} allocation sites ===\n")
+                for stat in snapshot.statistics("traceback")[:PROFILE_TOP]:
+                    f.write(f"{stat.size} bytes in {stat.count} blocks\n")
+                    for line in stat.traceback.format():
+                        f.write(f"{line}\n")
+            nmri.log_message("info", f"Profile written to {base}.pstats,"
+                             f" peak traced memory: {peak} bytes.")
+        except OSError as err:
+            nmri.log_message("warn", "Unable to write profile to"
+                             f" {PROFILES_DIR}: {err}")
+
+
 def main(nmri):
+    set_phase("discovery")
     # Instantiate the current device (CiscoDevice class)
-    device = CiscoDevice(nmri)
+    with tracer.span("CiscoDevice") as span:
+        device = CiscoDevice(nmri)
+        span.set_attribute("os", device.os)
+        span.set_attribute("model", device.model)
 
     nmri.log_message("notif",
                      f"Begin {device.os} Software Transfer")
 
+    # Compare the inventory version to the hash list first. Devices that
+    # already run the target version are done, before any CLI.
+    os_hash_list_id = get_list_id(nmri, hash_list)
+    hash_rows = get_list_rows(nmri, os_hash_list_id)
+    rules = None
+    groups = []
+    if use_target_rules:
+        rules = get_target_rules(nmri, hash_rows)
+        if rules.uses_groups:
+            groups = get_device_groups(nmri, device)
+    current_target = prefilter_device(nmri, device, hash_rows, rules, groups)
+    if current_target:
+        nmri.log_message("notif", f"{device.hostname} is already running"
+                         f" {device.version}, the version of the target"
+                         f" upgrade image {current_target}.")
+        metrics.inc("prefiltered_total", os=device.os)
+        return # back to __main__
+
     # Check if this is a non-admin ASA context. Raise exception if it is.
     if (device.os == "ASA"
             and device.asa_multi_context and not device.asa_admin_context):
@@ -1039,12 +1672,33 @@ def main(nmri):
     # Let's continue.
     nmri.log_message("info", 
                      f"Interacting with: {device.hostname} ({device.model})")
-
-    # Call CiscoDevice.get_system_image_info() to determine the current
-    # running system image, the sys image prefix, and the file system it's
-    # stored on.
-    device.get_system_image_info()
+    metrics.labels['os'] = device.os
+
+    # Resume from the checkpoint of a previous run, if there is one.
+    ckpt = load_checkpoint(nmri, device)
+    if "discovered" in ckpt['stages']:
+        with tracer.span("check_device_facts"):
+            facts_hold = device.check_device_facts(
+                ckpt['stages']['discovered']
+            )
+        if not facts_hold:
+            # e.g: Reloaded on another image, with the same version string.
+            nmri.log_message("info", "The running image changed since the"
+                             " checkpoint was written. Discarding it.")
+            ckpt = new_checkpoint(device, ckpt)
+    if "discovered" in ckpt['stages']:
+        nmri.log_message("notif", "Resuming from the checkpoint of a previous"
+                         " run. Skipping system image discovery.")
+        with tracer.span("load_device_facts"):
+            device.load_device_facts(ckpt['stages']['discovered'])
+    else:
+        # Call CiscoDevice.get_system_image_info() to determine the current
+        # running system image, the sys image prefix, and the file system
+        # it's stored on.
+        with tracer.span("get_system_image_info"):
+            device.get_system_image_info()
     nmri.log_message("info", f"Detected platform prefix is: {device.platform}")
+    metrics.labels['platform'] = device.platform
     nmri.log_message("info", "Current system image is:"
                      f" {device.current_system_image_fs}:/"
                      f"{device.current_system_image}")
@@ -1053,8 +1707,14 @@ def main(nmri):
         nmri.log_message("info", 
                          f"This device is in {device.iosxe_boot_mode} mode.")
 
-    # Get fs names and their free space
-    device.get_system_fs_info()
+    # Get fs names and their free space.
+    # This is always refreshed, even when resuming. Free space may have
+    # changed since the checkpoint was written.
+    with tracer.span("get_system_fs_info") as span:
+        device.get_system_fs_info()
+        span.set_attribute("fs_count", len(device.system_fs_info))
+    if "discovered" not in ckpt['stages']:
+        mark_stage(nmri, ckpt, "discovered", device.get_device_facts())
 
     if device.current_system_image_fs != device.system_fs:
         nmri.log_message("warn", "The current running image is not"
@@ -1067,25 +1727,22 @@ def main(nmri):
         raise Exception("IOS-XE SD-WAN is not supported.")
 
     # Get target upgrade image file information
+    set_phase("target")
     nmri.log_message("notif", 'Searching for target upgrade image from list'
                      f' "{hash_list}" ...')
 
-    # Get the list ID that contains the software hashes
-    os_hash_list_id = get_list_id(nmri, hash_list)
-
-    # Get the target upgrade filename, size, and hash from the list.
-    upgrade_file_info = get_upgrade_file_info(nmri, device, os_hash_list_id)
-    nmri.log_message("info", "Upgrade image selected:"
-                            f" {upgrade_file_info['Filename']}"
-                            f", size: {upgrade_file_info['Size']} bytes.")
-
-    # Get kickstart upgrade filename.
-    if device.os == "NX-OS" and device.nxos_kickstart_image:
-        ks_upgrade_info = get_upgrade_file_info(nmri, device,
-                                                os_hash_list_id, True)
-        nmri.log_message("info", "Kickstart upgrade image selected:"
-                                f" {ks_upgrade_info['Filename']}, size:"
-                                f" {ks_upgrade_info['Size']} bytes.")
+    # Get the target manifest from the list: the upgrade image, and the
+    # other files of the platform (kickstart, ROMMON, ASDM, SMUs), in
+    # transfer order.
+    manifest = get_upgrade_manifest(nmri, device, os_hash_list_id,
+                                    rows=hash_rows, rules=rules,
+                                    groups=groups)
+    for item in manifest:
+        nmri.log_message("info", f"Upgrade {item['Role']} selected:"
+                         f" {item['Filename']}, size: {item['Size']}"
+                         " bytes.")
+    check_checkpoint_targets(ckpt, manifest)
+    upgrade_file_info = manifest[0]
 
     # Check if device is already running the target upgrade image.
     already_running_current = False
@@ -1098,90 +1755,112 @@ def main(nmri):
     if already_running_current:
         nmri.log_message("notif", f"{device.hostname} is already running"
                          " the target upgrade image.")
+        # The other files of the manifest (e.g: ASDM) may still be missing.
+        manifest = [item for item in manifest
+                    if item['Role'] not in OS_ROLES]
+        if not manifest:
+            save_device_facts(nmri, device, [])
+            return # back to __main__
+        upgrade_file_info = None
+
+    # Check if a previous pre-stage already added the target packages. The
+    # image file was deleted after, so it won't be found below.
+    if (upgrade_file_info and iosxe_prestage_install
+            and device.iosxe_boot_mode == "INSTALL"
+            and (f"staged:{upgrade_file_info['Filename']}" in ckpt['stages']
+                 or device.get_install_staged(device.get_install_summary(),
+                                              upgrade_file_info))):
+        nmri.log_message("notif", "Target upgrade packages are already"
+                         " staged on this device.")
+        save_device_facts(nmri, device, [upgrade_file_info['Filename']])
+        mark_stage(nmri, ckpt, "complete")
         return # back to __main__
 
-    # Check if the target upgrade image already exists.
-    f_exists_and_valid = False
-    f_exists = device.get_file_size_info(device.system_fs,
-                                         upgrade_file_info['Filename'])
-
-    # If this device is a NX-OS /w kickstart, then check if the target
-    # kickstart upgrade already exists.
-    ks_exists = (None,-1)
-    ks_exists_and_valid = False
-    # Only send if it's actually NX-OS /w kickstart.
-    if device.os == "NX-OS" and device.nxos_kickstart_image:
-        ks_exists = device.get_file_size_info(device.system_fs,
-                                              ks_upgrade_info['Filename'])
-
-    # Target upgrade already exists, check if we need to continue or not.
-    if f_exists[0]:
-        nmri.log_message("notif", "Target upgrade image already exists on this"
+    # Check which files of the manifest already exist, and are valid.
+    missing = []
+    for item in manifest:
+        f_exists = device.get_file_size_info(device.system_fs,
+                                             item['Filename'])
+        if not f_exists[0]:
+            missing.append(item)
+            continue
+        if checkpoint_verified(ckpt, item, f_exists[1]):
+            nmri.log_message("notif", f"Target upgrade {item['Role']}"
+                             f" {item['Filename']} already exists on this"
+                             " device, and was verified by a previous run.")
+            continue
+        nmri.log_message("notif", f"Target upgrade {item['Role']}"
+                         f" {item['Filename']} already exists on this"
                          " device. Verifying integrity ...")
-        f_exists_and_valid = verify_image_integrity(upgrade_file_info, device)
-        severity = "notif" if f_exists_and_valid else "warn"
-        result = "passed" if f_exists_and_valid else "failed"
+        valid = verify_image_integrity(item, device)
+        severity = "notif" if valid else "warn"
+        result = "passed" if valid else "failed"
         nmri.log_message(severity, f"Integrity check {result}.")
+        if valid:
+            mark_stage(nmri, ckpt, f"verified:{item['Filename']}")
+            continue
         # If NX-OS, we have to delete the file that failed validation.
         # Otherwise, we'll get prompt to overwrite,
         # and the default answer is "no".
-        if device.os == "NX-OS" and not f_exists_and_valid:
-            cmd = (f"delete {device.system_fs}:/"
-                   f"{upgrade_file_info['Filename']} no-prompt")
-            if dry_run:
-                nmri.log_message("info", f"dry_run send_async_command: {cmd}")
-            else:
-                device.dis.send_command(cmd)
-        # Target upgrade exists, is valid,
-        # and this device isn't a NX-OS /w kickstart.
-        if f_exists_and_valid and not ks_exists[0]:
-            return
-
-    # Kickstart image exists. Check if we continue or not.
-    if ks_exists[0]:
-        nmri.log_message("notif", "Kickstart upgrade image already exists on"
-                         " this device. Verifying integrity ...")
-        ks_exists_and_valid = verify_image_integrity(ks_upgrade_info, device)
-        severity = "notif" if ks_exists_and_valid else "warn"
-        result = "passed" if ks_exists_and_valid else "failed"
-        nmri.log_message(severity, f"Integrity check {result}.")
-        # Same with kickstart. 
-        if device.os == "NX-OS" and not ks_exists_and_valid:
-            cmd = (f"delete {device.system_fs}:/"
-                   f"{ks_upgrade_info['Filename']} no-prompt")
+        if device.os == "NX-OS":
+            cmd = device.get_delete_command(device.system_fs,
+                                            item['Filename'])
             if dry_run:
-                nmri.log_message("info", f"dry_run send_async_command: {cmd}")
+                nmri.log_message("info", f"dry_run send_command: {cmd}")
             else:
                 device.dis.send_command(cmd)
-        # Both the system image and kickstart exist, and both are validated.
-        # Nothing to do.
-        if f_exists_and_valid and ks_exists_and_valid:
-            return
+        missing.append(item)
+    ks_upgrade_info = get_manifest_file(manifest, "kickstart")
+
+    # Every file exists, and is valid. Nothing to transfer.
+    if not missing:
+        # A previous run died before reverting its HTTP client tuning.
+        revert_http_tuning(nmri, device, ckpt,
+                           ckpt['stages'].get("http_tuned"))
+        if upgrade_file_info:
+            # A previous run died after the transfer, but before finishing
+            # the copies to the other file systems. Finish them.
+            if (f"transferred:{upgrade_file_info['Filename']}"
+                    in ckpt['stages'] and "complete" not in ckpt['stages']):
+                copy_to_other_fs(nmri, device, upgrade_file_info, ckpt)
+            with tracer.span("prestage_install"):
+                prestage_install(nmri, device, upgrade_file_info, ckpt)
+            with tracer.span("prestage_boot"):
+                prestage_boot(nmri, device, upgrade_file_info,
+                              ks_upgrade_info, ckpt)
+        save_device_facts(nmri, device,
+                          [item['Filename'] for item in manifest])
+        mark_stage(nmri, ckpt, "complete")
+        return
 
-    # File exists, but failed verification.
-    if ((f_exists[0] and not f_exists_and_valid)
-            or (ks_exists[0] and not ks_exists_and_valid)):
-        nmri.log_message("notif", "Continuing with transfer.")
+    nmri.log_message("notif", f"Continuing with transfer of {len(missing)}"
+                     f" of {len(manifest)} file(s).")
+    # The files of the manifest that are already there (e.g: a valid system
+    # image, when only the kickstart is missing) are not old.
+    keep = [item['Filename'] for item in manifest]
 
     # If user checked "clean old images", then call remove_old_images() early.
-    if clean_old_images:
+    set_phase("cleanup")
+    if clean_old_images and "cleaned" in ckpt['stages']:
+        nmri.log_message("notif", "Old images were already removed by a"
+                         " previous run.")
+    elif clean_old_images:
         nmri.log_message("notif", "Forcefully removing old images ...")
         fs_list = [item['fs'] for item in device.system_fs_info.values()]
-        remove_old_images(nmri, device, fs_list)
+        remove_old_images(nmri, device, fs_list, keep)
         # Refresh fs info to get updated free space after old image deletion. 
-        device.get_system_fs_info()
+        with tracer.span("get_system_fs_info"):
+            device.get_system_fs_info()
+        mark_stage(nmri, ckpt, "cleaned")
 
     # Check if there is enough free space.
+    set_phase("space_check")
     nmri.log_message("notif", f"Checking if {len(device.system_fs_info)}"
                      " file system(s) has sufficient space for target upgrade"
                      " image ...")
     
-    # NX-OS with kickstart. Account size for system + kickstart.
-    if device.os == "NX-OS" and device.nxos_kickstart_image:
-        req_sz = ks_upgrade_info['Size'] + upgrade_file_info['Size']
-    # Everything else.
-    else:
-        req_sz = upgrade_file_info['Size']
+    # One check, for every file left to transfer.
+    req_sz = sum(item['Size'] for item in missing)
 
     # Build fs_validated
     fs_validated = validate_fs_space_available(nmri, req_sz,
@@ -1207,12 +1886,13 @@ def main(nmri):
             nmri.log_message("info", "Attempting to reclaim storage space ...")
             # Send the failed fs list for old image deletion.
             fs_list = fs_validated['fs']
-            remove_old_images(nmri, device, fs_list)
+            remove_old_images(nmri, device, fs_list, keep)
             # Get updated free space from file systems
             nmri.log_message("info",
                              f"Re-checking {len(device.system_fs_info)} file"
                              " system(s) for free space ...")
-            device.get_system_fs_info()
+            with tracer.span("get_system_fs_info"):
+                device.get_system_fs_info()
             # Call validate_fs_space_available()
             # again, and check if we freed enough space.
             fs_validated = validate_fs_space_available(nmri, req_sz, 
@@ -1230,6 +1910,7 @@ def main(nmri):
                 raise Exception("Insufficient free space")
 
     # Get the remote destination information
+    set_phase("repo_select")
     if ovr_repo:
         repo_addr = repo_host_override
         nmri.log_message("notif", f"Repo host override. Using: {repo_addr}")
@@ -1242,44 +1923,50 @@ def main(nmri):
         repo_addr = get_repo_info(
             repo_list_id,
             repo_region,
-            device.device.virtual_network.VirtualNetworkName
+            device.device.virtual_network.VirtualNetworkName,
+            device.platform
         )
 
-    # Begin transfer
-    if not f_exists_and_valid:
-        nmri.log_message("notif", "Starting transfer of upgrade image ...")
-        xfer_handler(nmri, repo_addr, upgrade_file_info, device, max_retries)
-    # Do NX-OS kickstart, if need be.
-    #TODO: Change this to "supplemental image"?
-    if (device.os == "NX-OS"
-            and device.nxos_kickstart_image and not ks_exists_and_valid):
-        nmri.log_message("notif",
-                         "Starting transfer of kickstart upgrade image ...")
-        xfer_handler(nmri, repo_addr, ks_upgrade_info, device, max_retries)
-
-    # Copy to other file systems, if required.
-    if ((device.os == "IOS" or device.os == "IOS-XE")
-            and len(device.system_fs_info) > 1):
-        for item in list(device.system_fs_info.values())[1:]:
-            # Start at the 2nd key. We don't need key 0 (default fs), because
-            # that's where we just transferred to..
-            nmri.log_message("notif", "Copying"
-                                f" {upgrade_file_info['Filename']}"
-                                f" to '{item['fs']}' ...")
-            cmd = (f"copy {device.system_fs}:/{upgrade_file_info['Filename']}"
-                   f" {item['fs']}:/{upgrade_file_info['Filename']}\r\r\r")
-            if dry_run:
-                nmri.log_message("info", f"dry_run send_async_command: {cmd}")
-            else:
-                # Use send_async_command, otherwise long copy operations
-                # will time out. 1 hour timeout should suffice.
-                device.dis.send_async_command(cmd, 3600, "")
+    # Begin transfer. Back to back, in manifest order, in this session.
+    set_phase("transfer")
+    # A previous run may have died before reverting its tuning. It's still
+    # applied, so revert that instead.
+    undo = list(ckpt['stages'].get("http_tuned") or [])
+    try:
+        if not undo:
+            apply_http_tuning(nmri, device, ckpt, undo)
+        for i, item in enumerate(missing, start=1):
+            nmri.log_message("notif", f"({i}/{len(missing)}) Starting"
+                             f" transfer of upgrade {item['Role']}"
+                             f" {item['Filename']} ...")
+            xfer_handler(nmri, repo_addr, item, device, max_retries, ckpt,
+                         bool(undo))
+    finally:
+        revert_http_tuning(nmri, device, ckpt, undo)
+
+    if upgrade_file_info:
+        # Copy to other file systems, if required.
+        set_phase("copy")
+        copy_to_other_fs(nmri, device, upgrade_file_info, ckpt)
+
+        # Stage the IOS-XE packages, if requested.
+        with tracer.span("prestage_install"):
+            prestage_install(nmri, device, upgrade_file_info, ckpt)
+
+        # Set the boot images / check the install impact, if requested.
+        with tracer.span("prestage_boot"):
+            prestage_boot(nmri, device, upgrade_file_info, ks_upgrade_info,
+                          ckpt)
 
     # NOTE: NX-OS does not need the images copied.
     # 'install all' will handle this.
     #if device.os == "NX-OS":
 
     # Success
+    if not dry_run:
+        save_device_facts(nmri, device,
+                          [item['Filename'] for item in manifest])
+    mark_stage(nmri, ckpt, "complete")
     return
 
 if __name__ == "__main__":
@@ -1289,7 +1976,15 @@ if __name__ == "__main__":
     reclaim = True if attempt_storage_space_reclaim_if_full == "on" else False
     ovr_repo = True if override_automatic_repo_selection == "on" else False
     enable_debug = True if enable_debug == "on" else False
+    enable_profiling = True if enable_profiling == "on" else False
     nxos_use_mgmt_vrf = True if nxos_use_mgmt_vrf == "on" else False
+    iosxe_prestage_install = (True if iosxe_prestage_install == "on"
+                              else False)
+    prestage_boot_vars = True if prestage_boot_vars == "on" else False
+    use_target_rules = True if use_target_rules == "on" else False
+    record_cassette = True if record_cassette == "on" else False
+    use_transfer_history = True if use_transfer_history == "on" else False
+    tune_http_client = True if tune_http_client == "on" else False
     # TODO: Check repo_host_override .. is it an IP? Is it valid?
     if ovr_repo and repo_host_override == "IP Address":
         raise ValueError("Invalid repo override host.")
@@ -1325,6 +2020,70 @@ if __name__ == "__main__":
         "batch_id": batch_id,
     }
 
-    with NetMRIEasy(enable_debug, **easyparams) as nmri:
-        main(nmri)
-    nmri.log_message("notif", "Software transfer completed.")
+    # Log messages are batched by EventLog, and also written as JSON lines to
+    # {LOCAL_STATE_DIR}/events/{job_id}-{device_id}.jsonl
+    events_path = os.path.join(LOCAL_STATE_DIR, "events",
+                               f"{job_id}-{device_id}.jsonl")
+    metrics = JobMetrics(METRICS_DIR, METRICS_PREFIX, METRICS_HELP)
+    tracer = JobTrace("na_ciscoswtransfer", {"netmri.job_id": job_id,
+                                             "netmri.batch_id": batch_id,
+                                             "netmri.device_id": device_id})
+    with NetMRIEasy(enable_debug, **easyparams) as easy:
+        if record_cassette:
+            # The checkpoint decides where the job resumes. Keep it, so the
+            # replay resumes at the same stage.
+            try:
+                with open(os.path.join(LOCAL_STATE_DIR, "checkpoints",
+                                       f"{device_id}.json"), "r") as f:
+                    checkpoint = json.load(f)
+            except (OSError, ValueError):
+                checkpoint = None
+            easy = CassetteRecorder(
+                easy, {name: globals()[name] for name in JOB_SETTINGS},
+                checkpoint
+            )
+        nmri = EventLog(easy, events_path, job_id, device_id)
+        # The transfer history is only an aid. Carry on without it.
+        try:
+            history = TransferHistory(HISTORY_FILE)
+        except (OSError, sqlite3.Error) as err:
+            history = None
+            nmri.log_message("warn", "Unable to open the transfer history"
+                             f" {HISTORY_FILE}: {err}")
+        job_result = "failed"
+        try:
+            with tracer.span("job", dry_run=dry_run):
+                if enable_profiling:
+                    profile_main(nmri)
+                else:
+                    main(nmri)
+            job_result = "success"
+            set_phase("complete")
+            nmri.log_message("notif", "Software transfer completed.")
+        finally:
+            metrics.inc("jobs_total", result=job_result)
+            # Dry runs don't transfer anything. Keep them out of the totals.
+            if not dry_run:
+                try:
+                    metrics.write(METRICS_FILE)
+                except OSError as err:
+                    nmri.log_message("warn", "Unable to write metrics to"
+                                     f" {METRICS_DIR}: {err}")
+            try:
+                tracer.write(os.path.join(TRACES_DIR,
+                                          f"{job_id}-{device_id}.json"))
+            except OSError as err:
+                nmri.log_message("warn", "Unable to write trace to"
+                                 f" {TRACES_DIR}: {err}")
+            if record_cassette:
+                easy.result = job_result
+                try:
+                    easy.save(os.path.join(CASSETTES_DIR,
+                                           f"{job_id}-{device_id}.json.gz"))
+                except OSError as err:
+                    nmri.log_message("warn", "Unable to write cassette to"
+                                     f" {CASSETTES_DIR}: {err}")
+            if history:
+                history.close()
+            # Flush everything still buffered, even if the job failed.
+            nmri.close()
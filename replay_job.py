@@ -0,0 +1,238 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# replay_job.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Replays session cassettes recorded by the Cisco OS Software Transfer job
+#   ('record_cassette', see JobCassette.py) through the job's main(),
+#   without NetMRI or the devices.
+#
+#   For every cassette, main() runs with the recorded settings and device,
+#   and its CLI commands and broker calls are answered from the cassette
+#   (JobCassette.CassetteEasy). The job's local state (checkpoints, facts,
+#   metrics, traces) goes to a temporary directory, starting from the
+#   recorded checkpoint.
+#
+#   A replay fails if:
+#       - the job ends differently than it did when it was recorded,
+#       - it sends a command (or broker call) that isn't in the cassette, or
+#         sends it more times than it was recorded.
+#   With the default strict replay, the commands must also come in the
+#   recorded order, and all of them must be sent. --loose allows fewer, and
+#   reordered, commands (e.g: to check a batching or caching change). The
+#   report then shows how many commands, and how much of the recorded time,
+#   the change saved.
+#
+# USAGE:
+#   python replay_job.py cassettes/
+#   python replay_job.py cassettes/7-31.json.gz --loose --time-scale 0.1
+#   python replay_job.py cassettes/ -o report.json
+#
+# NOTES:
+#   1. The job imports infoblox_netmri. If it isn't installed, a stand-in
+#      module with CassetteEasy as NetMRIEasy is registered, since the
+#      replay never uses the real one.
+#   2. --time-scale 1 waits for every command as long as it took when it
+#      was recorded. The default (0) doesn't wait, and the recorded time of
+#      the replayed commands is added up instead.
+#------------------------------------------------------------------------------
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+from EventLog import EventLog
+from JobCassette import CassetteEasy, load_cassette
+from JobMetrics import JobMetrics
+from JobTrace import JobTrace
+
+JOB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "na_ciscoswtransfer.py")
+
+
+def _netmri_module():
+    # The job imports NetMRIEasy, but the replay never calls it.
+    if importlib.util.find_spec("infoblox_netmri") is None:
+        package = types.ModuleType("infoblox_netmri")
+        easy = types.ModuleType("infoblox_netmri.easy")
+        easy.NetMRIEasy = CassetteEasy
+        package.easy = easy
+        sys.modules["infoblox_netmri"] = package
+        sys.modules["infoblox_netmri.easy"] = easy
+
+
+def load_job(state_dir, settings):
+    """Load a fresh copy of the job module, with its local state in
+    'state_dir', and the recorded settings as its globals.
+
+    Returns:
+        module: The job, ready for main(). (nmri, metrics and tracer are
+                still to be set)
+    """
+    spec = importlib.util.spec_from_file_location("na_ciscoswtransfer_replay",
+                                                  JOB_FILE)
+    job = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(job)
+    job.LOCAL_STATE_DIR = state_dir
+    job.METRICS_DIR = os.path.join(state_dir, "metrics")
+    job.TRACES_DIR = os.path.join(state_dir, "traces")
+    job.PROFILES_DIR = os.path.join(state_dir, "profiles")
+    job.CASSETTES_DIR = os.path.join(state_dir, "cassettes")
+    for name, value in settings.items():
+        setattr(job, name, value)
+    return job
+
+
+def replay(path, time_scale=0.0, strict=True):
+    """Replay one cassette through the job's main().
+
+    Returns:
+        dict: The replay report, with keys:
+            - 'cassette' (str), 'device' (str): Cassette file, and device.
+            - 'recorded_result', 'result' (str): "success" or "failed".
+            - 'error' (str): Why the replay failed, or None.
+            - 'job_error' (str): The exception the job failed with, if any.
+            - 'recorded_commands', 'commands' (int): CLI commands sent.
+            - 'recorded_seconds', 'seconds' (float): Recorded time of all
+              the interactions, and of the replayed ones.
+            - 'unused' (int): Interactions that weren't replayed.
+            - 'wall_seconds' (float): How long the replay took.
+    """
+    cassette = load_cassette(path)
+    interactions = cassette['interactions']
+    easy = CassetteEasy(cassette, time_scale, strict)
+    settings = cassette['settings']
+    report = {
+        "cassette": path,
+        "device": (cassette.get("device") or {}).get("DeviceName"),
+        "recorded_result": cassette.get("result"),
+        "result": "failed",
+        "error": None,
+        "job_error": None,
+        "recorded_commands": sum(item['kind'] == "cli"
+                                 for item in interactions),
+        "commands": 0,
+        "recorded_seconds": round(sum(item.get("elapsed", 0)
+                                      for item in interactions), 3),
+        "seconds": 0.0,
+        "unused": 0,
+        "wall_seconds": 0.0
+    }
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory() as state_dir:
+        if cassette.get("checkpoint"):
+            checkpoint = dict(cassette['checkpoint'], updated=time.time())
+            os.makedirs(os.path.join(state_dir, "checkpoints"))
+            with open(os.path.join(state_dir, "checkpoints",
+                                   f"{checkpoint['DeviceID']}.json"),
+                      "w") as f:
+                json.dump(checkpoint, f)
+        job = load_job(state_dir, settings)
+        job.nmri = EventLog(easy, None, settings.get("job_id"),
+                            settings.get("device_id"))
+        job.metrics = JobMetrics(job.METRICS_DIR, job.METRICS_PREFIX,
+                                 job.METRICS_HELP)
+        job.tracer = JobTrace("na_ciscoswtransfer", {})
+        # Replays aren't transfers. Keep them out of the history.
+        job.history = None
+        try:
+            job.main(job.nmri)
+            report['result'] = "success"
+        except Exception as err:
+            # The job failing is only an error if it didn't fail the same
+            # way when it was recorded.
+            report['job_error'] = f"{type(err).__name__}: {err}"
+        finally:
+            job.nmri.close()
+    report['wall_seconds'] = round(time.monotonic() - started, 3)
+    report['commands'] = sum(interactions[index]['kind'] == "cli"
+                             for index in easy.served)
+    report['seconds'] = round(easy.latency, 3)
+    report['unused'] = len(easy.unused())
+
+    if easy.mismatches:
+        # Reported even if the job caught it, and carried on.
+        report['error'] = f"CassetteMismatch: {easy.mismatches[0]}"
+    elif (report['recorded_result']
+            and report['result'] != report['recorded_result']):
+        report['error'] = (f"Job result {report['result']}, recorded"
+                           f" {report['recorded_result']}")
+        if report['job_error']:
+            report['error'] += f" ({report['job_error']})"
+    elif strict and report['unused']:
+        report['error'] = (f"{report['unused']} recorded interactions were"
+                           " not replayed")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay Cisco OS Software Transfer session cassettes"
+        " through the job, without NetMRI or the devices."
+    )
+    parser.add_argument("cassettes", nargs="+",
+                        help="Cassette files, or directories of them.")
+    parser.add_argument("--loose", action="store_true",
+                        help="Allow fewer, and reordered, commands.")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="Wait this times the recorded time of each"
+                        " command. (Default: 0, don't wait)")
+    parser.add_argument("-o", "--output",
+                        help="Write the reports to this JSON file.")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.cassettes:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "*.json"))
+                                + glob.glob(os.path.join(path, "*.json.gz"))))
+        else:
+            paths.append(path)
+    if not paths:
+        parser.error("no cassettes found")
+
+    _netmri_module()
+    reports = []
+    for path in paths:
+        report = replay(path, args.time_scale, not args.loose)
+        reports.append(report)
+        status = "FAIL" if report['error'] else "ok"
+        print(f"{status:<4} {os.path.basename(path)}"
+              f" ({report['device']}): {report['result']},"
+              f" {report['commands']}/{report['recorded_commands']} commands,"
+              f" {report['seconds']:.1f}/{report['recorded_seconds']:.1f}s"
+              f" recorded, {report['wall_seconds']:.2f}s wall")
+        if report['error']:
+            print(f"     {report['error']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=1)
+    failed = sum(1 for report in reports if report['error'])
+    print(f"Replayed {len(reports)} cassettes, {failed} failed.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
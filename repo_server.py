@@ -0,0 +1,799 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# repo_server.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   HTTP image repo server, for the regional repos (or as a local stand-in
+#   for one, when testing the job).
+#
+#   The job copies http://{repo}{repo_directory_path}/{Filename}. This
+#   server only serves the files of the Cisco OS SW Hashes list, found
+#   anywhere under the repo directory, and only if their size matches the
+#   list. Everything else is a 404.
+#
+#   Files are sent with sendfile() (zero-copy), in chunks, so every chunk
+#   can go through the rate limits: one per client address (shared by all of
+#   its connections), and one for the whole server. Single byte ranges are
+#   supported, so an interrupted copy can be resumed.
+#
+#   GET /metrics returns the requests, bytes sent, transfer durations and
+#   rate limit waits, by file and client, in the Prometheus text format.
+#
+#   With --cache-from, the repo is a cache of the master repo, for small
+#   regional appliances that can't hold every image. An image is pulled from
+#   the master the first time it's requested (once, for all the devices
+#   asking for it), checked against the hash list, and kept while the cache
+#   is under --quota. To make room, the images that the fewest devices still
+#   need are evicted first, then the least often, and least recently,
+#   requested ones (LFU, then LRU). An image being served is never evicted.
+#   How many devices need an image comes from a fleet_plan.py plan: the
+#   devices planned to transfer it (from this repo, with --repo-address),
+#   less the ones that downloaded it since.
+#
+# USAGE:
+#   python repo_server.py /srv/repo -l cisco_os_sw_hashes.csv \
+#       --prefix /pub/cisco --port 80 --rate 2000 --client-rate 100
+#
+#   As a cache of the master repo, holding at most 200 GB:
+#   python repo_server.py /srv/cache -l cisco_os_sw_hashes.csv \
+#       --cache-from http://10.0.0.1/pub/cisco --quota 200 -p plan.json \
+#       --repo-address 10.1.0.1
+#
+#   As a stand-in repo, in a test:
+#       server = RepoServer(("127.0.0.1", 0), "/tmp/repo", hash_rows)
+#       threading.Thread(target=server.serve_forever, daemon=True).start()
+#
+# NOTES:
+#   1. The hash list and the repo directory (and the plan) are read at
+#      startup. Send a SIGHUP to read them again (e.g: after
+#      build_hash_list.py).
+#   2. Without --prefix, a file is served from any directory path. With it,
+#      only from {prefix}/{Filename} (the job's repo_directory_path).
+#   3. Rates are in Mbps, like fleet_plan.py and fleet_schedule.py.
+#      0 means unlimited.
+#   4. Multiple ranges in one request aren't supported. The whole file is
+#      sent instead, as RFC 7233 allows.
+#   5. In cache mode, the images are kept in the repo directory itself, and
+#      the ones already there count towards the quota. Images that are
+#      dropped from the hash list are deleted on the next SIGHUP. A request
+#      for an image that can't be pulled from the master gets a 502, and
+#      one that doesn't fit in the quota (everything else is being served)
+#      gets a 503.
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import email.utils
+import hashlib
+import http.server
+import json
+import os
+import posixpath
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from build_hash_list import scan_repo
+from JobMetrics import JobMetrics
+
+# Largest sendfile() call. Also the most a rate limit lets through at once.
+CHUNK = 1024 * 1024
+# Smallest chunk, for slow rate limits.
+MIN_CHUNK = 64 * 1024
+# Socket timeout when pulling an image from the master repo, in seconds.
+FETCH_TIMEOUT = 60
+METRICS_PREFIX = "ciscoswrepo_"
+METRICS_HELP = {
+    "ciscoswrepo_requests_total": "Requests, by file, client and status.",
+    "ciscoswrepo_sent_bytes_total": "Bytes sent, by file and client.",
+    "ciscoswrepo_transfers_total": "File transfers, by file and result.",
+    "ciscoswrepo_transfer_duration_seconds": "File transfer duration.",
+    "ciscoswrepo_rate_limited_seconds_total": "Time spent waiting on the"
+    " rate limits, by client.",
+    "ciscoswrepo_cache_requests_total": "Cache lookups, by file and result"
+    " (hit or miss).",
+    "ciscoswrepo_cache_fetched_bytes_total": "Bytes pulled from the master"
+    " repo, by file.",
+    "ciscoswrepo_cache_fetch_errors_total": "Failed pulls from the master"
+    " repo, by file.",
+    "ciscoswrepo_cache_evictions_total": "Images evicted from the cache, by"
+    " file.",
+}
+
+
+def load_csv(path):
+    """Read a CSV file into a list of dicts."""
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def build_index(root, hash_rows):
+    """Find the files of the hash list in the repo directory.
+
+    Args:
+        - root (str): Repo directory.
+        - hash_rows (list): Cisco OS SW Hashes rows.
+
+    Returns:
+        tuple: (index, problems)
+            - index (dict): Keyed by Filename, with values:
+                - 'path' (str), 'size' (int), 'md5' (str), 'mtime' (float)
+            - problems (list): Why a Filename isn't served (str).
+    """
+    found = {}
+    # scan_repo() walks the tree in no particular order. The first path in
+    # sorted order wins, like build_hash_list.py.
+    for relpath, (_, size, mtime_ns) in sorted(scan_repo(root).items()):
+        found.setdefault(os.path.basename(relpath),
+                         (relpath, size, mtime_ns / 1e9))
+    index = {}
+    problems = []
+    for row in hash_rows:
+        name = row['Filename']
+        size = int(str(row['Size']).replace(",", ""))
+        if name not in found:
+            problems.append(f"{name}: not in {root}")
+            continue
+        relpath, actual, mtime = found[name]
+        if actual != size:
+            problems.append(f"{relpath}: {actual} bytes, the hash list says"
+                            f" {size}")
+            continue
+        index[name] = {"path": os.path.join(root, relpath), "size": size,
+                       "md5": row.get("MD5", "").lower(), "mtime": mtime}
+    return (index, problems)
+
+
+def parse_range(header, size):
+    """Parse a Range header, for a file of 'size' bytes.
+
+    Returns:
+        tuple: (start, end), inclusive. None to send the whole file (no
+               range, or one this server doesn't support).
+
+    Raises:
+        ValueError if the range is past the end of the file, or empty (416).
+    """
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if (first is None and last is None) or min(first or 0, last or 0) < 0:
+        return None
+    if first is None:
+        # bytes=-N is the last N bytes.
+        if not last:
+            raise ValueError(f"{header} is empty")
+        return (max(size - last, 0), size - 1)
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError(f"{header} is past the end of {size} bytes")
+    return (first, size - 1 if last is None else min(last, size - 1))
+
+
+def load_demand(plan, repo_address=None):
+    """Count the devices that still need each image, from a fleet_plan.py
+    plan.
+
+    Args:
+        - plan (dict): fleet_plan.py output.
+        - repo_address (str): Only the devices planned from this repo.
+
+    Returns:
+        dict: Number of devices, keyed by Filename.
+    """
+    demand = {}
+    for device in plan['devices']:
+        if device['status'] != "transfer":
+            continue
+        if repo_address and device.get("repo") != repo_address:
+            continue
+        for name in device['targets']:
+            demand[name] = demand.get(name, 0) + 1
+    return demand
+
+
+class CacheFull(Exception):
+    """An image doesn't fit in the cache quota."""
+
+
+class RepoCache:
+    """The images of the hash list, pulled from the master repo on first
+    request, and kept under a disk quota.
+
+    Args:
+        - root (str): Cache directory.
+        - hash_rows (list): Cisco OS SW Hashes rows.
+        - master_url (str): URL of the master repo image directory.
+        - quota (int): Bytes the cached images can use.
+        - demand (dict): From load_demand().
+        - record (callable): Records a metric, like RepoServer.record().
+    """
+
+    def __init__(self, root, hash_rows, master_url, quota, demand=None,
+                 record=None):
+        self.root = root
+        self.master_url = master_url.rstrip("/")
+        self.quota = quota
+        self.demand = demand or {}      # Filename -> devices (planned)
+        self.record = record or (lambda method, *args, **labels: None)
+        self.lock = threading.Condition()
+        self.rows = {}                  # Filename -> hash list row
+        self.entries = {}               # Filename -> cached image
+        self.fetching = set()           # Filenames being pulled
+        self.reserved = 0               # Bytes of the images being pulled
+        self.served = {}                # Filename -> clients that got it
+        self.load(hash_rows)
+
+    def load(self, hash_rows):
+        """(Re)load the hash list, and the images already in the cache."""
+        rows = {row['Filename']: row for row in hash_rows}
+        index, _ = build_index(self.root, hash_rows)
+        with self.lock:
+            for name, entry in self.entries.items():
+                if name not in rows and not entry['users']:
+                    self._remove(entry)
+            for name, entry in index.items():
+                old = self.entries.get(name, {})
+                entry['hits'] = old.get("hits", 0)
+                entry['last_used'] = old.get("last_used", entry['mtime'])
+                entry['users'] = old.get("users", 0)
+            # Images being served stay, even if they're off the list.
+            self.entries = {**{name: entry
+                               for name, entry in self.entries.items()
+                               if entry['users'] and name not in index},
+                            **index}
+            self.rows = rows
+
+    def used(self):
+        """Bytes used by the cached images, and the ones being pulled."""
+        return (sum(entry['size'] for entry in self.entries.values())
+                + self.reserved)
+
+    def remaining(self, name):
+        """Devices that still need an image."""
+        return max(self.demand.get(name, 0) - len(self.served.get(name, ())),
+                   0)
+
+    def acquire(self, name):
+        """The cached image, pulled from the master first if needed. It
+        can't be evicted until release().
+
+        Returns:
+            dict: Entry with keys 'path', 'size', 'md5', 'mtime'.
+
+        Raises:
+            CacheFull if there's no room for it.
+            OSError if it couldn't be pulled from the master.
+            ValueError if the pulled image doesn't match the hash list.
+        """
+        with self.lock:
+            # Only one pull per image. The other requests wait for it.
+            while name in self.fetching:
+                self.lock.wait()
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry['users'] += 1
+                entry['hits'] += 1
+                entry['last_used'] = time.time()
+                self.record("inc", "cache_requests_total", file=name,
+                            result="hit")
+                return entry
+            row = self.rows[name]
+            size = int(str(row['Size']).replace(",", ""))
+            self._make_room(size)
+            self.fetching.add(name)
+            self.reserved += size
+        self.record("inc", "cache_requests_total", file=name, result="miss")
+        entry = None
+        try:
+            entry = self._fetch(name, row, size)
+        except (OSError, ValueError):
+            self.record("inc", "cache_fetch_errors_total", file=name)
+            raise
+        finally:
+            with self.lock:
+                self.fetching.discard(name)
+                self.reserved -= size
+                if entry is not None:
+                    entry.update(hits=1, users=1, last_used=time.time())
+                    self.entries[name] = entry
+                self.lock.notify_all()
+        return entry
+
+    def release(self, name, client=None):
+        """Done serving an image. 'client' got all of it."""
+        with self.lock:
+            self.entries[name]['users'] -= 1
+            if client:
+                self.served.setdefault(name, set()).add(client)
+
+    def _eviction_key(self, name):
+        entry = self.entries[name]
+        return (self.remaining(name), entry['hits'], entry['last_used'])
+
+    def _make_room(self, size):
+        # Called with the lock held.
+        if size > self.quota:
+            raise CacheFull(f"{size} bytes is more than the quota")
+        idle = sorted((name for name, entry in self.entries.items()
+                       if not entry['users']), key=self._eviction_key)
+        while self.used() + size > self.quota:
+            if not idle:
+                raise CacheFull("every cached image is being served")
+            name = idle.pop(0)
+            self._remove(self.entries.pop(name))
+            self.record("inc", "cache_evictions_total", file=name)
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry['path'])
+        except FileNotFoundError:
+            pass
+
+    def _fetch(self, name, row, size):
+        path = os.path.join(self.root, name)
+        tmp_path = os.path.join(self.root, f".{name}.part")
+        md5 = hashlib.md5()
+        sha512 = hashlib.sha512()
+        try:
+            with urllib.request.urlopen(
+                    f"{self.master_url}/{urllib.parse.quote(name)}",
+                    timeout=FETCH_TIMEOUT) as resp, \
+                    open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: resp.read(CHUNK), b""):
+                    md5.update(chunk)
+                    sha512.update(chunk)
+                    f.write(chunk)
+                    self.record("inc", "cache_fetched_bytes_total",
+                                len(chunk), file=name)
+            st = os.stat(tmp_path)
+            if (st.st_size != size
+                    or (row.get("MD5") and md5.hexdigest()
+                        != row['MD5'].strip().lower())
+                    or (row.get("SHA512") and sha512.hexdigest()
+                        != row['SHA512'].strip().lower())):
+                raise ValueError(f"{name} from the master doesn't match the"
+                                 " hash list")
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return {"path": path, "size": size, "md5": md5.hexdigest(),
+                "mtime": st.st_mtime}
+
+
+class RateLimit:
+    """Token bucket, in bytes per second. Shared by every connection it
+    limits."""
+
+    def __init__(self, mbps):
+        self.rate = mbps * 1e6 / 8      # Bytes per second, 0 is unlimited
+        # Up to 1/4s worth of data at once, so slow limits stay smooth.
+        self.burst = (min(CHUNK, max(MIN_CHUNK, int(self.rate / 4)))
+                      if self.rate else CHUNK)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        """Wait until 'size' bytes (at most 'burst') can be sent.
+
+        Returns:
+            float: Seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            # Callers queue up by taking tokens they don't have yet. Each one
+            # waits for its own debt.
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RepoServer(http.server.ThreadingHTTPServer):
+    """Serves the files of the hash list from 'root'.
+
+    Args:
+        - address (tuple): (host, port) to listen on.
+        - root (str): Repo directory.
+        - hash_rows (list): Cisco OS SW Hashes rows.
+        - prefix (str): Directory path the files are served from. Any, if
+                        empty.
+        - rate (float): Server rate limit, in Mbps.
+        - client_rate (float): Rate limit of each client address, in Mbps.
+        - client_connections (int): Concurrent downloads per client address.
+                                    More get a 503. (0 is unlimited)
+        - quiet (bool): Don't log every request to stderr.
+        - cache (dict): Cache mode settings, RepoCache arguments:
+                        'master_url', 'quota', and 'demand'.
+    """
+    daemon_threads = True
+    # Batches of devices start their copies at the same time.
+    request_queue_size = 256
+
+    def __init__(self, address, root, hash_rows, prefix="", rate=0,
+                 client_rate=0, client_connections=0, quiet=False,
+                 cache=None):
+        self.root = root
+        self.prefix = "/" + prefix.strip("/") if prefix.strip("/") else ""
+        self.client_rate = client_rate
+        self.client_connections = client_connections
+        self.quiet = quiet
+        self.limit = RateLimit(rate)
+        self.clients = {}               # Address -> [RateLimit, downloads]
+        self.lock = threading.Lock()    # For clients and metrics
+        self.metrics = JobMetrics(None, METRICS_PREFIX, METRICS_HELP)
+        self.problems = []
+        self.index = {}
+        self.cache = None
+        if cache:
+            self.cache = RepoCache(root, hash_rows, record=self.record,
+                                   **cache)
+        else:
+            self.load(hash_rows)
+        super().__init__(address, RepoHandler)
+
+    def load(self, hash_rows):
+        """(Re)build the file index. Downloads in progress carry on."""
+        if self.cache:
+            self.cache.load(hash_rows)
+        else:
+            self.index, self.problems = build_index(self.root, hash_rows)
+
+    def lookup(self, path):
+        """The Filename of a request path, if it can be served."""
+        if self.prefix:
+            if not path.startswith(self.prefix + "/"):
+                return None
+            name = path[len(self.prefix) + 1:]
+        else:
+            name = posixpath.basename(path)
+        if name in (self.cache.rows if self.cache else self.index):
+            return name
+        return None
+
+    def open_client(self, address):
+        """Start a download for a client. Returns its RateLimit, or None if
+        it has too many downloads already."""
+        with self.lock:
+            client = self.clients.get(address)
+            if client is None:
+                client = self.clients[address] = [
+                    RateLimit(self.client_rate), 0
+                ]
+            if (self.client_connections
+                    and client[1] >= self.client_connections):
+                return None
+            client[1] += 1
+            return client[0]
+
+    def close_client(self, address):
+        with self.lock:
+            client = self.clients[address]
+            client[1] -= 1
+            if not client[1]:
+                del self.clients[address]
+
+    def record(self, method, *args, **labels):
+        """Call a JobMetrics method, from any thread."""
+        with self.lock:
+            getattr(self.metrics, method)(*args, **labels)
+
+    def render_metrics(self):
+        with self.lock:
+            text = self.metrics.render()
+            active = sum(client[1] for client in self.clients.values())
+        gauges = [("active_downloads", "Downloads in progress.", "",
+                   active)]
+        if self.cache:
+            with self.cache.lock:
+                gauges.append(("files", "Cached images.", "",
+                               len(self.cache.entries)))
+                gauges.append(("cache_used_bytes", "Bytes used by the"
+                               " cache.", "", self.cache.used()))
+                gauges.append(("cache_quota_bytes", "Cache quota.", "",
+                               self.cache.quota))
+                for name in sorted(self.cache.demand):
+                    gauges.append(("cache_demand_devices", "Devices that"
+                                   " still need an image.",
+                                   f'{{file="{name}"}}',
+                                   self.cache.remaining(name)))
+        else:
+            gauges.append(("files", "Files served.", "", len(self.index)))
+        lines = []
+        for name, help_text, labels, value in gauges:
+            name = METRICS_PREFIX + name
+            if not lines or not lines[-1].startswith(name + "{"):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{labels} {value}")
+        return text + "\n".join(lines) + "\n"
+
+
+class RepoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ciscoswrepo/1"
+    # Drop stalled clients.
+    timeout = 120
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.serve(head=False)
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def send_text(self, status, text, content_type="text/plain"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def serve(self, head):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if path == "/metrics":
+            self.send_text(200, self.server.render_metrics(),
+                           "text/plain; version=0.0.4")
+            return
+        client = self.client_address[0]
+        name = self.server.lookup(path)
+        if name is None:
+            self.server.record("inc", "requests_total", file="",
+                               client=client, status=404)
+            self.send_error(404)
+            return
+        limit = self.server.open_client(client)
+        if limit is None:
+            self.server.record("inc", "requests_total", file=name,
+                               client=client, status=503)
+            self.send_response(503, "Too many downloads from this client")
+            self.send_header("Retry-After", "30")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            cache = self.server.cache
+            if cache is None:
+                self.send_file(name, self.server.index[name], limit, client,
+                               head)
+                return
+            try:
+                entry = cache.acquire(name)
+            except CacheFull as err:
+                self.server.record("inc", "requests_total", file=name,
+                                   client=client, status=503)
+                self.send_error(503, f"Cache full: {err}")
+                return
+            except (OSError, ValueError) as err:
+                self.server.record("inc", "requests_total", file=name,
+                                   client=client, status=502)
+                self.send_error(502, f"Unable to pull from the master: {err}")
+                return
+            complete = False
+            try:
+                complete = self.send_file(name, entry, limit, client, head)
+            finally:
+                cache.release(name, client if complete else None)
+        finally:
+            self.server.close_client(client)
+
+    def send_file(self, name, entry, limit, client, head):
+        """Send (part of) a file.
+
+        Returns:
+            bool: Whether the client now has all of it (the request went
+                  through the end of the file).
+        """
+        size = entry['size']
+        etag = f'"{entry["md5"]}"'
+        span = None
+        header = self.headers.get("Range")
+        # A resumed copy of a file that changed since starts over.
+        if header and self.headers.get("If-Range", etag) == etag:
+            try:
+                span = parse_range(header, size)
+            except ValueError:
+                self.server.record("inc", "requests_total", file=name,
+                                   client=client, status=416)
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return False
+        start, end = span or (0, size - 1)
+        status = 206 if span else 200
+
+        try:
+            f = open(entry['path'], "rb")
+        except OSError:
+            f = None
+        # Replaced or truncated since the index was built.
+        if f is None or os.fstat(f.fileno()).st_size != size:
+            if f:
+                f.close()
+            self.server.record("inc", "requests_total", file=name,
+                               client=client, status=503)
+            self.send_error(503, "File changed, the index must be reloaded")
+            return False
+        with f:
+            self.server.record("inc", "requests_total", file=name,
+                               client=client, status=status)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", email.utils.formatdate(
+                entry['mtime'], usegmt=True))
+            if entry['md5']:
+                self.send_header("ETag", etag)
+            if span:
+                self.send_header("Content-Range",
+                                 f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if head:
+                return False
+
+            started = time.monotonic()
+            offset = start
+            remaining = end - start + 1
+            waited = 0.0
+            result = "complete"
+            try:
+                while remaining:
+                    count = min(remaining, limit.burst,
+                                self.server.limit.burst)
+                    waited += limit.take(count)
+                    waited += self.server.limit.take(count)
+                    sent = self.connection.sendfile(f, offset, count)
+                    if not sent:
+                        raise OSError("file truncated")
+                    offset += sent
+                    remaining -= sent
+                    self.server.record("inc", "sent_bytes_total", sent,
+                                       file=name, client=client)
+            except OSError:
+                # Client went away (or timed out). It can resume with a
+                # range.
+                result = "aborted"
+                self.close_connection = True
+            self.server.record("inc", "transfers_total", file=name,
+                               result=result)
+            if waited:
+                self.server.record("inc", "rate_limited_seconds_total",
+                                   round(waited, 3), client=client)
+            if result == "complete":
+                self.server.record("observe", "transfer_duration_seconds",
+                                   time.monotonic() - started, file=name)
+            return result == "complete" and end == size - 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve the images of the Cisco OS SW Hashes list over"
+        " HTTP, with sendfile(), range requests and rate limits."
+    )
+    parser.add_argument("root", help="Repo directory.")
+    parser.add_argument("-l", "--hash-list", required=True,
+                        help="Cisco OS SW Hashes CSV.")
+    parser.add_argument("--prefix", default="",
+                        help="Serve the files from this directory path only"
+                        " (e.g: /pub/cisco).")
+    parser.add_argument("--bind", default="",
+                        help="Address to listen on. (Default: all)")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Server rate limit, in Mbps.")
+    parser.add_argument("--client-rate", type=float, default=0,
+                        help="Rate limit per client address, in Mbps.")
+    parser.add_argument("--client-connections", type=int, default=0,
+                        help="Concurrent downloads per client address.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Don't log every request.")
+    parser.add_argument("--cache-from",
+                        help="Cache mode: URL of the master repo image"
+                        " directory.")
+    parser.add_argument("--quota", type=float,
+                        help="Cache mode: disk quota, in GB.")
+    parser.add_argument("-p", "--plan",
+                        help="Cache mode: fleet_plan.py plan, for the"
+                        " devices that still need each image.")
+    parser.add_argument("--repo-address",
+                        help="Cache mode: only count the devices planned"
+                        " from this repo address.")
+    args = parser.parse_args(argv)
+    if args.cache_from and not args.quota:
+        parser.error("--cache-from needs a --quota")
+
+    def load_plan():
+        if not args.plan:
+            return {}
+        with open(args.plan, "r") as f:
+            return load_demand(json.load(f), args.repo_address)
+
+    cache = None
+    if args.cache_from:
+        cache = {"master_url": args.cache_from,
+                 "quota": int(args.quota * 1e9), "demand": load_plan()}
+    server = RepoServer((args.bind, args.port), args.root,
+                        load_csv(args.hash_list), args.prefix, args.rate,
+                        args.client_rate, args.client_connections,
+                        args.quiet, cache)
+
+    def report():
+        if server.cache:
+            print(f"Caching {len(server.cache.rows)} files from"
+                  f" {args.cache_from} in {args.root}"
+                  f" ({len(server.cache.entries)} cached,"
+                  f" {server.cache.used() / 1e9:.2f}/{args.quota} GB) on"
+                  f" port {server.server_address[1]}", file=sys.stderr)
+            return
+        for problem in server.problems:
+            print(f"WARNING: Not serving {problem}", file=sys.stderr)
+        print(f"Serving {len(server.index)} files from {args.root} on"
+              f" port {server.server_address[1]}", file=sys.stderr)
+
+    def reload(signum, frame):
+        try:
+            server.load(load_csv(args.hash_list))
+            if server.cache:
+                server.cache.demand = load_plan()
+        except (OSError, ValueError, KeyError) as err:
+            print(f"ERROR: Reload failed, keeping the old index: {err}",
+                  file=sys.stderr)
+            return
+        report()
+
+    report()
+    signal.signal(signal.SIGHUP, reload)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# repo_sync.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Replicates the images of the Cisco OS SW Hashes list from the master
+#   repo to the regional repos, and reports which repos are compliant.
+#
+#   Each repo directory is compared with the hash list by size, MD5 and
+#   SHA-512. Only the files that are missing, or don't match, are copied
+#   (to the same path as in the master repo). Every copy is hashed again
+#   before it replaces the old file, so a repo never serves a bad image.
+#
+#   File hashes are kept in the same manifest as build_hash_list.py
+#   (<repo>/.hashlist_manifest.json), so only new or changed files are
+#   hashed on the next run.
+#
+#   Repos are synced in parallel. Each repo gets at most --per-repo copies
+#   at once (its link), and --jobs bounds the copies of all the repos.
+#
+# USAGE:
+#   python repo_sync.py /srv/repo/pub/cisco -l cisco_os_sw_hashes.csv \
+#       -m repo_paths.csv -o report.json
+#
+#   Only the repos of a region, from the regional repos list:
+#   python repo_sync.py /srv/repo/pub/cisco -l cisco_os_sw_hashes.csv \
+#       -m repo_paths.csv -r cisco_os_sw_regional_repos.csv --region Region
+#
+# NOTES:
+#   1. The repo map CSV has the columns Address (as in the regional repos
+#      list) and Path. The path is the repo's image directory, as mounted on
+#      this host (e.g: NFS, SMB, sshfs). A path that doesn't exist is
+#      reported as unreachable, and nothing is copied to it.
+#   2. With -r, a repo of the list without a path in the map is reported as
+#      unmapped.
+#   3. Files that aren't in the hash list are left alone.
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from build_hash_list import (hash_file, load_manifest, save_manifest,
+                             update_manifest)
+
+MANIFEST_NAME = ".hashlist_manifest.json"
+# Repo status.
+STATUS_COMPLIANT = "compliant"
+STATUS_NON_COMPLIANT = "non_compliant"
+STATUS_UNREACHABLE = "unreachable"
+STATUS_UNMAPPED = "unmapped"
+
+
+def load_csv(path):
+    """Read a CSV file into a list of dicts."""
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def load_repos(map_rows, repo_rows=None, region=None):
+    """The repos to sync.
+
+    Args:
+        - map_rows (list): Repo map rows (Address, Path).
+        - repo_rows (list): Cisco OS SW Regional Repos rows. If given, only
+                            these repos are synced.
+        - region (str): Only the repos of this region (with repo_rows).
+
+    Returns:
+        list: Dicts with keys 'address' and 'path' (None if unmapped).
+    """
+    paths = {row['Address'].strip(): row['Path'].strip() for row in map_rows}
+    if repo_rows is None:
+        return [{"address": address, "path": path}
+                for address, path in paths.items()]
+    repos = []
+    seen = set()
+    for row in repo_rows:
+        address = row['Address'].strip()
+        if (region and row['Region'] != region) or address in seen:
+            continue
+        seen.add(address)
+        repos.append({"address": address, "path": paths.get(address)})
+    return repos
+
+
+def repo_manifest(path, rehash=False):
+    """Hash the files of a repo that changed since the last run.
+
+    Returns:
+        dict: The build_hash_list.py manifest of the repo. (Not saved)
+    """
+    return update_manifest(path, load_manifest(os.path.join(
+        path, MANIFEST_NAME)), rehash)[0]
+
+
+def matches(entry, row):
+    """Whether a manifest entry is the file of a hash list row."""
+    return (entry['size'] == int(str(row['Size']).replace(",", ""))
+            and (not row.get("MD5")
+                 or entry['md5'] == row['MD5'].strip().lower())
+            and (not row.get("SHA512")
+                 or entry['sha512'] == row['SHA512'].strip().lower()))
+
+
+def master_files(manifest, hash_rows):
+    """Find the hash list files in the master repo.
+
+    Returns:
+        tuple: (files, problems)
+            - files (list): (relpath, row) of the files that can be synced,
+                            largest first.
+            - problems (list): Files that can't be synced, and why (str).
+    """
+    by_name = {}
+    for relpath in sorted(manifest['files']):
+        by_name.setdefault(os.path.basename(relpath), relpath)
+    files = []
+    problems = []
+    for row in hash_rows:
+        relpath = by_name.get(row['Filename'])
+        if relpath is None:
+            problems.append(f"{row['Filename']}: not in the master repo")
+        elif not matches(manifest['files'][relpath], row):
+            problems.append(f"{relpath}: doesn't match the hash list in the"
+                            " master repo")
+        else:
+            files.append((relpath, row))
+    files.sort(key=lambda item: -manifest['files'][item[0]]['size'])
+    return (files, problems)
+
+
+def copy_file(src, dest_root, relpath, row):
+    """Copy an image in to a repo, and verify it.
+
+    The copy is written to a hidden .part file first (skipped by
+    build_hash_list.py and repo_server.py), and only replaces the old file
+    once it matches the hash list.
+
+    Returns:
+        dict: The manifest entry of the new file.
+
+    Raises:
+        OSError if the copy failed.
+        ValueError if the copy doesn't match the hash list.
+    """
+    dest = os.path.join(dest_root, relpath)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(dest),
+                            f".{os.path.basename(dest)}.part")
+    try:
+        # copy_file_range()/sendfile() on Linux.
+        shutil.copyfile(src, tmp_path)
+        md5, sha512 = hash_file(tmp_path)
+        st = os.stat(tmp_path)
+        entry = {"inode": st.st_ino, "size": st.st_size,
+                 "mtime_ns": st.st_mtime_ns, "md5": md5, "sha512": sha512}
+        if not matches(entry, row):
+            raise ValueError("the copy doesn't match the hash list")
+        os.replace(tmp_path, dest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return entry
+
+
+def sync_repo(repo, master, files, per_repo, slots, dry_run=False,
+              rehash=False):
+    """Bring one repo up to date with the hash list.
+
+    Args:
+        - repo (dict): From load_repos().
+        - master (str): Master repo directory.
+        - files (list): From master_files().
+        - per_repo (int): Concurrent copies to this repo.
+        - slots (threading.BoundedSemaphore): Concurrent copies, all repos.
+        - dry_run (bool): Only report what would be copied.
+        - rehash (bool): Hash every file of the repo again.
+
+    Returns:
+        dict: The repo report, with keys:
+            - 'address', 'path' (str), 'status' (str)
+            - 'files' (int): Files of the hash list that can be synced.
+            - 'compliant_before', 'compliant' (int): Files that match.
+            - 'missing', 'mismatched' (list): Relpaths, before the sync.
+            - 'copied' (int), 'copied_bytes' (int), 'failed' (list)
+            - 'seconds' (float)
+    """
+    started = time.monotonic()
+    report = {
+        "address": repo['address'],
+        "path": repo['path'],
+        "status": STATUS_NON_COMPLIANT,
+        "files": len(files),
+        "compliant_before": 0,
+        "compliant": 0,
+        "missing": [],
+        "mismatched": [],
+        "copied": 0,
+        "copied_bytes": 0,
+        "failed": [],
+        "seconds": 0.0
+    }
+    if not repo['path']:
+        report['status'] = STATUS_UNMAPPED
+        return report
+    # Never copy to the mount point of a repo that isn't mounted.
+    if not os.path.isdir(repo['path']):
+        report['status'] = STATUS_UNREACHABLE
+        return report
+
+    with slots:
+        manifest = repo_manifest(repo['path'], rehash)
+    pending = []
+    for relpath, row in files:
+        entry = manifest['files'].get(relpath)
+        if entry is None:
+            report['missing'].append(relpath)
+        elif not matches(entry, row):
+            report['mismatched'].append(relpath)
+        else:
+            continue
+        pending.append((relpath, row))
+    report['compliant_before'] = len(files) - len(pending)
+
+    def copy(item):
+        relpath, row = item
+        with slots:
+            try:
+                return (relpath, copy_file(os.path.join(master, relpath),
+                                           repo['path'], relpath, row))
+            except (OSError, ValueError) as err:
+                return (relpath, err)
+
+    if not dry_run:
+        with ThreadPoolExecutor(max_workers=per_repo) as pool:
+            for relpath, result in pool.map(copy, pending):
+                if isinstance(result, Exception):
+                    report['failed'].append(f"{relpath}: {result}")
+                    continue
+                manifest['files'][relpath] = result
+                report['copied'] += 1
+                report['copied_bytes'] += result['size']
+        save_manifest(os.path.join(repo['path'], MANIFEST_NAME), manifest)
+
+    report['compliant'] = report['compliant_before'] + report['copied']
+    if report['compliant'] == len(files):
+        report['status'] = STATUS_COMPLIANT
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Copy the missing or mismatched images of the Cisco OS"
+        " SW Hashes list from the master repo to the regional repos."
+    )
+    parser.add_argument("master", help="Master repo image directory.")
+    parser.add_argument("-l", "--hash-list", required=True,
+                        help="Cisco OS SW Hashes CSV.")
+    parser.add_argument("-m", "--repo-map", required=True,
+                        help="Repo map CSV (Address, Path).")
+    parser.add_argument("-r", "--repos",
+                        help="Cisco OS SW Regional Repos CSV. Only sync"
+                        " these repos.")
+    parser.add_argument("--region", help="Only sync the repos of this region"
+                        " (with -r).")
+    parser.add_argument("--per-repo", type=int, default=2,
+                        help="Concurrent copies to each repo. (Default: 2)")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="Concurrent copies, all repos. (Default: 8)")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only report what would be copied.")
+    parser.add_argument("--rehash", action="store_true",
+                        help="Ignore the manifests and hash every file.")
+    parser.add_argument("-o", "--output",
+                        help="Write the compliance report to this JSON file.")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    hash_rows = load_csv(args.hash_list)
+    repos = load_repos(load_csv(args.repo_map),
+                       load_csv(args.repos) if args.repos else None,
+                       args.region)
+    if not repos:
+        parser.error("no repos to sync")
+
+    master_manifest = repo_manifest(args.master, args.rehash)
+    if not args.dry_run:
+        save_manifest(os.path.join(args.master, MANIFEST_NAME),
+                      master_manifest)
+    files, problems = master_files(master_manifest, hash_rows)
+    for problem in problems:
+        print(f"WARNING: Not syncing {problem}", file=sys.stderr)
+
+    slots = threading.BoundedSemaphore(args.jobs)
+    with ThreadPoolExecutor(max_workers=len(repos)) as pool:
+        reports = list(pool.map(
+            lambda repo: sync_repo(repo, args.master, files, args.per_repo,
+                                   slots, args.dry_run, args.rehash),
+            repos
+        ))
+
+    for report in reports:
+        print(f"{report['status']:<14} {report['address']}"
+              f" ({report['path']}): {report['compliant']}/{report['files']}"
+              f" files, {report['copied']} copied"
+              f" ({report['copied_bytes'] / 1e9:.2f} GB),"
+              f" {len(report['failed'])} failed")
+        if args.dry_run and report['status'] == STATUS_NON_COMPLIANT:
+            print(f"{'':<14} would copy {len(report['missing'])} missing,"
+                  f" {len(report['mismatched'])} mismatched")
+        for failure in report['failed']:
+            print(f"{'':<14} {failure}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"generated": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                                  time.gmtime()),
+                       "problems": problems, "repos": reports}, f, indent=1)
+    compliant = sum(1 for report in reports
+                    if report['status'] == STATUS_COMPLIANT)
+    print(f"{compliant}/{len(reports)} repos compliant"
+          f" ({time.monotonic() - started:.2f}s)")
+    return 0 if compliant == len(reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
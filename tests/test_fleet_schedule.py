@@ -0,0 +1,62 @@
+import datetime
+import unittest
+
+import fleet_schedule
+
+
+def _site(start, end, mbps=100.0, priority=0):
+    return {"start": start, "end": end, "mbps": mbps, "priority": priority}
+
+
+class BuildScheduleTest(unittest.TestCase):
+
+    def test_unaligned_window_start_is_rounded_up(self):
+        day = datetime.datetime(2024, 1, 1)
+        sites = {
+            "A": _site(day.replace(hour=22),
+                       day.replace(hour=2) + datetime.timedelta(days=1)),
+            "B": _site(day.replace(hour=22, minute=3),
+                       day.replace(hour=22, minute=13)),
+        }
+        devices = [
+            {"DeviceID": "1", "DeviceName": "a1", "Site": "A",
+             "repo": "r", "bytes": 1000},
+            {"DeviceID": "2", "DeviceName": "b1", "Site": "B",
+             "repo": "r", "bytes": 1000},
+        ]
+        scheduled, unscheduled = fleet_schedule.build_schedule(
+            devices, sites, {}, 1000.0, 10.0, slot_minutes=5
+        )
+        self.assertEqual(unscheduled, [])
+        for row in scheduled:
+            site = sites[row["Site"]]
+            self.assertGreaterEqual(row["Start"], site["start"])
+            self.assertLessEqual(row["End"], site["end"])
+        row = next(row for row in scheduled if row["Site"] == "B")
+        self.assertEqual(row["Start"], day.replace(hour=22, minute=5))
+        self.assertEqual(row["End"], day.replace(hour=22, minute=10))
+
+    def test_window_shorter_than_a_slot_after_rounding(self):
+        day = datetime.datetime(2024, 1, 1)
+        sites = {
+            "A": _site(day.replace(hour=22), day.replace(hour=23)),
+            "B": _site(day.replace(hour=22, minute=3),
+                       day.replace(hour=22, minute=8)),
+        }
+        devices = [
+            {"DeviceID": "1", "DeviceName": "a1", "Site": "A",
+             "repo": "r", "bytes": 1000},
+            {"DeviceID": "2", "DeviceName": "b1", "Site": "B",
+             "repo": "r", "bytes": 1000},
+        ]
+        scheduled, unscheduled = fleet_schedule.build_schedule(
+            devices, sites, {}, 1000.0, 10.0, slot_minutes=5
+        )
+        self.assertEqual([row["Site"] for row in scheduled], ["A"])
+        self.assertEqual([(plan["DeviceID"], reason)
+                          for plan, reason in unscheduled],
+                         [("2", "WINDOW_TOO_SHORT")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# trace_summary.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Summarizes the job traces (OTLP/JSON) of a batch, as written by the job
+#   to /tmp/na_ciscoswtransfer/traces on the appliance.
+#
+#   Prints:
+#       - Where the fleet spends its time: total/mean/max seconds per span
+#         name, across every device.
+#       - The slowest devices, with their critical path (the chain of the
+#         longest child span, from the root span down).
+#
+# USAGE:
+#   python trace_summary.py traces/
+#   python trace_summary.py traces/ --top 20
+#------------------------------------------------------------------------------
+import argparse
+import json
+import os
+import sys
+
+
+def load_traces(path):
+    """Load every trace file in a directory (or a single file).
+
+    Returns:
+        list: One dict per trace, with keys:
+            - 'resource' (dict): Resource attributes.
+            - 'spans' (list): Span dicts, with 'name', 'span_id',
+              'parent_id', 'start', 'end' (seconds) and 'error' (bool).
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                 if name.endswith(".json")]
+    else:
+        files = [path]
+    traces = []
+    for file in files:
+        with open(file, "r") as f:
+            data = json.load(f)
+        for resource_spans in data.get("resourceSpans", []):
+            resource = {
+                attr['key']: next(iter(attr['value'].values()))
+                for attr in resource_spans['resource'].get("attributes", [])
+            }
+            spans = []
+            for scope_spans in resource_spans.get("scopeSpans", []):
+                for span in scope_spans.get("spans", []):
+                    spans.append({
+                        "name": span['name'],
+                        "span_id": span['spanId'],
+                        "parent_id": span.get("parentSpanId"),
+                        "start": int(span['startTimeUnixNano']) / 1e9,
+                        "end": int(span['endTimeUnixNano']) / 1e9,
+                        "error": span.get("status", {}).get("code") == 2
+                    })
+            traces.append({"resource": resource, "spans": spans})
+    return traces
+
+
+def critical_path(spans):
+    """Follow the longest child span, from the root span down.
+
+    Returns:
+        list: Spans on the path, root first.
+    """
+    children = {}
+    root = None
+    for span in spans:
+        if span['parent_id']:
+            children.setdefault(span['parent_id'], []).append(span)
+        elif root is None or span['end'] - span['start'] > (root['end']
+                                                             - root['start']):
+            root = span
+    path = []
+    while root is not None:
+        path.append(root)
+        kids = children.get(root['span_id'])
+        root = (max(kids, key=lambda s: s['end'] - s['start'])
+                if kids else None)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize the job traces of a batch."
+    )
+    parser.add_argument("path", help="Traces directory, or a trace file.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest devices to show.")
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.path)
+    if not traces:
+        print("No traces found.", file=sys.stderr)
+        return 1
+
+    # name: [count, total, max, errors]
+    by_name = {}
+    devices = []
+    for trace in traces:
+        for span in trace['spans']:
+            stats = by_name.setdefault(span['name'], [0, 0.0, 0.0, 0])
+            seconds = span['end'] - span['start']
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += span['error']
+        path = critical_path(trace['spans'])
+        if path:
+            devices.append((path[0]['end'] - path[0]['start'],
+                            trace['resource'].get("netmri.device_id"), path))
+
+    print(f"{len(traces)} traces\n")
+    print(f"{'Span':<28} {'Count':>7} {'Total s':>11} {'Mean s':>9}"
+          f" {'Max s':>9} {'Errors':>7}")
+    for name, (count, total, peak, errors) in sorted(
+            by_name.items(), key=lambda item: -item[1][1]):
+        print(f"{name:<28} {count:>7} {total:>11.1f} {total / count:>9.1f}"
+              f" {peak:>9.1f} {errors:>7}")
+
+    print(f"\nSlowest {min(args.top, len(devices))} devices (critical path):")
+    devices.sort(key=lambda item: -item[0])
+    for seconds, device_id, path in devices[:args.top]:
+        chain = " > ".join(
+            f"{span['name']} ({span['end'] - span['start']:.1f}s)"
+            for span in path
+        )
+        print(f"  {device_id}: {seconds:.1f}s  {chain}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
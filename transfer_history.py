@@ -0,0 +1,120 @@
+#------------------------------------------------------------------------------
+# NetMRI Cisco OS Software Transfer
+# transfer_history.py
+#
+# Copyright (c) 2023 Infoblox, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# DESCRIPTION:
+#   Reports the transfer history of the jobs (see TransferHistory.py), as
+#   recorded by the job in /tmp/na_ciscoswtransfer/history.sqlite on the
+#   appliance.
+#
+#   Prints the throughput percentiles (Mbps) of the passed transfers (or
+#   integrity checks), and the failure count, by repo, site, platform, OS,
+#   file, hour of the day, or HTTP client tuning ('tune_http_client', 0 or
+#   1). Slowest median first, so the groups to look at are on top.
+#
+# USAGE:
+#   python transfer_history.py history.sqlite
+#   python transfer_history.py history.sqlite --by platform --since 7
+#   python transfer_history.py history.sqlite --by site -i inventory.csv
+#   python transfer_history.py history.sqlite --by tuned
+#   python transfer_history.py history.sqlite --kind verify -o report.json
+#
+# NOTES:
+#   1. The job doesn't know the sites. --by site needs an inventory CSV with
+#      the columns DeviceID and Site (e.g: the fleet_plan.py inventory).
+#      Devices without a site aren't in the report.
+#------------------------------------------------------------------------------
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from TransferHistory import (GROUP_COLUMNS, KIND_TRANSFER, KIND_VERIFY,
+                             TransferHistory)
+
+PERCENTILES = (5, 50, 95)
+
+
+def load_csv(path):
+    """Read a CSV file into a list of dicts."""
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report the transfer history of the Cisco OS Software"
+        " Transfer jobs."
+    )
+    parser.add_argument("history", help="Transfer history database.")
+    parser.add_argument("--by", choices=GROUP_COLUMNS, default="repo",
+                        help="Group by. (Default: repo)")
+    parser.add_argument("--kind", choices=(KIND_TRANSFER, KIND_VERIFY),
+                        default=KIND_TRANSFER,
+                        help="Transfers, or integrity checks.")
+    parser.add_argument("--since", type=float,
+                        help="Only the last this many days.")
+    parser.add_argument("-i", "--inventory",
+                        help="Inventory CSV (DeviceID, Site), for --by"
+                        " site.")
+    parser.add_argument("-o", "--output",
+                        help="Write the report to this JSON file.")
+    args = parser.parse_args(argv)
+
+    if args.by == "site" and not args.inventory:
+        parser.error("--by site requires --inventory")
+    if not os.path.isfile(args.history):
+        parser.error(f"{args.history} not found")
+
+    try:
+        history = TransferHistory(args.history)
+    except sqlite3.Error as err:
+        print(f"Unable to open {args.history}: {err}", file=sys.stderr)
+        return 1
+    try:
+        if args.inventory:
+            history.set_sites({row.get('DeviceID'): row.get('Site')
+                               for row in load_csv(args.inventory)})
+        since = time.time() - args.since * 24 * 3600 if args.since else None
+        groups = history.throughput(args.by, args.kind, since, PERCENTILES)
+    finally:
+        history.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(groups, f, indent=1)
+    if not groups:
+        print("No history found.", file=sys.stderr)
+        return 1
+
+    groups.sort(key=lambda group: group['p50'])
+    columns = "".join(f" {f'p{pct}':>9}" for pct in PERCENTILES)
+    print(f"{args.by.capitalize():<40} {'Passed':>7} {'Failed':>7}{columns}")
+    for group in groups:
+        values = "".join(f" {group[f'p{pct}']:>9.1f}" for pct in PERCENTILES)
+        print(f"{str(group[args.by]):<40} {group['count']:>7}"
+              f" {group['failed']:>7}{values}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())